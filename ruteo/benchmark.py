@@ -0,0 +1,377 @@
+"""
+    benchmark.py
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from apps.ruteo.proveedores import ProveedorLineaRecta
+from apps.ruteo.preprocesamiento import (
+    obtener_pasajeros_ruta, formato_dataframe, agrupar_por_destinos,
+    agrupar_por_horas, obtener_ruta_previa)
+from apps.ruteo.ruta import obtener_rutas_ida, servicios_completos
+
+# Columnas que retorna obtener_servicios (obtain_services.sql)
+COLUMNAS_SERVICIOS = [
+    'OBSERVACIONES', 'ESTADO_SERVICIO', 'SERVICIO_ID', 'CLIENTE_ID',
+    'IDENTIFICACION_USUARIO', 'NOMBRE_USUARIO', 'CRITICIDAD',
+    'MEDIO_DE_APOYO', 'FECHA_SERVICIO', 'HORA_SERVICIO',
+    'REGIONAL_ID_ORIGEN', 'CIUDAD_ID_ORIGEN', 'CIUDAD_ORIGEN',
+    'LOCALIDAD_ORIGEN', 'UPZ_ORIGEN', 'BARRIO_ORIGEN', 'DIRECCION_ORIGEN',
+    'DESCRIPCION_ORIGEN', 'REGIONAL_ID_DESTINO', 'CIUDAD_ID_DESTINO',
+    'CIUDAD_DESTINO', 'LOCALIDAD_DESTINO', 'UPZ_DESTINO',
+    'DIRECCION_DESTINO', 'DESCRIPCION_DESTINO', 'TIPO_RUTA',
+    'LATITUD_ORIGEN', 'LONGITUD_ORIGEN', 'LATITUD_DESTINO',
+    'LONGITUD_DESTINO', 'CELULAR_1', 'CELULAR_2', 'DETALLE_SERVICIO',
+]
+# Ciudades sintéticas: (id, nombre, regional, latitud, longitud,
+# dispersión de los orígenes en grados, número de destinos, peso)
+CIUDADES = [
+    (1, 'BOGOTA', 1, 4.65, -74.08, 0.06, 25, 0.6),
+    (2, 'MEDELLIN', 2, 6.24, -75.58, 0.04, 12, 0.25),
+    (3, 'CALI', 3, 3.43, -76.52, 0.04, 8, 0.15),
+]
+# Picos de hora de servicio: (hora media en minutos, desviación, peso)
+PICOS_HORA = [(6 * 60 + 30, 40, 0.5), (13 * 60, 60, 0.2),
+              (17 * 60 + 30, 45, 0.3)]
+TAMANOS = (100, 1000, 10000, 100000)
+
+
+def generar_servicios(n_servicios, fecha_inicio='2023-04-05', dias=1,
+                      semilla=0, ciudades=CIUDADES, prop_ida=0.6,
+                      prop_sin_coordenadas=0.01):
+    """
+    Genera una tabla sintética de servicios con las columnas de
+        obtener_servicios.
+
+    Los destinos son pocos puntos fijos por ciudad (sedes) con una pequeña
+    variación de coordenadas, los orígenes se dispersan alrededor del
+    centro de cada ciudad y las horas siguen una mezcla de picos del día,
+    redondeadas a 5 minutos. La generación es determinística por semilla.
+
+    Args:
+        n_servicios (int): Número de filas.
+        fecha_inicio (str, opcional): Primera fecha de servicio (YYYY-MM-DD).
+        dias (int, opcional): Número de días consecutivos.
+        semilla (int, opcional): Semilla del generador aleatorio.
+        ciudades (list of tuple, opcional): Ciudades con la forma de CIUDADES.
+        prop_ida (float, opcional): Proporción de servicios de ida.
+        prop_sin_coordenadas (float, opcional): Proporción de servicios sin
+            coordenadas de origen.
+
+    Returns:
+        pd.DataFrame: Servicios con las columnas de COLUMNAS_SERVICIOS y las
+            coordenadas como float (NaN si faltan).
+
+    Example:
+        df_servicios = generar_servicios(1000, dias=2, semilla=1)
+    """
+    rng = np.random.default_rng(semilla)
+    pesos = np.array([ciudad[7] for ciudad in ciudades], dtype=float)
+    indice_ciudad = rng.choice(len(ciudades), n_servicios, p=pesos / pesos.sum())
+    ciudad = [ciudades[i] for i in indice_ciudad]
+    centro = np.array([(c[3], c[4]) for c in ciudad])
+    dispersion = np.array([c[5] for c in ciudad])
+    # Sedes de destino por ciudad, fijas para la semilla
+    sedes = [c[3:5] + rng.normal(0, c[5] / 2, (c[6], 2)) for c in ciudades]
+    sede = np.array([rng.integers(len(sedes[i])) for i in indice_ciudad])
+    destinos = np.array([sedes[i][s] for i, s in zip(indice_ciudad, sede)])
+    destinos += rng.normal(0, 0.0002, destinos.shape)
+    origenes = centro + rng.normal(0, 1, (n_servicios, 2)) * \
+        dispersion[:, None]
+    sin_coordenadas = rng.random(n_servicios) < prop_sin_coordenadas
+    origenes[sin_coordenadas] = np.nan
+    pesos_hora = np.array([pico[2] for pico in PICOS_HORA])
+    pico = rng.choice(len(PICOS_HORA), n_servicios,
+                      p=pesos_hora / pesos_hora.sum())
+    minutos = rng.normal([PICOS_HORA[p][0] for p in pico],
+                         [PICOS_HORA[p][1] for p in pico])
+    minutos = (np.clip(minutos, 0, 24 * 60 - 5) // 5 * 5).astype(int)
+    inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
+    fechas = [(inicio + timedelta(days=int(dia))).strftime('%Y-%m-%d')
+              for dia in rng.integers(0, dias, n_servicios)]
+    usuarios = rng.integers(10**7, 10**7 + max(1, n_servicios // 2),
+                            n_servicios)
+    df_servicios = pd.DataFrame({
+        'OBSERVACIONES': '',
+        'ESTADO_SERVICIO': 1,
+        'SERVICIO_ID': np.arange(1, n_servicios + 1),
+        'CLIENTE_ID': rng.integers(1, 5, n_servicios),
+        'IDENTIFICACION_USUARIO': usuarios.astype(str),
+        'NOMBRE_USUARIO': [f"Pasajero {usuario}" for usuario in usuarios],
+        'CRITICIDAD': rng.integers(1, 4, n_servicios),
+        'MEDIO_DE_APOYO': rng.integers(1, 3, n_servicios),
+        'FECHA_SERVICIO': fechas,
+        'HORA_SERVICIO': [f"{m // 60:02d}:{m % 60:02d}:00" for m in minutos],
+        'REGIONAL_ID_ORIGEN': [c[2] for c in ciudad],
+        'CIUDAD_ID_ORIGEN': [c[0] for c in ciudad],
+        'CIUDAD_ORIGEN': [c[1] for c in ciudad],
+        'LOCALIDAD_ORIGEN': '',
+        'UPZ_ORIGEN': '',
+        'BARRIO_ORIGEN': '',
+        'DIRECCION_ORIGEN': '',
+        'DESCRIPCION_ORIGEN': '',
+        'REGIONAL_ID_DESTINO': [c[2] for c in ciudad],
+        'CIUDAD_ID_DESTINO': [c[0] for c in ciudad],
+        'CIUDAD_DESTINO': [c[1] for c in ciudad],
+        'LOCALIDAD_DESTINO': '',
+        'UPZ_DESTINO': '',
+        'DIRECCION_DESTINO': [f"Sede {s}" for s in sede],
+        'DESCRIPCION_DESTINO': '',
+        'TIPO_RUTA': 1,
+        'LATITUD_ORIGEN': origenes[:, 0].round(6),
+        'LONGITUD_ORIGEN': origenes[:, 1].round(6),
+        'LATITUD_DESTINO': destinos[:, 0].round(6),
+        'LONGITUD_DESTINO': destinos[:, 1].round(6),
+        'CELULAR_1': '',
+        'CELULAR_2': '',
+        'DETALLE_SERVICIO': np.where(
+            rng.random(n_servicios) < prop_ida, 'Ida', 'Retorno'),
+    }, columns=COLUMNAS_SERVICIOS)
+    return df_servicios.sort_values(
+        'FECHA_SERVICIO', kind='mergesort').reset_index(drop=True)
+
+
+class ProveedorConteo(ProveedorLineaRecta):
+    """
+    Proveedor determinístico en línea recta que cuenta las solicitudes,
+        usado en lugar de la API de rutas durante el benchmark.
+    """
+    nombre = 'benchmark'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.llamadas = 0
+        self._lock = threading.Lock()
+
+    def direcciones(self, *args, **kwargs):
+        with self._lock:
+            self.llamadas += 1
+        return super().direcciones(*args, **kwargs)
+
+
+def medir(etapa, conteo, funcion, *args, **kwargs):
+    """
+    Ejecuta una función midiendo su tiempo, memoria pico y solicitudes de
+        rutas.
+
+    La salida estándar de la función se descarta para no mezclarla con
+    los resultados.
+
+    Args:
+        etapa (str): Nombre de la etapa.
+        conteo (ProveedorConteo): Proveedor cuyas llamadas se cuentan.
+        funcion (callable): Función a medir.
+        *args, **kwargs: Argumentos de la función.
+
+    Returns:
+        tuple: Resultado de la función y diccionario con las llaves etapa,
+            segundos, memoria_pico_mb y llamadas_api.
+    """
+    llamadas = conteo.llamadas
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        resultado = funcion(*args, **kwargs)
+    segundos = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, {
+        'etapa': etapa,
+        'segundos': round(segundos, 6),
+        'memoria_pico_mb': round(pico / 2**20, 3),
+        'llamadas_api': conteo.llamadas - llamadas,
+    }
+
+
+def medir_etapas(df_servicios, proveedor, tiempo_aprox=30):
+    """
+    Mide por separado cada etapa del cálculo de rutas de ida.
+
+    Cada etapa recibe como entrada la salida ya calculada de la anterior,
+    de modo que su medición no incluye el trabajo de las demás.
+
+    Args:
+        df_servicios (pd.DataFrame): Servicios de generar_servicios.
+        proveedor (ProveedorConteo): Proveedor de rutas.
+        tiempo_aprox (int, opcional): Tiempo aproximado de ruta en minutos.
+
+    Returns:
+        list of dict: Una medición por etapa.
+    """
+    mediciones = []
+    df_ida = obtener_pasajeros_ruta(df_servicios, 0)
+    (df_rutas, _), medicion = medir(
+        'formato_dataframe', proveedor, formato_dataframe, df_ida.copy())
+    mediciones.append(medicion)
+    if df_rutas.empty:
+        return mediciones
+    etiquetas, medicion = medir(
+        'agrupar_por_destinos', proveedor, agrupar_por_destinos, df_rutas)
+    mediciones.append(medicion)
+    df_rutas['GRUPO_DESTINO'] = etiquetas
+    df_rutas.reset_index(drop=True, inplace=True)
+    df_rutas, medicion = medir(
+        'agrupar_por_horas', proveedor, agrupar_por_horas, df_rutas)
+    mediciones.append(medicion)
+    df_rutas.sort_values(['GRUPO_HORA', 'GRUPO_DESTINO'], inplace=True)
+    df_rutas.reset_index(drop=True, inplace=True)
+    _, medicion = medir(
+        'obtener_ruta_previa', proveedor, obtener_ruta_previa, df_rutas)
+    mediciones.append(medicion)
+    _, medicion = medir(
+        'obtener_rutas_ida', proveedor, obtener_rutas_ida, df_servicios.copy(),
+        (1 / 15) * tiempo_aprox, 1, proveedor)
+    mediciones.append(medicion)
+    return mediciones
+
+
+def medir_completo(df_servicios, proveedor, tiempo_aprox=30):
+    """
+    Mide servicios_completos de principio a fin sobre un archivo CSV
+        temporal con los servicios.
+
+    Args:
+        df_servicios (pd.DataFrame): Servicios de generar_servicios.
+        proveedor (ProveedorConteo): Proveedor de rutas.
+        tiempo_aprox (int, opcional): Tiempo aproximado de ruta en minutos.
+
+    Returns:
+        dict: Medición de la etapa servicios_completos, con las filas de
+            ida y retorno obtenidas y la llave error (None si el resultado
+            es válido).
+    """
+    descriptor, ruta_csv = tempfile.mkstemp(suffix='.csv')
+    os.close(descriptor)
+    try:
+        df_servicios.to_csv(ruta_csv, index=False)
+        fechas = df_servicios['FECHA_SERVICIO']
+        (df_ida, df_retorno), medicion = medir(
+            'servicios_completos', proveedor, servicios_completos,
+            fechas.min(), fechas.max(), tiempo_aprox=tiempo_aprox,
+            by_excel=ruta_csv, n_procesos=1, n_hilos=1, proveedor=proveedor)
+    finally:
+        os.remove(ruta_csv)
+    medicion['filas_ida'] = len(df_ida)
+    medicion['filas_retorno'] = len(df_retorno)
+    # servicios_completos retorna DataFrames vacíos ante cualquier error
+    hay_ida = (df_servicios['DETALLE_SERVICIO'].str.lower() == 'ida').any()
+    medicion['error'] = 'servicios_completos no retornó rutas de ida' \
+        if hay_ida and df_ida.empty else None
+    return medicion
+
+
+def ejecutar_benchmark(tamanos=TAMANOS, dias=1, semilla=0, tiempo_aprox=30,
+                       etapas=True, completo=True):
+    """
+    Ejecuta el benchmark para varios tamaños de tabla de servicios.
+
+    Args:
+        tamanos (iterable of int, opcional): Número de servicios por corrida.
+        dias (int, opcional): Días de servicio de cada tabla.
+        semilla (int, opcional): Semilla del generador.
+        tiempo_aprox (int, opcional): Tiempo aproximado de ruta en minutos.
+        etapas (bool, opcional): Si se miden las etapas por separado.
+        completo (bool, opcional): Si se mide servicios_completos.
+
+    Returns:
+        dict: Resultados serializables a JSON con el entorno de ejecución y
+            una lista de mediciones por tamaño y etapa.
+
+    Example:
+        resultados = ejecutar_benchmark([100, 1000])
+        print(json.dumps(resultados, indent=2))
+    """
+    resultados = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'plataforma': platform.platform(),
+        'parametros': {'dias': dias, 'semilla': semilla,
+                       'tiempo_aprox': tiempo_aprox},
+        'mediciones': [],
+    }
+    for tamano in tamanos:
+        df_servicios = generar_servicios(tamano, dias=dias, semilla=semilla)
+        mediciones = []
+        if etapas:
+            mediciones.extend(medir_etapas(
+                df_servicios, ProveedorConteo(), tiempo_aprox))
+        if completo:
+            mediciones.append(medir_completo(
+                df_servicios, ProveedorConteo(), tiempo_aprox))
+        for medicion in mediciones:
+            medicion['servicios'] = tamano
+        resultados['mediciones'].extend(mediciones)
+    return resultados
+
+
+def comparar(base, actual, tolerancia=0.1):
+    """
+    Compara dos resultados de ejecutar_benchmark.
+
+    Args:
+        base (dict): Resultados de referencia.
+        actual (dict): Resultados nuevos.
+        tolerancia (float, opcional): Aumento relativo permitido en tiempo y
+            memoria antes de marcar una regresión.
+
+    Returns:
+        list of dict: Una fila por etapa y tamaño presentes en ambos, con la
+            relación actual/base de cada métrica y si es una regresión.
+    """
+    referencia = {(m['servicios'], m['etapa']): m for m in base['mediciones']}
+    filas = []
+    for medicion in actual['mediciones']:
+        anterior = referencia.get((medicion['servicios'], medicion['etapa']))
+        if anterior is None:
+            continue
+        fila = {'servicios': medicion['servicios'], 'etapa': medicion['etapa']}
+        for metrica in ('segundos', 'memoria_pico_mb', 'llamadas_api'):
+            fila[metrica] = round(
+                medicion[metrica] / anterior[metrica], 3) \
+                if anterior[metrica] else None
+        fila['regresion'] = bool(medicion.get('error')) or any(
+            fila[metrica] is not None and fila[metrica] > 1 + tolerancia
+            for metrica in ('segundos', 'memoria_pico_mb')) or \
+            medicion['llamadas_api'] > anterior['llamadas_api']
+        filas.append(fila)
+    return filas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark del cálculo de rutas con datos sintéticos')
+    parser.add_argument('--tamanos', type=int, nargs='+', default=TAMANOS)
+    parser.add_argument('--dias', type=int, default=1)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--tiempo-aprox', type=int, default=30)
+    parser.add_argument('--sin-etapas', action='store_true')
+    parser.add_argument('--sin-completo', action='store_true')
+    parser.add_argument('--salida', help='Archivo JSON de resultados')
+    parser.add_argument('--base', help='Resultados anteriores para comparar')
+    args = parser.parse_args()
+    resultados = ejecutar_benchmark(
+        args.tamanos, args.dias, args.semilla, args.tiempo_aprox,
+        not args.sin_etapas, not args.sin_completo)
+    if args.base:
+        with open(args.base, 'r', encoding='utf-8') as archivo:
+            resultados['comparacion'] = comparar(json.load(archivo), resultados)
+    texto = json.dumps(resultados, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto)
+    print(texto)
+    if any(medicion.get('error') for medicion in resultados['mediciones']):
+        sys.exit(1)
@@ -0,0 +1,302 @@
+"""
+    cache_rutas.py
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from apps.ruteo.constantes import (
+    CACHE_ACTIVA, CACHE_PATH, CACHE_TTL_HORAS, CACHE_MAX_ENTRADAS,
+    CACHE_PRECISION, CACHE_MINUTOS_FRANJA)
+
+
+def normalizar_ubicacion(ubicacion, precision=CACHE_PRECISION):
+    """
+    Normaliza una ubicación para usarla como parte de la llave del cache.
+
+    Args:
+        ubicacion (str or tuple): Dirección o tupla (latitud, longitud).
+        precision (int): Número de decimales a los que se redondean
+            las coordenadas.
+
+    Returns:
+        str: Representación normalizada de la ubicación.
+    """
+    if isinstance(ubicacion, str):
+        return ubicacion.strip().lower()
+    lat, lon = ubicacion[0], ubicacion[1]
+    return f"{round(float(lat), precision)},{round(float(lon), precision)}"
+
+
+def franja_horaria(departure_time, minutos=CACHE_MINUTOS_FRANJA):
+    """
+    Trunca una hora de salida a la franja de `minutos` que la contiene.
+
+    Args:
+        departure_time (datetime): Hora de salida de la ruta.
+        minutos (int): Tamaño de la franja en minutos.
+
+    Returns:
+        str: Inicio de la franja en formato 'YYYY-MM-DD HH:MM'.
+    """
+    if departure_time is None:
+        return ''
+    fecha_hora = pd.Timestamp(departure_time).floor(f"{minutos}min")
+    return fecha_hora.strftime('%Y-%m-%d %H:%M')
+
+
+def reducir_respuesta(directions_result):
+    """
+    Conserva únicamente los campos de la respuesta de Directions que
+        usa el proceso de ruteo.
+
+    Se guardan las duraciones (con tráfico, si la respuesta la trae) y
+    distancias de trayectos y pasos, las polilíneas de cada paso, las
+    ubicaciones de inicio y fin de cada trayecto y el orden de los
+    waypoints.
+
+    Args:
+        directions_result (list): Respuesta de la API de Google Maps Directions.
+
+    Returns:
+        list: Respuesta con la misma estructura pero solo con los campos usados.
+    """
+    rutas = []
+    for route in directions_result or []:
+        legs = []
+        for leg in route.get('legs', []):
+            steps = [{
+                'duration': {'value': step['duration']['value']},
+                'polyline': {'points': step['polyline']['points']}
+            } for step in leg.get('steps', [])]
+            legs.append({
+                'duration': {'value': leg.get('duration', {}).get('value', 0)},
+                'distance': {'value': leg.get('distance', {}).get('value', 0)},
+                'start_location': leg.get('start_location'),
+                'end_location': leg.get('end_location'),
+                'steps': steps
+            })
+            if 'duration_in_traffic' in leg:
+                legs[-1]['duration_in_traffic'] = {
+                    'value': leg['duration_in_traffic']['value']}
+        rutas.append({
+            'legs': legs,
+            'waypoint_order': route.get('waypoint_order', [])
+        })
+    return rutas
+
+
+class CacheRutas:
+    """
+    Cache persistente en SQLite para las respuestas de rutas.
+
+    Las entradas expiran después de `ttl_horas` y, cuando se supera
+    `max_entradas`, se eliminan las usadas hace más tiempo (LRU).
+
+    Args:
+        ruta (str): Ruta del archivo SQLite.
+        ttl_horas (int): Horas de vigencia de cada entrada.
+        max_entradas (int): Número máximo de entradas almacenadas.
+        precision (int): Decimales usados al normalizar coordenadas.
+        minutos_franja (int): Tamaño de la franja de hora de salida.
+
+    Attributes:
+        conn (sqlite3.Connection): Conexión al archivo del cache.
+    """
+    PURGA_CADA = 100
+
+    def __init__(self, ruta=CACHE_PATH, ttl_horas=CACHE_TTL_HORAS,
+                 max_entradas=CACHE_MAX_ENTRADAS, precision=CACHE_PRECISION,
+                 minutos_franja=CACHE_MINUTOS_FRANJA):
+        self.ttl = ttl_horas * 3600
+        self.max_entradas = max_entradas
+        self.precision = precision
+        self.minutos_franja = minutos_franja
+        self._lock = threading.Lock()
+        self._escrituras = 0
+        self.conn = sqlite3.connect(
+            ruta, timeout=30, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rutas ("
+                "clave TEXT PRIMARY KEY, respuesta TEXT NOT NULL, "
+                "creado REAL NOT NULL, ultimo_acceso REAL NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_rutas_acceso "
+                "ON rutas (ultimo_acceso)")
+        self.purgar()
+
+    def clave(self, origen, destino, waypoints=None, departure_time=None,
+              optimize=True):
+        """
+        Construye la llave del cache para una solicitud de ruta.
+
+        Returns:
+            str: Llave compuesta por origen, destino, waypoints, bandera de
+                optimización y franja de la hora de salida.
+        """
+        puntos = [normalizar_ubicacion(punto, self.precision)
+                  for punto in (waypoints or [])]
+        return "|".join([
+            normalizar_ubicacion(origen, self.precision),
+            normalizar_ubicacion(destino, self.precision),
+            ";".join(puntos),
+            str(int(bool(optimize))),
+            franja_horaria(departure_time, self.minutos_franja)
+        ])
+
+    def clave_matriz(self, origen, destino, departure_time=None):
+        """
+        Construye la llave del cache para un elemento (origen, destino) de
+            una matriz de tiempos.
+
+        Returns:
+            str: Llave compuesta por origen, destino y franja de salida.
+        """
+        return "|".join([
+            "matriz",
+            normalizar_ubicacion(origen, self.precision),
+            normalizar_ubicacion(destino, self.precision),
+            franja_horaria(departure_time, self.minutos_franja)
+        ])
+
+    def obtener(self, clave):
+        """
+        Busca una respuesta en el cache.
+
+        Args:
+            clave (str): Llave generada con `clave`.
+
+        Returns:
+            list or None: Respuesta reducida o None si no existe o expiró.
+        """
+        ahora = time.time()
+        with self._lock:
+            fila = self.conn.execute(
+                "SELECT respuesta, creado FROM rutas WHERE clave = ?",
+                (clave,)).fetchone()
+            if fila is None:
+                return None
+            if ahora - fila[1] > self.ttl:
+                with self.conn:
+                    self.conn.execute(
+                        "DELETE FROM rutas WHERE clave = ?", (clave,))
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE rutas SET ultimo_acceso = ? WHERE clave = ?",
+                    (ahora, clave))
+        return json.loads(fila[0])
+
+    def obtener_varios(self, claves, tamano_lote=500):
+        """
+        Busca varias entradas en el cache con pocas consultas.
+
+        Args:
+            claves (list of str): Llaves a buscar.
+            tamano_lote (int): Número máximo de llaves por consulta.
+
+        Returns:
+            dict: Valor almacenado por llave, solo para las encontradas
+                y vigentes.
+        """
+        ahora = time.time()
+        encontradas = {}
+        claves = list(dict.fromkeys(claves))
+        with self._lock:
+            for inicio in range(0, len(claves), tamano_lote):
+                lote = claves[inicio:inicio + tamano_lote]
+                filas = self.conn.execute(
+                    "SELECT clave, respuesta FROM rutas WHERE creado >= ? "
+                    f"AND clave IN ({','.join('?' * len(lote))})",
+                    [ahora - self.ttl, *lote]).fetchall()
+                encontradas.update(filas)
+            if encontradas:
+                with self.conn:
+                    self.conn.executemany(
+                        "UPDATE rutas SET ultimo_acceso = ? WHERE clave = ?",
+                        [(ahora, clave) for clave in encontradas])
+        return {clave: json.loads(valor)
+                for clave, valor in encontradas.items()}
+
+    def guardar_varios(self, valores):
+        """
+        Guarda varias entradas en una sola transacción.
+
+        Args:
+            valores (dict): Valor serializable a JSON por llave.
+        """
+        self._insertar([
+            (clave, json.dumps(valor, separators=(',', ':')))
+            for clave, valor in valores.items()])
+
+    def guardar(self, clave, directions_result):
+        """
+        Guarda la versión reducida de una respuesta en el cache.
+
+        Args:
+            clave (str): Llave generada con `clave`.
+            directions_result (list): Respuesta de la API de Directions.
+
+        Returns:
+            list: Respuesta reducida que fue almacenada.
+        """
+        reducida = reducir_respuesta(directions_result)
+        self._insertar(
+            [(clave, json.dumps(reducida, separators=(',', ':')))])
+        return reducida
+
+    def _insertar(self, filas):
+        ahora = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rutas "
+                "(clave, respuesta, creado, ultimo_acceso) VALUES (?, ?, ?, ?)",
+                [(clave, respuesta, ahora, ahora) for clave, respuesta in filas])
+            anteriores = self._escrituras
+            self._escrituras += len(filas)
+            purgar = self._escrituras // self.PURGA_CADA > \
+                anteriores // self.PURGA_CADA
+        if purgar:
+            self.purgar()
+
+    def purgar(self):
+        """
+        Elimina las entradas expiradas y las menos usadas recientemente
+            cuando se supera el máximo de entradas.
+        """
+        with self._lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM rutas WHERE creado < ?",
+                (time.time() - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM rutas WHERE clave IN ("
+                "SELECT clave FROM rutas ORDER BY ultimo_acceso DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entradas,))
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def obtener_cache():
+    """
+    Retorna la instancia compartida del cache de rutas del proceso.
+
+    Returns:
+        CacheRutas or None: Cache compartido, o None si está desactivado
+            con CACHE_ACTIVA.
+    """
+    global _cache, _cache_pid
+    if not CACHE_ACTIVA:
+        return None
+    with _cache_lock:
+        # Las conexiones SQLite no se comparten entre procesos
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = CacheRutas()
+            _cache_pid = os.getpid()
+    return _cache
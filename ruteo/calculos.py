@@ -1,9 +1,11 @@
 """
     Test
 """
+import numpy as np
 from polyline import decode
-from geopy.distance import geodesic
-from math import radians, sin, cos, sqrt, atan2
+from apps.ruteo.geo import (
+    RADIO_TIERRA_KM, haversine, geodesica, distancias_fila,
+    distancias_pares, distancias_consecutivas)
 
 def distancia_haversine_pasajero(coord1, coord2):
     """
@@ -16,20 +18,8 @@ def distancia_haversine_pasajero(coord1, coord2):
     Returns:
         float: Distancia haversine entre las coordenadas en metros.
     """
-    # Radio de la Tierra en metros
-    radio_t = 6371000.0
-    # Convertir coordenadas de grados a radianes
-    lat1, lon1 = radians(coord1[0]), radians(coord1[1])
-    lat2, lon2 = radians(coord2[0]), radians(coord2[1])
-    # Diferencia de latitud y longitud
-    diff_lat = lat2 - lat1
-    dif__lon = lon2 - lon1
-    # Calcular la distancia haversine
-    dis_a = sin(diff_lat / 2)**2 + cos(lat1) * cos(lat2) * \
-        sin(dif__lon / 2)**2
-    circ = 2 * atan2(sqrt(dis_a), sqrt(1 - dis_a))
-    distancia = radio_t * circ
-    return distancia
+    distancia = float(haversine(coord1[0], coord1[1], coord2[0], coord2[1]))
+    return distancia * 1000
 
 
 def duracion_estimada_pasajero(distancia, vel_promedio):
@@ -65,18 +55,12 @@ def duracion_estimada_ruta(route, vel_prom_km_h=30):
     Retorna:
         float: Duración estimada de la ruta en minutos.
     """
-    total_duracion_mins = 0
-
-    for i in range(len(route) - 1):
-        origin_coordinate = route[i]
-        destination_coordinate = route[i + 1]
-        distancia = distancia_haversine_pasajero(
-            origin_coordinate, destination_coordinate)
-        vel_prom_mps = vel_prom_km_h * 1000 / 3600  # Convertir km/h a m/s
-        duracion_mins = duracion_estimada_pasajero(
-            distancia, vel_prom_mps)
-        total_duracion_mins += duracion_mins
-    return total_duracion_mins
+    if len(route) < 2:
+        return 0
+    vel_prom_mps = vel_prom_km_h * 1000 / 3600  # Convertir km/h a m/s
+    distancia = distancias_consecutivas(route).sum() * 1000
+    total_duracion_mins = duracion_estimada_pasajero(distancia, vel_prom_mps)
+    return float(total_duracion_mins)
 
 
 def calcular_distancia_lineal(row):
@@ -95,10 +79,31 @@ def calcular_distancia_lineal(row):
     Ejemplo:
         df['DISTANCIA_LINEAL'] = df.apply(calcular_distancia_lineal, axis=1)
     """
-    origen = (row['LATITUD_ORIGEN'], row['LONGITUD_ORIGEN'])
-    destino = (row['LATITUD_DESTINO'], row['LONGITUD_DESTINO'])
-    distancia_km = geodesic(origen, destino).kilometers
-    return distancia_km
+    distancia_km = geodesica(
+        row['LATITUD_ORIGEN'], row['LONGITUD_ORIGEN'],
+        row['LATITUD_DESTINO'], row['LONGITUD_DESTINO'])
+    return float(distancia_km)
+
+
+def calcular_distancias_lineales(df):
+    """
+    Calcula la distancia lineal (geodésica) entre origen y destino para
+        todas las filas de un DataFrame a la vez.
+
+    Args:
+        df (pandas.DataFrame): DataFrame con las columnas LATITUD_ORIGEN,
+            LONGITUD_ORIGEN, LATITUD_DESTINO y LONGITUD_DESTINO.
+
+    Returns:
+        np.ndarray: Distancias en kilómetros, una por fila.
+
+    Ejemplo:
+        df['DISTANCIA_LINEAL'] = calcular_distancias_lineales(df)
+    """
+    return distancias_fila(
+        df[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(dtype=float),
+        df[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].to_numpy(dtype=float),
+        metodo='geodesica')
 
 
 def obtener_coordenadas_polilinea(directions_result):
@@ -111,7 +116,7 @@ def obtener_coordenadas_polilinea(directions_result):
 
 
 def filtrar_coordenadas_por_distancia(row, polyline_coords, max_distancia_km):
-    ref_coord = row['COORD_ORIGEN']
+    ref_coord = (row['LATITUD_ORIGEN'], row['LONGITUD_ORIGEN'])
     is_near = False
     for coord in polyline_coords:
         distance = distancia_haversine(ref_coord[0], ref_coord[1], coord[0], coord[1])
@@ -121,6 +126,221 @@ def filtrar_coordenadas_por_distancia(row, polyline_coords, max_distancia_km):
     return is_near
 
 
+def distancia_minima_polilinea(origenes, polilinea, max_elementos=1000000):
+    """
+    Calcula la distancia Haversine mínima de cada origen a los vértices de
+        una polilínea.
+
+    El cálculo se hace por bloques de vértices para que la matriz de
+    distancias intermedia no supere `max_elementos` elementos, sin importar
+    la longitud de la polilínea.
+
+    Args:
+        origenes (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        polilinea (array-like): Arreglo (M, 2) de vértices (latitud, longitud).
+        max_elementos (int, opcional): Tamaño máximo de cada bloque N x B.
+
+    Returns:
+        np.ndarray: Arreglo (N,) con la distancia mínima en kilómetros. Es
+            infinito si la polilínea está vacía.
+
+    Ejemplo:
+        distancias = distancia_minima_polilinea(
+            df[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(), poly_coords)
+    """
+    origenes = np.asarray(origenes, dtype=float).reshape(-1, 2)
+    polilinea = np.asarray(polilinea, dtype=float).reshape(-1, 2)
+    distancias = np.full(origenes.shape[0], np.inf)
+    if origenes.shape[0] == 0 or polilinea.shape[0] == 0:
+        return distancias
+    tamano_bloque = max(1, max_elementos // origenes.shape[0])
+    for inicio in range(0, polilinea.shape[0], tamano_bloque):
+        bloque = distancias_pares(
+            origenes, polilinea[inicio:inicio + tamano_bloque])
+        np.minimum(distancias, bloque.min(axis=1), out=distancias)
+    return distancias
+
+
+def filtrar_origenes_por_distancia(origenes, polilinea, max_distancia_km,
+                                   max_elementos=1000000):
+    """
+    Versión vectorizada de filtrar_coordenadas_por_distancia para todos los
+        orígenes a la vez.
+
+    Args:
+        origenes (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        polilinea (array-like): Arreglo (M, 2) de vértices (latitud, longitud).
+        max_distancia_km (float): Distancia máxima para considerar un origen
+            cercano a la polilínea.
+        max_elementos (int, opcional): Tamaño máximo de cada bloque de cálculo.
+
+    Returns:
+        tuple:
+            np.ndarray: Máscara booleana (N,) de orígenes cercanos.
+            np.ndarray: Distancia mínima (N,) de cada origen en kilómetros.
+    """
+    distancias = distancia_minima_polilinea(origenes, polilinea, max_elementos)
+    return distancias <= max_distancia_km, distancias
+
+
+def proyectar_coordenadas(coords, lat_ref):
+    """
+    Proyecta coordenadas (latitud, longitud) a un plano local en kilómetros.
+
+    Usa una proyección equirectangular centrada en `lat_ref`, cuyo error es
+    despreciable a la escala de una ciudad.
+
+    Args:
+        coords (np.ndarray): Arreglo (N, 2) de coordenadas en grados.
+        lat_ref (float): Latitud de referencia en grados.
+
+    Returns:
+        np.ndarray: Arreglo (N, 2) de coordenadas (x, y) en kilómetros.
+    """
+    coords = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+    planas = np.empty_like(coords)
+    planas[:, 0] = RADIO_TIERRA_KM * coords[:, 1] * np.cos(np.radians(lat_ref))
+    planas[:, 1] = RADIO_TIERRA_KM * coords[:, 0]
+    return planas
+
+
+def simplificar_polilinea(coords, tolerancia_km=0.01):
+    """
+    Simplifica una polilínea con el algoritmo de Douglas-Peucker.
+
+    Ningún vértice eliminado queda a más de `tolerancia_km` de la
+    polilínea simplificada.
+
+    Args:
+        coords (array-like): Arreglo (M, 2) de vértices (latitud, longitud).
+        tolerancia_km (float, opcional): Desviación máxima permitida en
+            kilómetros. Por defecto 10 metros.
+
+    Returns:
+        np.ndarray: Arreglo (K, 2) float32 con los vértices conservados.
+
+    Ejemplo:
+        simplificada = simplificar_polilinea(decode(puntos), 0.02)
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if coords.shape[0] <= 2:
+        return coords.astype(np.float32)
+    planas = proyectar_coordenadas(coords, coords[:, 0].mean())
+    conservar = np.zeros(coords.shape[0], dtype=bool)
+    conservar[[0, -1]] = True
+    pendientes = [(0, coords.shape[0] - 1)]
+    while pendientes:
+        inicio, fin = pendientes.pop()
+        if fin - inicio < 2:
+            continue
+        interiores = planas[inicio + 1:fin]
+        distancias = _distancia_a_segmento(
+            interiores, planas[inicio], planas[fin])
+        indice = int(np.argmax(distancias))
+        if distancias[indice] > tolerancia_km:
+            indice += inicio + 1
+            conservar[indice] = True
+            pendientes.append((inicio, indice))
+            pendientes.append((indice, fin))
+    return coords[conservar].astype(np.float32)
+
+
+def _distancia_a_segmento(puntos, inicio, fin):
+    """
+    Calcula la distancia en el plano de cada punto al segmento inicio-fin.
+    """
+    segmento = fin - inicio
+    longitud = np.dot(segmento, segmento)
+    if longitud == 0:
+        return np.hypot(*(puntos - inicio).T)
+    proy = np.clip(np.dot(puntos - inicio, segmento) / longitud, 0, 1)
+    cercanos = inicio + proy[:, np.newaxis] * segmento
+    return np.hypot(*(puntos - cercanos).T)
+
+
+def obtener_polilinea_simplificada(directions_result, tolerancia_km=0.01):
+    """
+    Obtiene la polilínea completa de una ruta simplificada como arreglo.
+
+    Args:
+        directions_result (list): Respuesta de la API de Directions.
+        tolerancia_km (float, opcional): Tolerancia de simplificación.
+
+    Returns:
+        np.ndarray: Arreglo (K, 2) float32 con los vértices de la ruta.
+    """
+    coords = obtener_coordenadas_polilinea(directions_result)
+    if not coords:
+        return np.empty((0, 2), dtype=np.float32)
+    return simplificar_polilinea(coords, tolerancia_km)
+
+
+def distancia_minima_segmentos(origenes, polilinea, max_elementos=1000000):
+    """
+    Calcula la distancia mínima de cada origen a los segmentos de una
+        polilínea.
+
+    A diferencia de distancia_minima_polilinea, mide la distancia a los
+    tramos entre vértices, por lo que da el resultado correcto en tramos
+    largos con pocos vértices y admite polilíneas simplificadas.
+
+    Args:
+        origenes (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        polilinea (array-like): Arreglo (M, 2) de vértices (latitud, longitud).
+        max_elementos (int, opcional): Tamaño máximo de cada bloque N x B.
+
+    Returns:
+        np.ndarray: Arreglo (N,) con la distancia mínima en kilómetros. Es
+            infinito si la polilínea está vacía.
+    """
+    origenes = np.asarray(origenes, dtype=float).reshape(-1, 2)
+    polilinea = np.asarray(polilinea, dtype=float).reshape(-1, 2)
+    distancias = np.full(origenes.shape[0], np.inf)
+    if origenes.shape[0] == 0 or polilinea.shape[0] == 0:
+        return distancias
+    if polilinea.shape[0] == 1:
+        polilinea = np.repeat(polilinea, 2, axis=0)
+    lat_ref = polilinea[:, 0].mean()
+    puntos = proyectar_coordenadas(origenes, lat_ref)[:, np.newaxis, :]
+    vertices = proyectar_coordenadas(polilinea, lat_ref)
+    inicios = vertices[:-1]
+    segmentos = vertices[1:] - inicios
+    longitudes = np.einsum('ij,ij->i', segmentos, segmentos)
+    longitudes[longitudes == 0] = np.inf
+    tamano_bloque = max(1, max_elementos // origenes.shape[0])
+    for inicio in range(0, inicios.shape[0], tamano_bloque):
+        fin = inicio + tamano_bloque
+        relativos = puntos - inicios[inicio:fin]
+        proy = np.clip(
+            np.einsum('nmk,mk->nm', relativos, segmentos[inicio:fin]) /
+            longitudes[inicio:fin], 0, 1)
+        diferencia = relativos - proy[..., np.newaxis] * segmentos[inicio:fin]
+        bloque = np.sqrt(np.einsum('nmk,nmk->nm', diferencia, diferencia))
+        np.minimum(distancias, bloque.min(axis=1), out=distancias)
+    return distancias
+
+
+def filtrar_origenes_por_segmentos(origenes, polilinea, max_distancia_km,
+                                   max_elementos=1000000):
+    """
+    Determina qué orígenes están a menos de `max_distancia_km` de algún
+        segmento de la polilínea.
+
+    Args:
+        origenes (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        polilinea (array-like): Arreglo (M, 2) de vértices (latitud, longitud).
+        max_distancia_km (float): Distancia máxima en kilómetros.
+        max_elementos (int, opcional): Tamaño máximo de cada bloque de cálculo.
+
+    Returns:
+        tuple:
+            np.ndarray: Máscara booleana (N,) de orígenes cercanos.
+            np.ndarray: Distancia mínima (N,) de cada origen en kilómetros.
+    """
+    distancias = distancia_minima_segmentos(origenes, polilinea, max_elementos)
+    return distancias <= max_distancia_km, distancias
+
+
 def distancia_haversine(lat1, lon1, lat2, lon2):
     """
     Calcula la distancia Haversine entre dos puntos geográficos en coordenadas (latitud, longitud).
@@ -140,17 +360,5 @@ def distancia_haversine(lat1, lon1, lat2, lon2):
     Ejemplo:
         distancia = distancia_haversine(40.7128, -74.0060, 34.0522, -118.2437)
     """
-    # Radio de la Tierra en kilómetros
-    RADIO_TIERRA = 6371.0
-
-    lat1_rad = radians(lat1)
-    lon1_rad = radians(lon1)
-    lat2_rad = radians(lat2)
-    lon2_rad = radians(lon2)
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    dis_a = sin(dlat / 2)**2 + cos(lat1_rad) * \
-        cos(lat2_rad) * sin(dlon / 2)**2
-    dis_c = 2 * atan2(sqrt(dis_a), sqrt(1 - dis_a))
-    distance = RADIO_TIERRA * dis_c
+    distance = float(haversine(lat1, lon1, lat2, lon2))
     return distance
@@ -1,66 +1,199 @@
 import os
+import threading
+import uuid
 import paramiko
 import pandas as pd
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from apps.ruteo.consultas import RegistroConsultas
+from apps.ruteo.decoradores import cronometro, contar
 from apps.ruteo.constantes import (SSH_HOST, SSH_USERNAME, SSH_KEY_PATH,
                         DB_NAME, DB_USER, DB_PASSWORD, DB_HOST,
-                        DB_PORT, DB_SCHEMA, DEBUG, PROD_DATA, ABSOLUTE_PATH)
+                        DB_PORT, DB_SCHEMA, DEBUG, PROD_DATA, ABSOLUTE_PATH,
+                        DB_POOL_MIN, DB_POOL_MAX, SSH_KEEPALIVE)
 
+# Las consultas SQL se cargan y validan una sola vez al importar el módulo
+registro_consultas = RegistroConsultas(ABSOLUTE_PATH)
 
-def obtener_servicios(fecha_inicio, fecha_final=None, tipo_prod_list=[14]):
+
+def obtener_servicios(fecha_inicio, fecha_final=None, tipo_prod_list=[14],
+                      ciudad_origen=None, ciudad_destino=None,
+                      regional_origen=None, regional_destino=None,
+                      detalle_servicio=None):
     """
     Obtiene datos de servicios en un rango de fechas desde la base de datos.
 
+    Los filtros opcionales se aplican en la consulta SQL, de modo que solo se
+    descargan (y luego se enrutan) los servicios relevantes.
+
     Args:
         fecha_inicio (str): Fecha de inicio en formato 'YYYY-MM-DD'.
         fecha_final (str, opcional): Fecha final en formato 'YYYY-MM-DD'.
             Si no se proporciona, se asume la fecha de inicio.
+        tipo_prod_list (list, opcional): Tipos de procedimiento a consultar.
+        ciudad_origen (int, opcional): Id de la ciudad de origen.
+        ciudad_destino (int, opcional): Id de la ciudad de destino.
+        regional_origen (int, opcional): Id del departamento de origen.
+        regional_destino (int, opcional): Id del departamento de destino.
+        detalle_servicio (int, opcional): 0 para solo 'ida', 1 para solo
+            'retorno'.
 
     Returns:
         pd.DataFrame: DataFrame que contiene los resultados de la consulta.
     """
-    tipo_prod_list = [str(tipo_prod) for tipo_prod in tipo_prod_list]
-    tipo_prod = ",".join(tipo_prod_list)
     conn = Connection(PROD_DATA)
+    try:
+        df_data = conn.execute_query(*parametros_servicios(
+            fecha_inicio, fecha_final, tipo_prod_list, ciudad_origen,
+            ciudad_destino, regional_origen, regional_destino,
+            detalle_servicio))
+    finally:
+        conn.close()
+    return df_data
+
+
+def obtener_servicios_por_dia(fecha_inicio, fecha_final=None,
+                              tipo_prod_list=[14], ciudad_origen=None,
+                              ciudad_destino=None, regional_origen=None,
+                              regional_destino=None, detalle_servicio=None,
+                              tamano_bloque=5000):
+    """
+    Obtiene los servicios de un rango de fechas día por día, a medida que
+        llegan de la base de datos.
+
+    Recibe los mismos filtros que obtener_servicios. Cada día se entrega
+    en cuanto termina de llegar, de modo que se puede procesar mientras se
+    descargan los siguientes.
+
+    Args:
+        tamano_bloque (int): Filas pedidas al servidor en cada viaje.
+
+    Yields:
+        tuple: Fecha de servicio (str) y DataFrame con los servicios de ese día.
+    """
+    conn = Connection(PROD_DATA)
+    try:
+        for df_dia in conn.stream_query(
+                *parametros_servicios(
+                    fecha_inicio, fecha_final, tipo_prod_list, ciudad_origen,
+                    ciudad_destino, regional_origen, regional_destino,
+                    detalle_servicio),
+                tamano_bloque=tamano_bloque, columna_grupo='FECHA_SERVICIO'):
+            yield df_dia['FECHA_SERVICIO'].iat[0], df_dia
+    finally:
+        conn.close()
+
+
+def parametros_servicios(fecha_inicio, fecha_final, tipo_prod_list,
+                         ciudad_origen, ciudad_destino, regional_origen,
+                         regional_destino, detalle_servicio):
+    """
+    Arma el nombre del archivo y los datos de la consulta de servicios.
+
+    Returns:
+        tuple: Nombre de la consulta y diccionario con sus parámetros.
+    """
     QUERY_FILE = 'obtain_services'
     QUERY_FILE = QUERY_FILE if not DEBUG else QUERY_FILE + '_test'
     if not fecha_final:
         fecha_final = fecha_inicio
-    df_data = conn.execute_query(
-        QUERY_FILE, [fecha_inicio, fecha_final, tipo_prod])
-    conn.close()
+    return QUERY_FILE, {
+        'fecha_inicio': fecha_inicio,
+        'fecha_final': fecha_final,
+        'tipo_prod_list': [int(tipo_prod) for tipo_prod in tipo_prod_list],
+        'ciudad_origen': entero_opcional(ciudad_origen),
+        'ciudad_destino': entero_opcional(ciudad_destino),
+        'regional_origen': entero_opcional(regional_origen),
+        'regional_destino': entero_opcional(regional_destino),
+        'detalle': None if detalle_servicio is None else detalle_servicio == 0
+    }
+
+
+def entero_opcional(valor):
+    """
+    Convierte un filtro opcional a entero.
+
+    Args:
+        valor (int, str or None): Identificador por el que se filtra.
+
+    Returns:
+        int or None: El identificador como entero, o None si no hay filtro.
+    """
+    return None if valor is None else int(valor)
+
+
+COLUMNAS_COORDENADAS = ['LATITUD_ORIGEN', 'LONGITUD_ORIGEN',
+                        'LATITUD_DESTINO', 'LONGITUD_DESTINO']
+# Textos con pocos valores distintos por día
+COLUMNAS_CATEGORICAS = ['CIUDAD_ORIGEN', 'CIUDAD_DESTINO', 'LOCALIDAD_ORIGEN',
+                        'LOCALIDAD_DESTINO', 'UPZ_ORIGEN', 'UPZ_DESTINO',
+                        'DETALLE_SERVICIO']
+# Identificadores enteros
+COLUMNAS_ENTERAS = ['ESTADO_SERVICIO', 'SERVICIO_ID', 'CLIENTE_ID',
+                    'CRITICIDAD', 'MEDIO_DE_APOYO', 'REGIONAL_ID_ORIGEN',
+                    'CIUDAD_ID_ORIGEN', 'REGIONAL_ID_DESTINO',
+                    'CIUDAD_ID_DESTINO', 'TIPO_RUTA']
+
+
+def tipar_columnas(df_data):
+    """
+    Asigna tipos compactos a las columnas de una consulta de servicios.
+
+    Las coordenadas pasan a float (los valores vacíos o inválidos quedan
+    como NaN), los textos de COLUMNAS_CATEGORICAS a categorías y los
+    identificadores de COLUMNAS_ENTERAS al entero más pequeño que los
+    contiene, si no tienen nulos.
+
+    Args:
+        df_data (pd.DataFrame): Resultado de una consulta de servicios.
+
+    Returns:
+        pd.DataFrame: El mismo DataFrame con las columnas tipadas.
+    """
+    for columna in COLUMNAS_COORDENADAS:
+        if columna in df_data.columns:
+            df_data[columna] = pd.to_numeric(
+                df_data[columna], errors='coerce').astype(float, copy=False)
+    for columna in COLUMNAS_CATEGORICAS:
+        if columna in df_data.columns:
+            df_data[columna] = df_data[columna].astype('category')
+    for columna in COLUMNAS_ENTERAS:
+        if columna in df_data.columns and \
+                pd.api.types.is_integer_dtype(df_data[columna]):
+            df_data[columna] = pd.to_numeric(
+                df_data[columna], downcast='integer')
     return df_data
 
 
-class Connection:
+class GestorConexiones:
     """
-    Clase para manejar la conexión a bases de datos PostgreSQL.
-    
+    Administra un túnel SSH y un pool de conexiones PostgreSQL compartidos
+        por todo el proceso.
+
+    El túnel se abre una sola vez con keepalive y se vuelve a abrir, junto
+    con el pool, si se detecta caído. Las conexiones se prestan con
+    `obtener` y se devuelven con `devolver`; si todas están en uso, la
+    solicitud espera a que se libere una.
+
     Args:
         ssh_connection (bool): Indica si se debe establecer una conexión SSH
             antes de la conexión a la base de datos.
+        minconn (int): Conexiones que se mantienen abiertas en el pool.
+        maxconn (int): Conexiones simultáneas máximas.
 
     Attributes:
-        conn (psycopg2.extensions.connection): Conexión a la base de datos PostgreSQL.
-        ssh (bool): Indica si se ha establecido una conexión SSH.
+        pool (ThreadedConnectionPool): Pool de conexiones PostgreSQL.
+        ssh_client (paramiko.SSHClient): Cliente del túnel SSH, si aplica.
     """
-    def __init__(self, ssh_connection=False):
-        """
-        Inicializa una instancia de la clase Connection.
-
-        Args:
-            ssh_connection (bool): Indica si se debe establecer
-                una conexión SSH antes de la conexión a la base de datos.
-        """
-        conn_port = self.ssh_connection(DB_PORT) if ssh_connection else DB_PORT
-        self.conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=conn_port
-        )
+    def __init__(self, ssh_connection=False, minconn=DB_POOL_MIN,
+                 maxconn=DB_POOL_MAX):
         self.ssh = ssh_connection
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.pool = None
+        self.ssh_client = None
+        self._lock = threading.Lock()
+        self._disponibles = threading.BoundedSemaphore(maxconn)
 
     def ssh_connection(self, pg_port=5432):
         """
@@ -90,49 +223,265 @@ class Connection:
             username=ssh_username,
             pkey=ssh_private_key)
         transport = self.ssh_client.get_transport()
+        transport.set_keepalive(SSH_KEEPALIVE)
         local_port = transport.request_port_forward("", pg_port)
         return local_port
 
+    def tunel_activo(self):
+        """
+        Indica si el túnel SSH sigue abierto.
+
+        Returns:
+            bool: True si el túnel está activo o no se usa SSH.
+        """
+        if not self.ssh:
+            return True
+        if self.ssh_client is None:
+            return False
+        transport = self.ssh_client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _asegurar_pool(self):
+        """
+        Crea el pool (y el túnel) si no existe o si el túnel se cayó.
+        """
+        with self._lock:
+            if self.pool is not None and not self.pool.closed and \
+                    self.tunel_activo():
+                return
+            self._cerrar()
+            conn_port = self.ssh_connection(DB_PORT) if self.ssh else DB_PORT
+            self.pool = ThreadedConnectionPool(
+                self.minconn, self.maxconn,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                host=DB_HOST,
+                port=conn_port,
+                options=f"-c search_path={DB_SCHEMA}"
+            )
+
+    def obtener(self):
+        """
+        Presta una conexión del pool, esperando si todas están en uso.
+
+        Returns:
+            psycopg2.extensions.connection: Conexión abierta.
+        """
+        self._disponibles.acquire()
+        try:
+            self._asegurar_pool()
+            conn = self.pool.getconn()
+            if conn.closed:
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        except Exception:
+            self._disponibles.release()
+            raise
+        return conn
+
+    def devolver(self, conn):
+        """
+        Devuelve una conexión al pool, descartándola si quedó inutilizable.
+
+        Args:
+            conn (psycopg2.extensions.connection): Conexión prestada.
+        """
+        try:
+            pool = self.pool
+            if pool is None or pool.closed:
+                conn.close()
+                return
+            cerrar = bool(conn.closed)
+            if not cerrar:
+                try:
+                    # Descartar la transacción abierta por la consulta
+                    conn.rollback()
+                except psycopg2.Error:
+                    cerrar = True
+            try:
+                pool.putconn(conn, close=cerrar)
+            except psycopg2.pool.PoolError:
+                # La conexión pertenece a un pool reemplazado al reconectar
+                conn.close()
+        finally:
+            self._disponibles.release()
+
+    def _cerrar(self):
+        if self.pool is not None and not self.pool.closed:
+            self.pool.closeall()
+        self.pool = None
+        if self.ssh_client is not None:
+            self.ssh_client.close()
+            self.ssh_client = None
+
+    def cerrar(self):
+        """
+        Cierra todas las conexiones del pool y el túnel SSH.
+        """
+        with self._lock:
+            self._cerrar()
+
+
+_gestores = {}
+_gestores_pid = None
+_gestores_lock = threading.Lock()
+
+
+def obtener_gestor(ssh_connection=False):
+    """
+    Retorna el gestor de conexiones compartido del proceso.
+
+    Args:
+        ssh_connection (bool): Indica si las conexiones usan túnel SSH.
+
+    Returns:
+        GestorConexiones: Gestor compartido para ese tipo de conexión.
+    """
+    global _gestores_pid
+    with _gestores_lock:
+        # Las conexiones y el túnel no se comparten entre procesos
+        if _gestores_pid != os.getpid():
+            _gestores.clear()
+            _gestores_pid = os.getpid()
+        if ssh_connection not in _gestores:
+            _gestores[ssh_connection] = GestorConexiones(ssh_connection)
+        return _gestores[ssh_connection]
+
+
+class Connection:
+    """
+    Clase para manejar la conexión a bases de datos PostgreSQL.
+
+    La conexión se toma prestada del pool compartido del proceso
+    (ver GestorConexiones) y se devuelve al llamar `close`.
+    
+    Args:
+        ssh_connection (bool): Indica si se debe establecer una conexión SSH
+            antes de la conexión a la base de datos.
+
+    Attributes:
+        conn (psycopg2.extensions.connection): Conexión a la base de datos PostgreSQL.
+        ssh (bool): Indica si se ha establecido una conexión SSH.
+    """
+    def __init__(self, ssh_connection=False):
+        """
+        Inicializa una instancia de la clase Connection.
+
+        Args:
+            ssh_connection (bool): Indica si se debe establecer
+                una conexión SSH antes de la conexión a la base de datos.
+        """
+        self.gestor = obtener_gestor(ssh_connection)
+        self.conn = self.gestor.obtener()
+        self.ssh = ssh_connection
+
     def execute_query(self, filename, data=None):
         """
-        Ejecuta una consulta SQL desde un archivo y devuelve
+        Ejecuta una consulta SQL registrada y devuelve
             los resultados como un DataFrame.
 
+        Los valores se envían enlazados como parámetros de la consulta.
+
         Args:
             filename (str): Nombre del archivo de consulta SQL
                 (sin extensión).
-            data (list): Lista de datos para formatear la
-                consulta SQL.
+            data (dict): Valores de los parámetros de la consulta
+                por nombre.
 
         Returns:
             pd.DataFrame: DataFrame que contiene los resultados
                 de la consulta.
         """
-        with self.conn.cursor() as cursor:
-            cursor.execute(f"SET search_path TO {DB_SCHEMA}")
-            # Leer el archivo de consulta SQL
-            file_route = os.path.join(ABSOLUTE_PATH, f"{filename}.sql")
-            with open(file_route, 'r', encoding='utf-8') as sql_file:
-                query = sql_file.read()
-            # Formatear la consulta con la fecha de servicio
-            if data:
-                query = query.format(*data)
+        with self.conn.cursor() as cursor, cronometro('consulta_bd'):
             # Ejecutar la consulta
-            cursor.execute(query)
+            registro_consultas.ejecutar(cursor, filename, data or {})
             # Obtener los resultados de la consulta
             results = cursor.fetchall()
+            contar('ruteo_filas_total', len(results), etapa='consulta_bd')
             # Convertir los resultados a un DataFrame
             columns = [desc[0] for desc in cursor.description]
             df_data = pd.DataFrame(results, columns=columns)
             df_data.columns = [col.upper() for col in df_data.columns]
         return df_data
+
+    def stream_query(self, filename, data=None, tamano_bloque=5000,
+                     columna_grupo=None):
+        """
+        Ejecuta una consulta SQL con un cursor del lado del servidor y
+            entrega los resultados por bloques.
+
+        A diferencia de execute_query, las filas no se cargan todas en
+        memoria: cada bloque se convierte en un DataFrame tan pronto llega,
+        con las columnas de coordenadas ya convertidas a float.
+
+        Args:
+            filename (str): Nombre del archivo de consulta SQL
+                (sin extensión).
+            data (dict): Valores de los parámetros de la consulta
+                por nombre.
+            tamano_bloque (int): Número de filas pedidas al servidor
+                en cada viaje.
+            columna_grupo (str, opcional): Si se indica, cada bloque
+                entregado contiene exactamente las filas de un valor de esa
+                columna. La consulta debe estar ordenada por ella.
+
+        Yields:
+            pd.DataFrame: Bloque de resultados con columnas en mayúscula.
+
+        Example:
+            for df_dia in conn.stream_query('obtain_services', datos,
+                                            columna_grupo='FECHA_SERVICIO'):
+                procesar(df_dia)
+        """
+        cursor = self.conn.cursor(name=f"ruteo_{uuid.uuid4().hex}")
+        cursor.itersize = tamano_bloque
+        try:
+            with cronometro('consulta_bd'):
+                registro_consultas.ejecutar(cursor, filename, data or {})
+            columns = None
+            indice_grupo = None
+            pendientes = []
+            while True:
+                with cronometro('consulta_bd'):
+                    filas = cursor.fetchmany(tamano_bloque)
+                contar('ruteo_filas_total', len(filas), etapa='consulta_bd')
+                if columns is None and cursor.description:
+                    columns = [desc[0].upper() for desc in cursor.description]
+                    if columna_grupo:
+                        indice_grupo = columns.index(columna_grupo.upper())
+                if not filas:
+                    break
+                if indice_grupo is None:
+                    yield tipar_columnas(pd.DataFrame(filas, columns=columns))
+                    continue
+                pendientes.extend(filas)
+                # Entregar los grupos completos; el último puede continuar
+                # en el siguiente bloque
+                ultimo = pendientes[-1][indice_grupo]
+                inicio = 0
+                for fin in range(1, len(pendientes)):
+                    valor = pendientes[fin][indice_grupo]
+                    if valor != pendientes[fin - 1][indice_grupo]:
+                        yield tipar_columnas(pd.DataFrame(
+                            pendientes[inicio:fin], columns=columns))
+                        inicio = fin
+                    if valor == ultimo:
+                        break
+                pendientes = pendientes[inicio:]
+            if pendientes:
+                yield tipar_columnas(pd.DataFrame(pendientes, columns=columns))
+        finally:
+            cursor.close()
+
     def close(self):
         """
-        Cierra la conexión SSH y la conexión a la base de datos PostgreSQL.
+        Devuelve la conexión al pool compartido. El túnel SSH y el pool
+            permanecen abiertos para las siguientes consultas.
         """
-        if self.ssh:
-            self.ssh_client.close()
-        self.conn.close()
+        if self.conn is not None:
+            self.gestor.devolver(self.conn)
+            self.conn = None
 
 
 if __name__ == '__main__':
@@ -14,3 +14,66 @@ SSH_HOST = config('SSH_HOST')
 SSH_USERNAME = config('SSH_USERNAME')
 SSH_KEY_PATH = config('SSH_KEY_PATH')
 ABSOLUTE_PATH = config('ABSOLUTE_PATH')
+# Cache persistente de respuestas de rutas
+CACHE_ACTIVA = config('CACHE_ACTIVA', default=True, cast=bool)
+CACHE_PATH = config(
+    'CACHE_PATH', default=ABSOLUTE_PATH + '/cache_rutas.sqlite3')
+CACHE_TTL_HORAS = config('CACHE_TTL_HORAS', default=24 * 30, cast=int)
+CACHE_MAX_ENTRADAS = config('CACHE_MAX_ENTRADAS', default=50000, cast=int)
+CACHE_PRECISION = config('CACHE_PRECISION', default=5, cast=int)
+CACHE_MINUTOS_FRANJA = config('CACHE_MINUTOS_FRANJA', default=15, cast=int)
+# Concurrencia de las solicitudes a la API de rutas
+RUTAS_MAX_HILOS = config('RUTAS_MAX_HILOS', default=8, cast=int)
+# Duración máxima en minutos para validar una ruta
+MAX_DURATION = config('MAX_DURATION', default=60, cast=int)
+# Número de procesos para calcular los días de servicio en paralelo
+RUTAS_PROCESOS = config('RUTAS_PROCESOS', default=1, cast=int)
+# Número de grupos de ruta inicial calculados en paralelo por día
+RUTAS_HILOS_GRUPOS = config('RUTAS_HILOS_GRUPOS', default=1, cast=int)
+# Pool de conexiones a la base de datos y túnel SSH
+DB_POOL_MIN = config('DB_POOL_MIN', default=1, cast=int)
+DB_POOL_MAX = config('DB_POOL_MAX', default=5, cast=int)
+SSH_KEEPALIVE = config('SSH_KEEPALIVE', default=30, cast=int)
+# Proveedor de rutas: 'google', 'local' (extracto OSM) o 'linea_recta'
+RUTAS_PROVEEDOR = config('RUTAS_PROVEEDOR', default='google')
+OSM_PATH = config('OSM_PATH', default=ABSOLUTE_PATH + '/mapa.osm')
+VEL_LINEA_RECTA = config('VEL_LINEA_RECTA', default=30, cast=float)
+FACTOR_CIRCUITO = config('FACTOR_CIRCUITO', default=1.3, cast=float)
+# Costo en USD por solicitud a la API de Directions (básica y avanzada:
+# con tráfico o más de 10 waypoints)
+COSTO_DIRECTIONS = config('COSTO_DIRECTIONS', default=0.005, cast=float)
+COSTO_DIRECTIONS_AVANZADO = config(
+    'COSTO_DIRECTIONS_AVANZADO', default=0.01, cast=float)
+# Costo en USD por elemento de la API de Distance Matrix
+COSTO_MATRIZ_ELEMENTO = config('COSTO_MATRIZ_ELEMENTO', default=0.005, cast=float)
+COSTO_MATRIZ_ELEMENTO_AVANZADO = config(
+    'COSTO_MATRIZ_ELEMENTO_AVANZADO', default=0.01, cast=float)
+# Ordenar los waypoints localmente con la matriz de tiempos en lugar de
+# optimize_waypoints de la API de Directions, solo cuando la matriz no
+# genera solicitudes pagas (proveedores locales o pares ya en el cache)
+RUTAS_ORDEN_LOCAL = config('RUTAS_ORDEN_LOCAL', default=True, cast=bool)
+# Motor de agrupación de rutas finales: 'directions', 'matriz' o 'vrp'
+RUTAS_MOTOR = config('RUTAS_MOTOR', default='directions')
+# Modelo de tiempos de viaje aprendido del cache de rutas
+MODELO_TIEMPO_PATH = config(
+    'MODELO_TIEMPO_PATH', default=ABSOLUTE_PATH + '/modelo_tiempo.sqlite3')
+MODELO_TIEMPO_PRECISION = config('MODELO_TIEMPO_PRECISION', default=5, cast=int)
+MODELO_TIEMPO_MIN_MUESTRAS = config(
+    'MODELO_TIEMPO_MIN_MUESTRAS', default=5, cast=int)
+# Estado de los días ya ruteados para el recálculo incremental
+ESTADO_RUTAS_PATH = config(
+    'ESTADO_RUTAS_PATH', default=ABSOLUTE_PATH + '/estado_rutas.sqlite3')
+# Plantillas de rutas finales de grupos recurrentes entre días: Jaccard
+# mínimo de pasajeros, franja horaria en minutos y precisión del destino
+RUTAS_PLANTILLAS = config('RUTAS_PLANTILLAS', default=False, cast=bool)
+PLANTILLAS_PATH = config(
+    'PLANTILLAS_PATH', default=ABSOLUTE_PATH + '/plantillas_rutas.sqlite3')
+PLANTILLAS_JACCARD = config('PLANTILLAS_JACCARD', default=0.8, cast=float)
+PLANTILLAS_MINUTOS_FRANJA = config(
+    'PLANTILLAS_MINUTOS_FRANJA', default=30, cast=int)
+PLANTILLAS_PRECISION = config('PLANTILLAS_PRECISION', default=7, cast=int)
+# Solucionador de rutas (motor 'vrp'): pasajeros por vehículo, espera máxima
+# en el destino en minutos y costo fijo de cada vehículo en segundos
+VRP_CAPACIDAD = config('VRP_CAPACIDAD', default=4, cast=int)
+VRP_ESPERA_MAX = config('VRP_ESPERA_MAX', default=30, cast=int)
+VRP_COSTO_VEHICULO = config('VRP_COSTO_VEHICULO', default=900, cast=float)
@@ -0,0 +1,114 @@
+"""
+    consultas.py
+"""
+import os
+import re
+
+PARAMETRO = re.compile(r"%\((\w+)\)s")
+
+# Consultas disponibles y sus parámetros
+PARAMETROS_SERVICIOS = [
+    'fecha_inicio',
+    'fecha_final',
+    'tipo_prod_list',
+    'ciudad_origen',
+    'ciudad_destino',
+    'regional_origen',
+    'regional_destino',
+    'detalle',
+]
+CONSULTAS = {
+    'obtain_services': PARAMETROS_SERVICIOS,
+    'obtain_services_test': PARAMETROS_SERVICIOS,
+}
+
+
+class Consulta:
+    """
+    Consulta SQL cargada desde un archivo, con parámetros enlazados.
+
+    Args:
+        nombre (str): Nombre del archivo SQL (sin extensión).
+        sql (str): Texto de la consulta con parámetros %(nombre)s.
+        parametros (list of str): Nombres de los parámetros.
+    """
+    def __init__(self, nombre, sql, parametros):
+        self.nombre = nombre
+        self.sql = sql
+        self.parametros = parametros
+
+    def valores(self, datos):
+        """
+        Selecciona los valores de los parámetros de la consulta.
+
+        Args:
+            datos (dict): Valores por nombre de parámetro.
+
+        Returns:
+            dict: Valores de los parámetros declarados.
+
+        Raises:
+            ValueError: Si falta algún parámetro.
+        """
+        faltantes = set(self.parametros) - set(datos)
+        if faltantes:
+            raise ValueError(
+                f"Faltan parámetros para la consulta {self.nombre}: "
+                f"{sorted(faltantes)}")
+        return {nombre: datos[nombre] for nombre in self.parametros}
+
+
+class RegistroConsultas:
+    """
+    Carga y valida una sola vez los archivos SQL del módulo y ejecuta las
+        consultas con parámetros enlazados.
+
+    No se usan sentencias preparadas (PREPARE/EXECUTE): la consulta de
+    servicios se lee con un cursor del lado del servidor (DECLARE), que
+    solo admite SELECT, de modo que el plan no se podría reutilizar allí.
+
+    Args:
+        ruta (str): Directorio que contiene los archivos SQL.
+        consultas (dict): Parámetros declarados por nombre de consulta.
+    """
+    def __init__(self, ruta, consultas=CONSULTAS):
+        self.consultas = {}
+        for nombre, parametros in consultas.items():
+            file_route = os.path.join(ruta, f"{nombre}.sql")
+            with open(file_route, 'r', encoding='utf-8') as sql_file:
+                sql = sql_file.read()
+            usados = set(PARAMETRO.findall(sql))
+            declarados = set(parametros)
+            if usados != declarados:
+                raise ValueError(
+                    f"Los parámetros de {file_route} {sorted(usados)} no "
+                    f"coinciden con los declarados {sorted(declarados)}")
+            self.consultas[nombre] = Consulta(nombre, sql, parametros)
+
+    def obtener(self, nombre):
+        """
+        Retorna una consulta registrada.
+
+        Args:
+            nombre (str): Nombre del archivo SQL (sin extensión).
+
+        Returns:
+            Consulta: Consulta cargada.
+        """
+        try:
+            return self.consultas[nombre]
+        except KeyError:
+            raise ValueError(f"Consulta no registrada: {nombre}") from None
+
+    def ejecutar(self, cursor, nombre, datos):
+        """
+        Ejecuta una consulta registrada en un cursor.
+
+        Args:
+            cursor (psycopg2.extensions.cursor): Cursor donde se ejecuta,
+                normal o del lado del servidor.
+            nombre (str): Nombre de la consulta.
+            datos (dict): Valores de los parámetros por nombre.
+        """
+        consulta = self.obtener(nombre)
+        cursor.execute(consulta.sql, consulta.valores(datos))
@@ -1,8 +1,397 @@
+"""
+    decoradores.py
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Límites superiores en segundos de los buckets de latencia
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0, 30.0)
+
+_ejecucion = contextvars.ContextVar('ruteo_ejecucion', default=None)
+
+
+def _clave(nombre, etiquetas):
+    return nombre, tuple(sorted(etiquetas.items()))
+
+
+class Histograma:
+    """
+    Histograma acumulado de valores con buckets fijos, al estilo Prometheus.
+
+    Args:
+        buckets (tuple of float): Límites superiores de los buckets.
+    """
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = tuple(buckets)
+        self.conteos = [0] * (len(self.buckets) + 1)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.conteos[bisect.bisect_left(self.buckets, valor)] += 1
+        self.suma += valor
+        self.total += 1
+
+    def combinar(self, otro):
+        for indice, conteo in enumerate(otro.conteos):
+            self.conteos[indice] += conteo
+        self.suma += otro.suma
+        self.total += otro.total
+
+    def percentil(self, fraccion):
+        """
+        Estima un percentil como el límite del bucket que lo contiene.
+
+        Args:
+            fraccion (float): Percentil entre 0 y 1.
+
+        Returns:
+            float or None: Límite superior del bucket, infinito si cae en
+                el último o None si no hay observaciones.
+        """
+        if not self.total:
+            return None
+        objetivo = fraccion * self.total
+        acumulado = 0
+        for limite, conteo in zip(self.buckets + (float('inf'),),
+                                  self.conteos):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                return limite
+        return float('inf')
+
+    def resumen(self):
+        return {
+            'total': self.total,
+            'suma': round(self.suma, 6),
+            'promedio': round(self.suma / self.total, 6) if self.total
+            else None,
+            'p50': self.percentil(0.5),
+            'p95': self.percentil(0.95),
+        }
+
+
+class Metricas:
+    """
+    Contadores e histogramas con etiquetas. La sincronización entre hilos
+    la hace RegistroMetricas.
+
+    Attributes:
+        contadores (dict): Valor por (nombre, etiquetas).
+        histogramas (dict): Histograma por (nombre, etiquetas).
+    """
+    def __init__(self):
+        self.contadores = {}
+        self.histogramas = {}
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        clave = _clave(nombre, etiquetas)
+        self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, buckets=BUCKETS_LATENCIA, **etiquetas):
+        clave = _clave(nombre, etiquetas)
+        if clave not in self.histogramas:
+            self.histogramas[clave] = Histograma(buckets)
+        self.histogramas[clave].observar(valor)
+
+    def combinar(self, otras):
+        for clave, valor in otras.contadores.items():
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+        for clave, histograma in otras.histogramas.items():
+            if clave not in self.histogramas:
+                self.histogramas[clave] = Histograma(histograma.buckets)
+            self.histogramas[clave].combinar(histograma)
+
+
+class RegistroMetricas:
+    """
+    Registro de métricas del proceso y de cada ejecución de ruteo.
+
+    Las métricas globales acumulan todo lo ocurrido en el proceso y se
+    exportan en formato de texto de Prometheus; además, cada valor se
+    suma a las métricas de la ejecución activa (ver `ejecucion`), que
+    forman el reporte por corrida.
+
+    Args:
+        max_ejecuciones (int): Número de reportes de ejecución conservados.
+    """
+    def __init__(self, max_ejecuciones=100):
+        self.max_ejecuciones = max_ejecuciones
+        self.globales = Metricas()
+        self.ejecuciones = {}
+        self._inicios = {}
+        self._lock = threading.Lock()
+
+    def _destinos(self):
+        destinos = [self.globales]
+        id_ejecucion = _ejecucion.get()
+        if id_ejecucion in self.ejecuciones:
+            destinos.append(self.ejecuciones[id_ejecucion])
+        return destinos
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        with self._lock:
+            for metricas in self._destinos():
+                metricas.incrementar(nombre, valor, **etiquetas)
+
+    def observar(self, nombre, valor, buckets=BUCKETS_LATENCIA, **etiquetas):
+        with self._lock:
+            for metricas in self._destinos():
+                metricas.observar(nombre, valor, buckets, **etiquetas)
+
+    def iniciar(self, id_ejecucion):
+        with self._lock:
+            if id_ejecucion not in self.ejecuciones:
+                self.ejecuciones[id_ejecucion] = Metricas()
+                self._inicios[id_ejecucion] = time.time()
+            while len(self.ejecuciones) > self.max_ejecuciones:
+                antigua = next(iter(self.ejecuciones))
+                del self.ejecuciones[antigua]
+                del self._inicios[antigua]
+
+    def combinar(self, id_ejecucion, metricas):
+        """
+        Suma a una ejecución (y a las globales) métricas recolectadas en
+            otro proceso.
+
+        Args:
+            id_ejecucion (str): Identificador de la ejecución.
+            metricas (Metricas): Métricas del otro proceso.
+        """
+        self.iniciar(id_ejecucion)
+        with self._lock:
+            self.globales.combinar(metricas)
+            self.ejecuciones[id_ejecucion].combinar(metricas)
+
+    def metricas_ejecucion(self, id_ejecucion):
+        with self._lock:
+            return self.ejecuciones.get(id_ejecucion)
+
+    def reporte(self, id_ejecucion):
+        """
+        Arma el reporte estructurado de una ejecución.
+
+        Args:
+            id_ejecucion (str): Identificador de la ejecución.
+
+        Returns:
+            dict or None: Reporte con las llaves ejecucion, inicio, etapas
+                (llamadas y segundos por etapa), latencias (resumen de cada
+                histograma) y contadores, o None si la ejecución no existe.
+        """
+        with self._lock:
+            metricas = self.ejecuciones.get(id_ejecucion)
+            if metricas is None:
+                return None
+            etapas, latencias, contadores = {}, {}, {}
+            for (nombre, etiquetas), histograma in metricas.histogramas.items():
+                etiquetas = dict(etiquetas)
+                if nombre == 'ruteo_etapa_segundos':
+                    etapas[etiquetas['etapa']] = {
+                        'llamadas': histograma.total,
+                        'segundos': round(histograma.suma, 6)}
+                else:
+                    sufijo = ','.join(f"{k}={v}" for k, v in etiquetas.items())
+                    latencias[f"{nombre}{{{sufijo}}}" if sufijo else nombre] = \
+                        histograma.resumen()
+            for (nombre, etiquetas), valor in metricas.contadores.items():
+                sufijo = ','.join(f"{k}={v}" for k, v in etiquetas)
+                contadores[f"{nombre}{{{sufijo}}}" if sufijo else nombre] = \
+                    round(valor, 6)
+            return {
+                'ejecucion': id_ejecucion,
+                'inicio': self._inicios[id_ejecucion],
+                'etapas': etapas,
+                'latencias': latencias,
+                'contadores': contadores,
+            }
+
+    def prometheus(self):
+        """
+        Exporta las métricas globales en formato de texto de Prometheus.
+
+        Returns:
+            str: Métricas en formato de exposición de texto 0.0.4.
+        """
+        def _etiquetas(etiquetas, extra=()):
+            pares = list(etiquetas) + list(extra)
+            if not pares:
+                return ''
+            return '{' + ','.join(
+                f'{k}="{str(v)}"' for k, v in pares) + '}'
+
+        lineas = []
+        with self._lock:
+            contadores = sorted(self.globales.contadores.items())
+            histogramas = sorted(self.globales.histogramas.items(),
+                                 key=lambda item: item[0])
+            tipos = set()
+            for (nombre, etiquetas), valor in contadores:
+                if nombre not in tipos:
+                    lineas.append(f"# TYPE {nombre} counter")
+                    tipos.add(nombre)
+                lineas.append(f"{nombre}{_etiquetas(etiquetas)} {valor}")
+            for (nombre, etiquetas), histograma in histogramas:
+                if nombre not in tipos:
+                    lineas.append(f"# TYPE {nombre} histogram")
+                    tipos.add(nombre)
+                acumulado = 0
+                for limite, conteo in zip(
+                        histograma.buckets + ('+Inf',), histograma.conteos):
+                    acumulado += conteo
+                    lineas.append(
+                        f"{nombre}_bucket"
+                        f"{_etiquetas(etiquetas, [('le', limite)])} "
+                        f"{acumulado}")
+                lineas.append(
+                    f"{nombre}_sum{_etiquetas(etiquetas)} {histograma.suma}")
+                lineas.append(
+                    f"{nombre}_count{_etiquetas(etiquetas)} {histograma.total}")
+        return '\n'.join(lineas) + '\n'
+
+
+registro_metricas = RegistroMetricas()
+
+
+def ejecucion_actual():
+    """
+    Retorna el identificador de la ejecución activa o None.
+    """
+    return _ejecucion.get()
+
+
+@contextmanager
+def ejecucion(id_ejecucion=None):
+    """
+    Marca las métricas registradas dentro del bloque con un id de ejecución.
+
+    Args:
+        id_ejecucion (str, opcional): Identificador; por defecto se genera
+            uno nuevo.
+
+    Yields:
+        str: Identificador de la ejecución.
+
+    Example:
+        with ejecucion() as id_ejecucion:
+            servicios_completos('2023-04-05', '2023-04-06')
+        print(registro_metricas.reporte(id_ejecucion))
+    """
+    id_ejecucion = id_ejecucion or uuid.uuid4().hex
+    registro_metricas.iniciar(id_ejecucion)
+    token = _ejecucion.set(id_ejecucion)
+    try:
+        yield id_ejecucion
+    finally:
+        _ejecucion.reset(token)
+
+
+def en_contexto(func):
+    """
+    Envuelve una función para que se ejecute con el contexto actual (y por
+        lo tanto con la ejecución activa) al pasarla a un pool de hilos.
+
+    Args:
+        func (function): Función a envolver.
+
+    Returns:
+        function: Función que corre dentro de una copia del contexto.
+    """
+    contexto = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return contexto.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def contar(nombre, valor=1, **etiquetas):
+    """
+    Suma un valor a un contador global y de la ejecución activa.
+
+    Args:
+        nombre (str): Nombre de la métrica.
+        valor (float, opcional): Valor a sumar.
+        **etiquetas: Etiquetas de la métrica.
+    """
+    registro_metricas.incrementar(nombre, valor, **etiquetas)
+
+
+@contextmanager
+def cronometro(etapa):
+    """
+    Mide el tiempo de un bloque como una etapa del ruteo.
+
+    Args:
+        etapa (str): Nombre de la etapa.
+
+    Example:
+        with cronometro('consulta_bd'):
+            filas = cursor.fetchmany(5000)
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registro_metricas.observar(
+            'ruteo_etapa_segundos', time.perf_counter() - inicio, etapa=etapa)
+
+
+def etapa(func):
+    """
+    Decorador que mide cada llamada de una función como una etapa con
+        su mismo nombre.
+
+    Args:
+        func (function): La función a medir.
+
+    Returns:
+        function: Función envoltorio.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with cronometro(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def latencia(func):
+    """
+    Decorador que registra la latencia de cada llamada de una función en
+        el histograma ruteo_latencia_segundos.
+
+    Args:
+        func (function): La función a medir.
+
+    Returns:
+        function: Función envoltorio.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            registro_metricas.observar(
+                'ruteo_latencia_segundos', time.perf_counter() - inicio,
+                funcion=func.__name__)
+    return wrapper
+
+
 def contador(func):
     """
         Decorador que realiza un seguimiento del número de veces
             que se llama una función.
 
+        Además de su diccionario propio, cada llamada suma al contador
+        ruteo_llamadas_total del registro de métricas.
+
         Args:
             func (function): La función a la que se aplicará el contador.
 
@@ -11,7 +400,9 @@ def contador(func):
                 de las llamadas y proporciona un método para obtener los recuentos.
     """
     counts = {}  # Diccionario para almacenar el recuento de cada función
+    lock = threading.Lock()
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
             Función envoltorio que realiza el seguimiento de las
@@ -24,7 +415,9 @@ def contador(func):
             Returns:
                 Any: El resultado de la función original.
         """
-        counts[func.__name__] = counts.get(func.__name__, 0) + 1
+        with lock:
+            counts[func.__name__] = counts.get(func.__name__, 0) + 1
+        contar('ruteo_llamadas_total', funcion=func.__name__)
         result = func(*args, **kwargs)
         return result
 
@@ -36,6 +429,7 @@ def contador(func):
                 dict: Un diccionario que contiene el recuento de
                     llamadas para cada función decorada.
         """
-        return counts
+        with lock:
+            return dict(counts)
     wrapper.get_counts = get_counts
     return wrapper
@@ -0,0 +1,185 @@
+"""
+    estado_rutas.py
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import pandas as pd
+from apps.ruteo.constantes import ESTADO_RUTAS_PATH, RUTAS_PROVEEDOR
+
+# Columnas de un servicio que, si cambian, obligan a recalcular su grupo
+COLUMNAS_DIFERENCIA = [
+    'LATITUD_ORIGEN', 'LONGITUD_ORIGEN', 'LATITUD_DESTINO',
+    'LONGITUD_DESTINO', 'HORA_SERVICIO', 'CIUDAD_DESTINO']
+# Columnas de ruteo que se conservan de un día ya calculado
+COLUMNAS_ESTADO = [
+    'SERVICIO_ID', 'GRUPO_DESTINO', 'GRUPO_HORA', 'RUTA_INICIAL',
+    'RUTA_FINAL', 'ORDEN_RECOGIDA', *COLUMNAS_DIFERENCIA]
+
+
+def clave_parametros(max_distancia_km, proveedor=None, motor=None):
+    """
+    Construye la llave de los parámetros con que se calculó un día; solo
+        se reutilizan rutas calculadas con los mismos parámetros.
+
+    Returns:
+        str: Llave con distancia máxima, proveedor y motor.
+    """
+    nombre = getattr(proveedor, 'nombre', proveedor) or RUTAS_PROVEEDOR
+    return "|".join([f"{float(max_distancia_km):.6f}", str(nombre),
+                     str(motor)])
+
+
+class EstadoRutas:
+    """
+    Estado persistente en SQLite de los días ya ruteados.
+
+    Por cada fecha y parámetros se guardan las columnas de ruteo de las
+    rutas de ida (COLUMNAS_ESTADO), que permiten recalcular un día solo
+    en los grupos de RUTA_INICIAL afectados por servicios nuevos,
+    cancelados o modificados.
+
+    Args:
+        ruta (str): Ruta del archivo SQLite.
+
+    Attributes:
+        conn (sqlite3.Connection): Conexión al archivo del estado.
+    """
+
+    def __init__(self, ruta=ESTADO_RUTAS_PATH):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            ruta, timeout=30, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS estado_dias ("
+                "fecha TEXT NOT NULL, parametros TEXT NOT NULL, "
+                "rutas BLOB NOT NULL, actualizado REAL NOT NULL, "
+                "PRIMARY KEY (fecha, parametros))")
+
+    def obtener(self, fecha, parametros):
+        """
+        Busca el estado de un día.
+
+        Args:
+            fecha (str): Fecha de servicio en formato 'YYYY-MM-DD'.
+            parametros (str): Llave generada con clave_parametros.
+
+        Returns:
+            pd.DataFrame or None: Columnas de ruteo del día, o None si el
+                día no se ha calculado con esos parámetros o su estado no
+                se puede leer (corrupto o de otra versión de pandas); en
+                ese caso el día se recalcula completo.
+        """
+        with self._lock:
+            fila = self.conn.execute(
+                "SELECT rutas FROM estado_dias "
+                "WHERE fecha = ? AND parametros = ?",
+                (fecha, parametros)).fetchone()
+        if fila is None:
+            return None
+        try:
+            anterior = pickle.loads(fila[0])
+        except Exception:
+            return None
+        return anterior if isinstance(anterior, pd.DataFrame) else None
+
+    def guardar(self, fecha, parametros, df_ida):
+        """
+        Guarda el estado de un día, reemplazando el anterior.
+
+        Args:
+            fecha (str): Fecha de servicio en formato 'YYYY-MM-DD'.
+            parametros (str): Llave generada con clave_parametros.
+            df_ida (pd.DataFrame): Rutas de ida del día (obtener_rutas_ida).
+        """
+        columnas = [col for col in COLUMNAS_ESTADO if col in df_ida.columns]
+        datos = pickle.dumps(df_ida[columnas].reset_index(drop=True),
+                             protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO estado_dias "
+                "(fecha, parametros, rutas, actualizado) VALUES (?, ?, ?, ?)",
+                (fecha, parametros, datos, time.time()))
+
+    def eliminar(self, fecha=None):
+        """Elimina el estado de una fecha, o de todas si no se indica."""
+        with self._lock, self.conn:
+            if fecha is None:
+                self.conn.execute("DELETE FROM estado_dias")
+            else:
+                self.conn.execute(
+                    "DELETE FROM estado_dias WHERE fecha = ?", (fecha,))
+
+
+_estado = None
+_estado_pid = None
+_estado_lock = threading.Lock()
+
+
+def obtener_estado():
+    """
+    Retorna la instancia compartida del estado de rutas del proceso.
+
+    Returns:
+        EstadoRutas: Estado compartido.
+    """
+    global _estado, _estado_pid
+    with _estado_lock:
+        # Las conexiones SQLite no se comparten entre procesos
+        if _estado is None or _estado_pid != os.getpid():
+            _estado = EstadoRutas()
+            _estado_pid = os.getpid()
+    return _estado
+
+
+def _valores(serie):
+    """Retorna la serie sin tipo categórico, para comparar entre cálculos."""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return serie.astype(object)
+    return serie
+
+
+def grupos_sin_cambios(df_ida, anterior):
+    """
+    Compara los grupos de RUTA_INICIAL recién formados con los de un
+        cálculo anterior del mismo día.
+
+    Un grupo no cambió si todos sus servicios (por SERVICIO_ID) estaban en
+    un mismo grupo anterior, ese grupo no tenía otros servicios y ninguna
+    de las COLUMNAS_DIFERENCIA cambió. Los servicios nuevos, cancelados o
+    modificados hacen que su grupo se recalcule.
+
+    Args:
+        df_ida (pd.DataFrame): Servicios de ida con RUTA_INICIAL asignada.
+        anterior (pd.DataFrame): Estado guardado del día (EstadoRutas).
+
+    Returns:
+        dict: RUTA_INICIAL anterior de cada RUTA_INICIAL nueva sin cambios.
+    """
+    anterior = anterior.drop_duplicates('SERVICIO_ID', keep=False)
+    columnas = [col for col in COLUMNAS_DIFERENCIA
+                if col in df_ida.columns and col in anterior.columns]
+    previo = anterior.set_index('SERVICIO_ID').reindex(df_ida['SERVICIO_ID'])
+    previo.index = df_ida.index
+    iguales = previo['RUTA_INICIAL'].notna()
+    for col in columnas:
+        # Las categorías de cada cálculo pueden diferir: se comparan valores
+        actual, previa = _valores(df_ida[col]), _valores(previo[col])
+        iguales &= (actual == previa) | (actual.isna() & previa.isna())
+    tamanos_anteriores = anterior.groupby('RUTA_INICIAL').size()
+    comparacion = pd.DataFrame({
+        'RUTA_INICIAL': df_ida['RUTA_INICIAL'],
+        'RUTA_ANTERIOR': previo['RUTA_INICIAL'],
+        'IGUAL': iguales})
+    resumen = comparacion.groupby('RUTA_INICIAL', sort=False).agg(
+        IGUALES=('IGUAL', 'all'), ANTERIORES=('RUTA_ANTERIOR', 'nunique'),
+        RUTA_ANTERIOR=('RUTA_ANTERIOR', 'first'),
+        TAMANO=('IGUAL', 'size'))
+    resumen = resumen[resumen['IGUALES'] & (resumen['ANTERIORES'] == 1)]
+    resumen = resumen[resumen['TAMANO'].to_numpy() == tamanos_anteriores.reindex(
+        resumen['RUTA_ANTERIOR']).to_numpy()]
+    return resumen['RUTA_ANTERIOR'].to_dict()
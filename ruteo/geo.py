@@ -0,0 +1,239 @@
+"""
+    geo.py
+"""
+import numpy as np
+
+# Radio medio de la Tierra en kilómetros
+RADIO_TIERRA_KM = 6371.0
+# Parámetros del elipsoide WGS-84
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+
+def _radianes(*valores):
+    return [np.radians(np.asarray(valor, dtype=float)) for valor in valores]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Calcula la distancia Haversine entre puntos en kilómetros.
+
+    Los argumentos pueden ser escalares o arreglos de NumPy; se aplican las
+    reglas de broadcasting.
+
+    Args:
+        lat1 (float or np.ndarray): Latitud de los primeros puntos en grados.
+        lon1 (float or np.ndarray): Longitud de los primeros puntos en grados.
+        lat2 (float or np.ndarray): Latitud de los segundos puntos en grados.
+        lon2 (float or np.ndarray): Longitud de los segundos puntos en grados.
+
+    Returns:
+        np.ndarray: Distancias en kilómetros.
+
+    Ejemplo:
+        distancias = haversine(df['LATITUD_ORIGEN'], df['LONGITUD_ORIGEN'],
+                               df['LATITUD_DESTINO'], df['LONGITUD_DESTINO'])
+    """
+    lat1, lon1, lat2, lon2 = _radianes(lat1, lon1, lat2, lon2)
+    dis_a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * \
+        np.sin((lon2 - lon1) / 2)**2
+    dis_c = 2 * np.arctan2(np.sqrt(dis_a), np.sqrt(1 - dis_a))
+    return RADIO_TIERRA_KM * dis_c
+
+
+def equirectangular(lat1, lon1, lat2, lon2):
+    """
+    Calcula una aproximación rápida de la distancia en kilómetros usando
+        la proyección equirectangular.
+
+    Es adecuada para distancias cortas (escala de ciudad), donde su error
+    frente a Haversine es despreciable.
+
+    Args:
+        lat1, lon1, lat2, lon2 (float or np.ndarray): Coordenadas en grados.
+
+    Returns:
+        np.ndarray: Distancias en kilómetros.
+    """
+    lat1, lon1, lat2, lon2 = _radianes(lat1, lon1, lat2, lon2)
+    dis_x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+    dis_y = lat2 - lat1
+    return RADIO_TIERRA_KM * np.hypot(dis_x, dis_y)
+
+
+def geodesica(lat1, lon1, lat2, lon2, max_iteraciones=200, tolerancia=1e-12):
+    """
+    Calcula la distancia geodésica sobre el elipsoide WGS-84 en kilómetros.
+
+    Implementa la fórmula inversa de Vincenty de forma vectorizada. Coincide
+    con geopy.distance.geodesic al milímetro salvo para puntos casi
+    antípodas, donde la iteración puede no converger.
+
+    Args:
+        lat1, lon1, lat2, lon2 (float or np.ndarray): Coordenadas en grados.
+        max_iteraciones (int, opcional): Número máximo de iteraciones.
+        tolerancia (float, opcional): Criterio de convergencia en radianes.
+
+    Returns:
+        np.ndarray: Distancias en kilómetros.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *_radianes(lat1, lon1, lat2, lon2))
+    dif_lon = lon2 - lon1
+    red_1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    red_2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(red_1), np.cos(red_1)
+    sin_u2, cos_u2 = np.sin(red_2), np.cos(red_2)
+    lam = dif_lon
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iteraciones):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            cos_2sm = np.where(
+                cos2_alpha == 0, 0,
+                cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+            dis_c = WGS84_F / 16 * cos2_alpha * (
+                4 + WGS84_F * (4 - 3 * cos2_alpha))
+            lam_anterior = lam
+            lam = dif_lon + (1 - dis_c) * WGS84_F * sin_alpha * (
+                sigma + dis_c * sin_sigma * (
+                    cos_2sm + dis_c * cos_sigma * (-1 + 2 * cos_2sm**2)))
+            if np.all(np.abs(lam - lam_anterior) < tolerancia):
+                break
+    u_2 = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+    coef_a = 1 + u_2 / 16384 * (4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    coef_b = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
+    delta_sigma = coef_b * sin_sigma * (cos_2sm + coef_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sm**2) - coef_b / 6 * cos_2sm *
+        (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sm**2)))
+    return WGS84_B * coef_a * (sigma - delta_sigma)
+
+
+METODOS = {
+    'haversine': haversine,
+    'equirectangular': equirectangular,
+    'geodesica': geodesica,
+}
+
+
+def _metodo(metodo):
+    try:
+        return METODOS[metodo]
+    except KeyError:
+        raise ValueError(
+            f"Método de distancia '{metodo}' no soportado, use uno de "
+            f"{sorted(METODOS)}") from None
+
+
+def distancias_fila(origenes, destinos, metodo='haversine'):
+    """
+    Calcula la distancia entre cada origen y el destino de la misma fila.
+
+    Args:
+        origenes (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        destinos (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        metodo (str, opcional): 'haversine', 'equirectangular' o 'geodesica'.
+
+    Returns:
+        np.ndarray: Arreglo (N,) de distancias en kilómetros.
+    """
+    origenes = np.asarray(origenes, dtype=float).reshape(-1, 2)
+    destinos = np.asarray(destinos, dtype=float).reshape(-1, 2)
+    return _metodo(metodo)(
+        origenes[:, 0], origenes[:, 1], destinos[:, 0], destinos[:, 1])
+
+
+def distancias_uno_a_muchos(punto, puntos, metodo='haversine'):
+    """
+    Calcula la distancia entre un punto y cada uno de varios puntos.
+
+    Args:
+        punto (tuple): Coordenadas (latitud, longitud) del punto de referencia.
+        puntos (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        metodo (str, opcional): 'haversine', 'equirectangular' o 'geodesica'.
+
+    Returns:
+        np.ndarray: Arreglo (N,) de distancias en kilómetros.
+    """
+    puntos = np.asarray(puntos, dtype=float).reshape(-1, 2)
+    return _metodo(metodo)(punto[0], punto[1], puntos[:, 0], puntos[:, 1])
+
+
+def distancias_pares(puntos_a, puntos_b=None, metodo='haversine'):
+    """
+    Calcula la matriz de distancias entre dos conjuntos de puntos.
+
+    Args:
+        puntos_a (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        puntos_b (array-like, opcional): Arreglo (M, 2) de coordenadas. Si no
+            se indica se usa `puntos_a`.
+        metodo (str, opcional): 'haversine', 'equirectangular' o 'geodesica'.
+
+    Returns:
+        np.ndarray: Matriz (N, M) de distancias en kilómetros.
+    """
+    puntos_a = np.asarray(puntos_a, dtype=float).reshape(-1, 2)
+    puntos_b = puntos_a if puntos_b is None else \
+        np.asarray(puntos_b, dtype=float).reshape(-1, 2)
+    return _metodo(metodo)(
+        puntos_a[:, 0:1], puntos_a[:, 1:2], puntos_b[:, 0], puntos_b[:, 1])
+
+
+def distancias_consecutivas(puntos, metodo='haversine'):
+    """
+    Calcula la distancia entre cada punto de un recorrido y el siguiente.
+
+    Args:
+        puntos (array-like): Arreglo (N, 2) de coordenadas (latitud, longitud).
+        metodo (str, opcional): 'haversine', 'equirectangular' o 'geodesica'.
+
+    Returns:
+        np.ndarray: Arreglo (N - 1,) de distancias en kilómetros.
+    """
+    puntos = np.asarray(puntos, dtype=float).reshape(-1, 2)
+    return distancias_fila(puntos[:-1], puntos[1:], metodo)
+
+
+GEOHASH_BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+
+def geohash(lat, lon, precision=5):
+    """
+    Calcula el geohash de cada punto de forma vectorizada.
+
+    Args:
+        lat (float or array-like): Latitudes en grados.
+        lon (float or array-like): Longitudes en grados.
+        precision (int, opcional): Número de caracteres (5 equivale a
+            celdas de unos 4.9 x 4.9 km).
+
+    Returns:
+        np.ndarray: Arreglo de cadenas con el geohash de cada punto.
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    lat_min, lat_max = np.full(lat.shape, -90.0), np.full(lat.shape, 90.0)
+    lon_min, lon_max = np.full(lon.shape, -180.0), np.full(lon.shape, 180.0)
+    codigos = np.zeros((lat.size, precision), dtype=np.int64)
+    for bit in range(precision * 5):
+        # Los bits pares dividen la longitud y los impares la latitud
+        if bit % 2 == 0:
+            medio = (lon_min + lon_max) / 2
+            arriba = lon >= medio
+            lon_min = np.where(arriba, medio, lon_min)
+            lon_max = np.where(arriba, lon_max, medio)
+        else:
+            medio = (lat_min + lat_max) / 2
+            arriba = lat >= medio
+            lat_min = np.where(arriba, medio, lat_min)
+            lat_max = np.where(arriba, lat_max, medio)
+        codigos[:, bit // 5] = codigos[:, bit // 5] * 2 + arriba
+    caracteres = GEOHASH_BASE32[codigos]
+    return np.array([''.join(fila) for fila in caracteres])
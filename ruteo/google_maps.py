@@ -1,15 +1,155 @@
 """
     google_maps.py
 """
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import googlemaps
-from apps.ruteo.decoradores import contador
-from apps.ruteo.constantes import GOOGLE_KEY
+import numpy as np
+from requests.adapters import HTTPAdapter
+from apps.ruteo.decoradores import contador, latencia, contar, en_contexto
+from apps.ruteo.constantes import (
+    GOOGLE_KEY, RUTAS_MAX_HILOS, RUTAS_PROVEEDOR, OSM_PATH, VEL_LINEA_RECTA,
+    FACTOR_CIRCUITO, COSTO_DIRECTIONS, COSTO_DIRECTIONS_AVANZADO,
+    COSTO_MATRIZ_ELEMENTO, COSTO_MATRIZ_ELEMENTO_AVANZADO)
+from apps.ruteo.cache_rutas import obtener_cache
+from apps.ruteo.geo import distancias_uno_a_muchos
+from apps.ruteo.proveedores import (
+    ProveedorRutas, ProveedorLocal, ProveedorLineaRecta)
+from apps.ruteo.optimizacion import ordenar_waypoints, barrido_angular
+
+ResultadoRuta = namedtuple('ResultadoRuta', ['respuesta', 'error'])
+
+_cliente = None
+_cliente_pid = None
+_cliente_lock = threading.Lock()
+_proveedores = {}
+_proveedores_lock = threading.Lock()
+
+
+def obtener_cliente():
+    """
+    Retorna el cliente de Google Maps compartido por el proceso.
+
+    El cliente se crea una sola vez y mantiene una sesión HTTP con un
+    pool de conexiones del tamaño de RUTAS_MAX_HILOS, de modo que las
+    solicitudes sucesivas o concurrentes reutilizan las conexiones abiertas.
+
+    Returns:
+        googlemaps.Client: Cliente compartido.
+    """
+    global _cliente, _cliente_pid
+    with _cliente_lock:
+        # Las sesiones HTTP no se comparten entre procesos
+        if _cliente is None or _cliente_pid != os.getpid():
+            cliente = googlemaps.Client(key=GOOGLE_KEY)
+            adaptador = HTTPAdapter(
+                pool_connections=RUTAS_MAX_HILOS,
+                pool_maxsize=RUTAS_MAX_HILOS)
+            cliente.session.mount('https://', adaptador)
+            _cliente = cliente
+            _cliente_pid = os.getpid()
+    return _cliente
+
+
+class ProveedorGoogle(ProveedorRutas):
+    """
+    Proveedor de rutas de la API de Google Maps Directions.
+    """
+    nombre = 'google'
+    usa_cache = True
+    # Límites de las APIs de Distance Matrix y Directions por solicitud
+    limites_matriz = (25, 25, 100)
+    max_waypoints = 25
+
+    def direcciones(self, origen, destino, waypoints=None,
+                    departure_time=None, optimize=True):
+        return obtener_cliente().directions(
+            origin=origen,
+            destination=destino,
+            waypoints=waypoints,
+            departure_time=departure_time,
+            optimize_waypoints=optimize
+        )
+
+    def costo(self, waypoints=None, departure_time=None):
+        # Las solicitudes con tráfico o más de 10 waypoints se cobran
+        # con la tarifa avanzada
+        if departure_time is not None or len(waypoints or []) > 10:
+            return COSTO_DIRECTIONS_AVANZADO
+        return COSTO_DIRECTIONS
+
+    def costo_matriz(self, elementos, departure_time=None):
+        if departure_time is not None:
+            return elementos * COSTO_MATRIZ_ELEMENTO_AVANZADO
+        return elementos * COSTO_MATRIZ_ELEMENTO
+
+    def matriz(self, origenes, destinos, departure_time=None):
+        respuesta = obtener_cliente().distance_matrix(
+            origins=list(origenes),
+            destinations=list(destinos),
+            departure_time=departure_time
+        )
+        tiempos = np.full((len(origenes), len(destinos)), np.inf)
+        for i, fila in enumerate(respuesta.get('rows', [])):
+            for j, elemento in enumerate(fila.get('elements', [])):
+                if elemento.get('status') == 'OK':
+                    # Con hora de salida se usa la duración con tráfico
+                    duracion = elemento.get(
+                        'duration_in_traffic', elemento['duration'])
+                    tiempos[i, j] = duracion['value']
+        return tiempos
+
+
+def crear_proveedor(nombre):
+    """
+    Crea un proveedor de rutas a partir de su nombre.
+
+    Args:
+        nombre (str): 'google', 'local' o 'linea_recta'.
+
+    Returns:
+        ProveedorRutas: Proveedor configurado.
+    """
+    if nombre == ProveedorGoogle.nombre:
+        return ProveedorGoogle()
+    respaldo = ProveedorLineaRecta(VEL_LINEA_RECTA, FACTOR_CIRCUITO)
+    if nombre == ProveedorLineaRecta.nombre:
+        return respaldo
+    if nombre == ProveedorLocal.nombre:
+        return ProveedorLocal(OSM_PATH, respaldo=respaldo)
+    raise ValueError(
+        f"Proveedor de rutas '{nombre}' no soportado, use 'google', "
+        "'local' o 'linea_recta'")
+
+
+def obtener_proveedor(proveedor=None):
+    """
+    Retorna el proveedor de rutas indicado, creándolo una sola vez por
+        proceso (el grafo del motor local se carga solo la primera vez).
+
+    Args:
+        proveedor (str or ProveedorRutas, opcional): Nombre del proveedor o
+            una instancia. Por defecto RUTAS_PROVEEDOR.
+
+    Returns:
+        ProveedorRutas: Proveedor de rutas.
+    """
+    if isinstance(proveedor, ProveedorRutas):
+        return proveedor
+    nombre = proveedor or RUTAS_PROVEEDOR
+    with _proveedores_lock:
+        if nombre not in _proveedores:
+            _proveedores[nombre] = crear_proveedor(nombre)
+        return _proveedores[nombre]
 
 
 @contador
+@latencia
 def calcular_ruta(origen, destino, waypoints=None,
-    departure_time=datetime.now(), optimize=True):
+    departure_time=datetime.now(), optimize=True, proveedor=None):
     """
     Calcula la ruta entre un origen y un destino utilizando
         la API de Google Maps Directions.
@@ -25,12 +165,22 @@ def calcular_ruta(origen, destino, waypoints=None,
             la duración. Por defecto es el momento actual.
         optimize (bool, optional): Indica si se deben optimizar los
             waypoints para la ruta. Por defecto es True.
+        proveedor (str or ProveedorRutas, optional): Proveedor de rutas a
+            usar. Por defecto el configurado en RUTAS_PROVEEDOR; con
+            'local' o 'linea_recta' no se consume la API de Google.
     Returns:
         list: Lista de pasos de la ruta, cada uno representado como
             un diccionario con información detallada.
     Note:
         Asegúrate de tener una clave de API válida de Google Maps
             (GOOGLE_KEY) para utilizar esta función.
+        Si el cache de rutas está activo, la respuesta se busca primero en
+            el cache persistente y se retorna solo con los campos que usa
+            el proceso de ruteo (ver cache_rutas.reducir_respuesta).
+        Cada llamada registra su latencia, el resultado del cache y el
+            costo de la solicitud en decoradores.registro_metricas.
+        Si los waypoints superan el máximo del proveedor, la ruta se
+            calcula por partes (ver calcular_ruta_por_partes).
     Example:
         origen = "New York, NY"
         destino = "Los Angeles, CA"
@@ -39,12 +189,304 @@ def calcular_ruta(origen, destino, waypoints=None,
         for step in ruta:
             print(step['html_instructions'])
     """
-    gmaps = googlemaps.Client(key=GOOGLE_KEY)
-    directions_result = gmaps.directions(
-        origin=origen,
-        destination=destino,
-        waypoints=waypoints,
-        departure_time=departure_time,
-        optimize_waypoints=optimize
-    )
-    return directions_result
\ No newline at end of file
+    proveedor = obtener_proveedor(proveedor)
+    if proveedor.max_waypoints is not None and \
+            len(waypoints or []) > proveedor.max_waypoints:
+        return calcular_ruta_por_partes(
+            origen, destino, waypoints, departure_time, optimize, proveedor)
+    # Solo se guardan en cache las respuestas de proveedores con costo
+    cache = obtener_cache() if proveedor.usa_cache else None
+    if cache:
+        clave = cache.clave(
+            origen, destino, waypoints, departure_time, optimize)
+        directions_result = cache.obtener(clave)
+        contar('ruteo_cache_total',
+               resultado='miss' if directions_result is None else 'hit')
+        if directions_result is not None:
+            return directions_result
+    directions_result = proveedor.direcciones(
+        origen, destino, waypoints=waypoints,
+        departure_time=departure_time, optimize=optimize)
+    contar('ruteo_solicitudes_api_total', proveedor=proveedor.nombre)
+    costo = proveedor.costo(waypoints, departure_time)
+    if costo:
+        contar('ruteo_costo_api_usd', costo, proveedor=proveedor.nombre)
+    if cache:
+        directions_result = cache.guardar(clave, directions_result)
+    return directions_result
+
+
+def calcular_rutas_batch(solicitudes, max_hilos=RUTAS_MAX_HILOS):
+    """
+    Calcula varias rutas de forma concurrente usando el cliente compartido.
+
+    Args:
+        solicitudes (list of dict): Lista de solicitudes, cada una con los
+            argumentos de calcular_ruta ('origen', 'destino' y opcionalmente
+            'waypoints', 'departure_time', 'optimize' y 'proveedor').
+        max_hilos (int, optional): Número máximo de solicitudes simultáneas.
+
+    Returns:
+        list of ResultadoRuta: Un resultado por solicitud, en el mismo orden
+            de entrada. Si una solicitud falla, su `respuesta` es None y
+            `error` contiene la excepción; las demás no se ven afectadas.
+
+    Example:
+        solicitudes = [
+            {'origen': (4.65, -74.05), 'destino': (4.60, -74.08)},
+            {'origen': (4.70, -74.10), 'destino': (4.60, -74.08)},
+        ]
+        for resultado in calcular_rutas_batch(solicitudes):
+            if resultado.error is None:
+                print(resultado.respuesta[0]['legs'][0]['duration'])
+    """
+    def _calcular(solicitud):
+        try:
+            return ResultadoRuta(calcular_ruta(**solicitud), None)
+        except Exception as error:
+            return ResultadoRuta(None, error)
+
+    if not solicitudes:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, max_hilos)) as executor:
+        return list(executor.map(en_contexto(_calcular), solicitudes))
+
+
+def calcular_ruta_por_partes(origen, destino, waypoints,
+                             departure_time=None, optimize=True,
+                             proveedor=None, max_hilos=RUTAS_MAX_HILOS):
+    """
+    Calcula una ruta con más waypoints de los que acepta el proveedor
+        dividiéndola en tramos que se piden de forma concurrente.
+
+    Con `optimize` las paradas (origen y waypoints) se dividen por barrido
+    angular alrededor del destino en grupos contiguos que caben en una
+    solicitud; el primero empieza en el origen y los demás en su parada
+    más lejana al destino. Sin `optimize` se respeta el orden recibido y
+    se corta en grupos consecutivos. Cada tramo va de la primera parada de
+    su grupo a la primera del siguiente (o al destino), y sus trayectos se
+    unen en una sola respuesta. Todos los tramos usan `departure_time`.
+
+    Args:
+        origen (tuple): Coordenadas (latitud, longitud) del origen.
+        destino (tuple): Coordenadas (latitud, longitud) del destino.
+        waypoints (list of tuple): Puntos intermedios.
+        departure_time (datetime, optional): Hora de salida.
+        optimize (bool, optional): Optimizar el orden dentro de cada tramo.
+        proveedor (str or ProveedorRutas, optional): Proveedor de rutas.
+        max_hilos (int, optional): Número máximo de tramos simultáneos.
+
+    Returns:
+        list: Respuesta con la forma de Directions; sus 'legs' recorren toda
+            la ruta y 'waypoint_order' refiere a los waypoints recibidos.
+
+    Raises:
+        Exception: El error del primer tramo que falle.
+    """
+    proveedor = obtener_proveedor(proveedor)
+    paradas = [origen, *(waypoints or [])]
+    tamano = proveedor.max_waypoints + 1
+    if optimize:
+        grupos = barrido_angular(paradas, destino, tamano, inicio=0)
+        lejanos = distancias_uno_a_muchos(destino, paradas)
+        for grupo in grupos[1:]:
+            # Cada grupo empieza en su parada más lejana al destino
+            grupo.insert(0, grupo.pop(int(np.argmax(lejanos[grupo]))))
+    else:
+        indices = list(range(len(paradas)))
+        grupos = [indices[i:i + tamano]
+                  for i in range(0, len(indices), tamano)]
+    solicitudes = [{
+        'origen': paradas[grupo[0]],
+        'destino': paradas[grupos[k + 1][0]] if k + 1 < len(grupos)
+        else destino,
+        'waypoints': [paradas[i] for i in grupo[1:]],
+        'departure_time': departure_time,
+        'optimize': optimize and len(grupo) > 2,
+        'proveedor': proveedor
+    } for k, grupo in enumerate(grupos)]
+    contar('ruteo_rutas_por_partes_total')
+    legs, orden = [], []
+    for grupo, resultado in zip(
+            grupos, calcular_rutas_batch(solicitudes, max_hilos)):
+        if resultado.error is not None:
+            raise resultado.error
+        if not resultado.respuesta:
+            return []
+        ruta = resultado.respuesta[0]
+        intermedios = grupo[1:]
+        orden_grupo = ruta.get('waypoint_order') or \
+            list(range(len(intermedios)))
+        visita = [grupo[0]] + [intermedios[i] for i in orden_grupo]
+        orden.extend(parada - 1 for parada in visita if parada > 0)
+        legs.extend(ruta['legs'])
+    return [{'legs': legs, 'waypoint_order': orden}]
+
+
+def bloques_matriz(n_origenes, n_destinos, limites):
+    """
+    Divide una matriz en bloques que respetan los límites por solicitud.
+
+    Args:
+        n_origenes (int): Número de orígenes.
+        n_destinos (int): Número de destinos.
+        limites (tuple): Máximo de orígenes, destinos y elementos por
+            solicitud.
+
+    Returns:
+        list of tuple: Pares (slice de orígenes, slice de destinos).
+    """
+    max_origenes, max_destinos, max_elementos = limites
+    ancho = min(n_destinos, max_destinos, max_elementos)
+    alto = min(max_origenes, max(1, max_elementos // max(ancho, 1)))
+    return [(slice(i, i + alto), slice(j, j + ancho))
+            for i in range(0, n_origenes, alto)
+            for j in range(0, n_destinos, ancho)]
+
+
+@latencia
+def calcular_matriz(origenes, destinos, departure_time=None, proveedor=None,
+                    max_hilos=RUTAS_MAX_HILOS):
+    """
+    Calcula la matriz de tiempos de viaje entre orígenes y destinos.
+
+    Con proveedores que tienen límites por solicitud (Distance Matrix de
+    Google), cada par se busca primero en el cache de rutas y solo los
+    orígenes y destinos con pares faltantes se piden a la API, en bloques
+    dentro de los límites y de forma concurrente.
+
+    Args:
+        origenes (list of tuple): Coordenadas (latitud, longitud).
+        destinos (list of tuple): Coordenadas (latitud, longitud).
+        departure_time (datetime, optional): Hora de salida.
+        proveedor (str or ProveedorRutas, optional): Proveedor de rutas.
+        max_hilos (int, optional): Número máximo de solicitudes simultáneas.
+
+    Returns:
+        np.ndarray: Matriz (n_origenes, n_destinos) de tiempos en segundos;
+            np.inf para los pares sin ruta.
+
+    Example:
+        tiempos = calcular_matriz([(4.65, -74.05), (4.70, -74.10)],
+                                  [(4.60, -74.08)])
+        print(tiempos[:, 0] / 60)
+    """
+    proveedor = obtener_proveedor(proveedor)
+    origenes = [tuple(map(float, punto)) for punto in origenes]
+    destinos = [tuple(map(float, punto)) for punto in destinos]
+    if not origenes or not destinos:
+        return np.empty((len(origenes), len(destinos)))
+    if proveedor.limites_matriz is None:
+        return proveedor.matriz(origenes, destinos, departure_time)
+    tiempos = np.full((len(origenes), len(destinos)), np.nan)
+    cache = obtener_cache() if proveedor.usa_cache else None
+    if cache:
+        claves = [[cache.clave_matriz(origen, destino, departure_time)
+                   for destino in destinos] for origen in origenes]
+        guardados = cache.obtener_varios(
+            [clave for fila in claves for clave in fila])
+        for i, fila in enumerate(claves):
+            for j, clave in enumerate(fila):
+                if clave in guardados:
+                    tiempos[i, j] = guardados[clave]
+        aciertos = len(guardados)
+        contar('ruteo_cache_total', aciertos, resultado='hit')
+        contar('ruteo_cache_total', tiempos.size - aciertos, resultado='miss')
+    faltantes = np.isnan(tiempos)
+    filas = np.flatnonzero(faltantes.any(axis=1))
+    columnas = np.flatnonzero(faltantes.any(axis=0))
+    if len(filas):
+        bloques = bloques_matriz(
+            len(filas), len(columnas), proveedor.limites_matriz)
+
+        def _calcular(bloque):
+            indices_filas, indices_columnas = \
+                filas[bloque[0]], columnas[bloque[1]]
+            contar('ruteo_solicitudes_api_total', proveedor=proveedor.nombre,
+                   api='matriz')
+            costo = proveedor.costo_matriz(
+                len(indices_filas) * len(indices_columnas), departure_time)
+            if costo:
+                contar('ruteo_costo_api_usd', costo, proveedor=proveedor.nombre)
+            return indices_filas, indices_columnas, proveedor.matriz(
+                [origenes[i] for i in indices_filas],
+                [destinos[j] for j in indices_columnas], departure_time)
+
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(max_hilos, len(bloques)))) as executor:
+            for indices_filas, indices_columnas, bloque in executor.map(
+                    en_contexto(_calcular), bloques):
+                tiempos[np.ix_(indices_filas, indices_columnas)] = bloque
+        if cache:
+            cache.guardar_varios({
+                claves[i][j]: float(tiempos[i, j])
+                for i in filas for j in columnas
+                if faltantes[i, j] and np.isfinite(tiempos[i, j])})
+    return tiempos
+
+
+def orden_waypoints(origen, destino, waypoints=None, departure_time=None,
+                    proveedor=None):
+    """
+    Calcula localmente el orden de visita de los waypoints de una ruta.
+
+    Reemplaza `optimize_waypoints` de la API de Directions: los tiempos
+    entre todos los puntos se obtienen con calcular_matriz (y su cache) y
+    el orden con optimizacion.ordenar_waypoints. Solo se ordena si la
+    matriz no requiere solicitudes pagas (ver matriz_sin_costo): una matriz
+    de (k + 2)² elementos de Distance Matrix cuesta mucho más que la única
+    solicitud de Directions con optimize_waypoints.
+
+    Args:
+        origen (tuple): Coordenadas (latitud, longitud) del origen.
+        destino (tuple): Coordenadas (latitud, longitud) del destino.
+        waypoints (list of tuple, optional): Puntos intermedios.
+        departure_time (datetime, optional): Hora de salida.
+        proveedor (str or ProveedorRutas, optional): Proveedor de rutas.
+
+    Returns:
+        list or None: Orden de visita con la misma forma que
+            `waypoint_order`, o None si la matriz tendría costo y se debe
+            usar optimize_waypoints.
+
+    Example:
+        orden = orden_waypoints(origen, destino, waypoints, fecha_hora_viaje)
+        ruta = calcular_ruta(origen, destino, [waypoints[i] for i in orden],
+                             fecha_hora_viaje, optimize=False)
+    """
+    waypoints = list(waypoints or [])
+    if len(waypoints) <= 1:
+        return list(range(len(waypoints)))
+    puntos = [origen, *waypoints, destino]
+    if not matriz_sin_costo(puntos, puntos, departure_time, proveedor):
+        return None
+    return ordenar_waypoints(
+        calcular_matriz(puntos, puntos, departure_time, proveedor))
+
+
+def matriz_sin_costo(origenes, destinos, departure_time=None, proveedor=None):
+    """
+    Indica si calcular_matriz puede responder sin solicitudes pagas.
+
+    Es así con los proveedores sin límites de matriz (locales), o cuando
+    todos los pares ya están en el cache de rutas.
+
+    Args:
+        origenes (list of tuple): Coordenadas (latitud, longitud).
+        destinos (list of tuple): Coordenadas (latitud, longitud).
+        departure_time (datetime, optional): Hora de salida.
+        proveedor (str or ProveedorRutas, optional): Proveedor de rutas.
+
+    Returns:
+        bool: True si la matriz no genera solicitudes a la API.
+    """
+    proveedor = obtener_proveedor(proveedor)
+    if proveedor.limites_matriz is None:
+        return True
+    cache = obtener_cache() if proveedor.usa_cache else None
+    if not cache:
+        return False
+    claves = {cache.clave_matriz(tuple(map(float, origen)),
+                                 tuple(map(float, destino)), departure_time)
+              for origen in origenes for destino in destinos}
+    return len(cache.obtener_varios(list(claves))) == len(claves)
@@ -0,0 +1,364 @@
+"""
+    modelo_tiempo.py
+"""
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+from apps.ruteo.constantes import (
+    MODELO_TIEMPO_PATH, MODELO_TIEMPO_PRECISION, MODELO_TIEMPO_MIN_MUESTRAS,
+    VEL_LINEA_RECTA, CACHE_PATH)
+from apps.ruteo.geo import geohash, distancias_fila
+
+# Niveles de perfil de velocidad, del más específico al más general. Un
+# valor vacío ('' en celda, -1 en día u hora) agrupa todos los valores.
+NIVELES = (
+    ('celda', 'dia', 'hora'),
+    ('celda', 'hora'),
+    ('celda',),
+    ('hora',),
+    (),
+)
+# Valor z de los límites de confianza (intervalo central del 90 %)
+Z_CONFIANZA = 1.645
+# Desviación mínima del logaritmo de la velocidad, para no confiar de más
+# en perfiles con muestras casi iguales
+MIN_DESVIACION_LOG = 0.1
+# Límites de las muestras usadas para entrenar
+MIN_DISTANCIA_KM = 0.2
+MIN_DURACION_S = 30
+VELOCIDAD_MIN_KM_H = 2
+VELOCIDAD_MAX_KM_H = 120
+
+
+def _coordenada(texto):
+    latitud, longitud = texto.split(',')
+    return float(latitud), float(longitud)
+
+
+def muestras_cache(ruta_cache):
+    """
+    Extrae muestras de viaje de las respuestas guardadas en el cache de rutas.
+
+    Cada trayecto (leg) de una respuesta de Directions y cada elemento de
+    una matriz de tiempos con franja horaria es una muestra. Como en las
+    matrices, la duración de un trayecto es la duración con tráfico si la
+    respuesta la trae, y su hora de salida es la de la franja más la
+    duración de los trayectos anteriores de la ruta.
+
+    Args:
+        ruta_cache (str): Ruta del archivo SQLite del cache de rutas.
+
+    Returns:
+        pd.DataFrame: Muestras con las columnas LATITUD_INICIO,
+            LONGITUD_INICIO, LATITUD_FIN, LONGITUD_FIN, FECHA_HORA y
+            DURACION (segundos).
+    """
+    muestras = []
+    conn = sqlite3.connect(ruta_cache)
+    try:
+        for clave, respuesta in conn.execute(
+                "SELECT clave, respuesta FROM rutas"):
+            partes = clave.split('|')
+            franja = partes[-1]
+            if not franja:
+                continue
+            if partes[0] == 'matriz':
+                try:
+                    inicio, fin = _coordenada(partes[1]), _coordenada(partes[2])
+                except ValueError:
+                    # Direcciones en texto en lugar de coordenadas
+                    continue
+                muestras.append(
+                    (*inicio, *fin, franja, 0, json.loads(respuesta)))
+                continue
+            for route in json.loads(respuesta):
+                # Segundos desde la salida de la ruta hasta el inicio del leg
+                desfase = 0
+                for leg in route.get('legs', []):
+                    duracion = leg.get(
+                        'duration_in_traffic', leg['duration'])['value']
+                    inicio = leg.get('start_location')
+                    fin = leg.get('end_location')
+                    if inicio and fin:
+                        muestras.append((
+                            inicio['lat'], inicio['lng'], fin['lat'],
+                            fin['lng'], franja, desfase, duracion))
+                    desfase += duracion
+    finally:
+        conn.close()
+    df_muestras = pd.DataFrame(muestras, columns=[
+        'LATITUD_INICIO', 'LONGITUD_INICIO', 'LATITUD_FIN', 'LONGITUD_FIN',
+        'FECHA_HORA', 'DESFASE', 'DURACION'])
+    df_muestras['FECHA_HORA'] = pd.to_datetime(df_muestras['FECHA_HORA']) + \
+        pd.to_timedelta(df_muestras.pop('DESFASE'), unit='s')
+    return df_muestras
+
+
+def llaves_perfil(inicios, fines, fechas_hora, precision):
+    """
+    Calcula la celda, el día de la semana y la hora de cada viaje.
+
+    La celda es el geohash del punto medio entre inicio y fin.
+
+    Args:
+        inicios (np.ndarray): Arreglo (N, 2) de coordenadas de inicio.
+        fines (np.ndarray): Arreglo (N, 2) de coordenadas de fin.
+        fechas_hora (array-like): Hora de salida de cada viaje.
+        precision (int): Caracteres del geohash.
+
+    Returns:
+        pd.DataFrame: Columnas celda, dia y hora.
+    """
+    medios = (np.asarray(inicios, dtype=float) +
+              np.asarray(fines, dtype=float)) / 2
+    fechas_hora = pd.DatetimeIndex(fechas_hora)
+    return pd.DataFrame({
+        'celda': geohash(medios[:, 0], medios[:, 1], precision)
+        if len(medios) else np.array([], dtype=str),
+        'dia': fechas_hora.dayofweek.to_numpy(dtype=np.int64),
+        'hora': fechas_hora.hour.to_numpy(dtype=np.int64),
+    })
+
+
+class ModeloTiempo:
+    """
+    Modelo de tiempos de viaje basado en perfiles de velocidad aprendidos.
+
+    La velocidad de cada viaje se mide como distancia en línea recta sobre
+    duración real, de modo que el modelo corrige directamente la estimación
+    Haversine. Por cada celda geohash, día de la semana y hora se guarda el
+    número de muestras y la media y varianza del logaritmo de la velocidad.
+    Las estimaciones usan el nivel más específico con al menos
+    `min_muestras` muestras (ver NIVELES) y los límites de confianza salen
+    de la distribución log-normal de la velocidad.
+
+    Args:
+        ruta (str): Ruta del archivo SQLite del modelo.
+        precision (int): Caracteres del geohash de las celdas.
+        min_muestras (int): Muestras mínimas para usar un perfil.
+
+    Attributes:
+        perfiles (pd.DataFrame): Perfiles con las columnas celda, dia, hora,
+            muestras, media y varianza.
+    """
+    def __init__(self, ruta=MODELO_TIEMPO_PATH,
+                 precision=MODELO_TIEMPO_PRECISION,
+                 min_muestras=MODELO_TIEMPO_MIN_MUESTRAS):
+        self.ruta = ruta
+        self.precision = precision
+        self.min_muestras = min_muestras
+        self.perfiles = pd.DataFrame(columns=[
+            'celda', 'dia', 'hora', 'muestras', 'media', 'varianza'])
+        if os.path.exists(ruta):
+            self.cargar()
+
+    @property
+    def vacio(self):
+        return self.perfiles.empty
+
+    def entrenar(self, df_muestras):
+        """
+        Calcula los perfiles de velocidad a partir de muestras de viaje.
+
+        Args:
+            df_muestras (pd.DataFrame): Muestras con el formato de
+                muestras_cache.
+
+        Returns:
+            ModeloTiempo: El mismo modelo, con los perfiles actualizados.
+        """
+        inicios = df_muestras[['LATITUD_INICIO', 'LONGITUD_INICIO']].to_numpy(
+            dtype=float)
+        fines = df_muestras[['LATITUD_FIN', 'LONGITUD_FIN']].to_numpy(
+            dtype=float)
+        distancia_km = distancias_fila(inicios, fines)
+        duracion = df_muestras['DURACION'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            velocidad = distancia_km / (duracion / 3600)
+        validas = (distancia_km >= MIN_DISTANCIA_KM) & \
+            (duracion >= MIN_DURACION_S) & \
+            (velocidad >= VELOCIDAD_MIN_KM_H) & \
+            (velocidad <= VELOCIDAD_MAX_KM_H)
+        llaves = llaves_perfil(
+            inicios[validas], fines[validas],
+            df_muestras['FECHA_HORA'][validas], self.precision)
+        llaves['log_velocidad'] = np.log(velocidad[validas])
+        perfiles = []
+        for nivel in NIVELES:
+            if nivel:
+                agregado = llaves.groupby(list(nivel))['log_velocidad'].agg(
+                    ['count', 'mean', 'var']).reset_index()
+            else:
+                agregado = pd.DataFrame({
+                    'count': [len(llaves)],
+                    'mean': [llaves['log_velocidad'].mean()],
+                    'var': [llaves['log_velocidad'].var()]})
+            for columna, vacio in (('celda', ''), ('dia', -1), ('hora', -1)):
+                if columna not in nivel:
+                    agregado[columna] = vacio
+            perfiles.append(agregado)
+        perfiles = pd.concat(perfiles, ignore_index=True).rename(columns={
+            'count': 'muestras', 'mean': 'media', 'var': 'varianza'})
+        perfiles = perfiles[perfiles['muestras'] > 0]
+        self.perfiles = perfiles[
+            ['celda', 'dia', 'hora', 'muestras', 'media', 'varianza']
+        ].fillna({'varianza': 0.0}).reset_index(drop=True)
+        return self
+
+    def guardar(self):
+        """
+        Guarda los perfiles en el archivo SQLite del modelo.
+        """
+        conn = sqlite3.connect(self.ruta)
+        try:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS perfiles_velocidad")
+                conn.execute(
+                    "CREATE TABLE perfiles_velocidad ("
+                    "celda TEXT NOT NULL, dia INTEGER NOT NULL, "
+                    "hora INTEGER NOT NULL, muestras INTEGER NOT NULL, "
+                    "media REAL NOT NULL, varianza REAL NOT NULL, "
+                    "PRIMARY KEY (celda, dia, hora)) WITHOUT ROWID")
+                conn.executemany(
+                    "INSERT INTO perfiles_velocidad VALUES (?, ?, ?, ?, ?, ?)",
+                    self.perfiles.itertuples(index=False, name=None))
+        finally:
+            conn.close()
+
+    def cargar(self):
+        """
+        Carga los perfiles desde el archivo SQLite del modelo.
+        """
+        conn = sqlite3.connect(self.ruta)
+        try:
+            existe = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'perfiles_velocidad'").fetchone()
+            if existe:
+                self.perfiles = pd.read_sql_query(
+                    "SELECT * FROM perfiles_velocidad", conn)
+        finally:
+            conn.close()
+
+    def _perfil(self, llaves):
+        """
+        Busca el perfil más específico con suficientes muestras para cada
+            viaje.
+
+        Returns:
+            pd.DataFrame: Columnas muestras, media y varianza por viaje
+                (NaN si ningún nivel tiene suficientes muestras).
+        """
+        resultado = pd.DataFrame(
+            np.nan, index=llaves.index,
+            columns=['muestras', 'media', 'varianza'])
+        suficientes = self.perfiles[
+            self.perfiles['muestras'] >= self.min_muestras]
+        for nivel in NIVELES:
+            faltantes = resultado['media'].isna()
+            if not faltantes.any():
+                break
+            consulta = llaves.loc[faltantes].copy()
+            for columna, vacio in (('celda', ''), ('dia', -1), ('hora', -1)):
+                if columna not in nivel:
+                    consulta[columna] = vacio
+            encontrados = consulta.reset_index().merge(
+                suficientes, on=['celda', 'dia', 'hora'], how='inner'
+            ).set_index('index')
+            resultado.loc[encontrados.index, ['muestras', 'media', 'varianza']] \
+                = encontrados[['muestras', 'media', 'varianza']]
+        return resultado
+
+    def estimar(self, inicios, fines, fechas_hora):
+        """
+        Estima la duración de varios viajes con límites de confianza.
+
+        Args:
+            inicios (array-like): Arreglo (N, 2) de coordenadas de inicio.
+            fines (array-like): Arreglo (N, 2) de coordenadas de fin.
+            fechas_hora (array-like): Hora de salida de cada viaje.
+
+        Returns:
+            pd.DataFrame: Una fila por viaje con DURACION, DURACION_MIN y
+                DURACION_MAX en segundos y MUESTRAS del perfil usado. Si no
+                hay perfil se usa VEL_LINEA_RECTA, sin límites (NaN).
+
+        Example:
+            modelo = obtener_modelo()
+            df_est = modelo.estimar(origenes, destinos, [salida] * len(origenes))
+            confiables = df_est['DURACION_MAX'] <= 45 * 60
+        """
+        inicios = np.asarray(inicios, dtype=float).reshape(-1, 2)
+        fines = np.asarray(fines, dtype=float).reshape(-1, 2)
+        fechas_hora = pd.DatetimeIndex(
+            np.broadcast_to(np.asarray(fechas_hora, dtype='datetime64[ns]'),
+                            (len(inicios),)))
+        distancia_km = distancias_fila(inicios, fines)
+        perfil = self._perfil(
+            llaves_perfil(inicios, fines, fechas_hora, self.precision))
+        media = perfil['media'].to_numpy(dtype=float)
+        muestras = perfil['muestras'].to_numpy(dtype=float)
+        # Desviación de predicción de un viaje nuevo
+        desviacion = np.maximum(
+            np.sqrt(perfil['varianza'].to_numpy(dtype=float)),
+            MIN_DESVIACION_LOG) * np.sqrt(1 + 1 / muestras)
+        sin_perfil = np.isnan(media)
+        media = np.where(sin_perfil, np.log(VEL_LINEA_RECTA), media)
+        duracion = distancia_km / np.exp(media) * 3600
+        return pd.DataFrame({
+            'DURACION': duracion,
+            'DURACION_MIN': distancia_km / np.exp(
+                media + Z_CONFIANZA * desviacion) * 3600,
+            'DURACION_MAX': distancia_km / np.exp(
+                media - Z_CONFIANZA * desviacion) * 3600,
+            'MUESTRAS': muestras,
+        })
+
+
+_modelo = None
+_modelo_lock = threading.Lock()
+
+
+def obtener_modelo():
+    """
+    Retorna el modelo de tiempos del proceso, cargado una sola vez desde
+        MODELO_TIEMPO_PATH.
+
+    Returns:
+        ModeloTiempo: Modelo compartido (vacío si aún no se ha entrenado).
+    """
+    global _modelo
+    with _modelo_lock:
+        if _modelo is None:
+            _modelo = ModeloTiempo()
+    return _modelo
+
+
+def entrenar_desde_cache(ruta_cache=CACHE_PATH, ruta_modelo=MODELO_TIEMPO_PATH):
+    """
+    Entrena el modelo con las respuestas del cache de rutas y lo guarda.
+
+    Args:
+        ruta_cache (str, opcional): Archivo del cache de rutas.
+        ruta_modelo (str, opcional): Archivo donde se guarda el modelo.
+
+    Returns:
+        ModeloTiempo: Modelo entrenado.
+
+    Example:
+        python -m apps.ruteo.modelo_tiempo
+    """
+    global _modelo
+    modelo = ModeloTiempo(ruta_modelo).entrenar(muestras_cache(ruta_cache))
+    modelo.guardar()
+    with _modelo_lock:
+        _modelo = modelo
+    return modelo
+
+
+if __name__ == '__main__':
+    modelo = entrenar_desde_cache()
+    print(f"Perfiles de velocidad: {len(modelo.perfiles)}")
@@ -53,8 +53,14 @@ LEFT JOIN public.general_localidad localidad_origen on upz_origen."Localidad_id"
 LEFT JOIN public.general_ciudad ciudad_origen on localidad_origen."Ciudad_id" = ciudad_origen.id
 LEFT JOIN public.general_departamento regional_origen on ciudad_origen."Departamento_id" = regional_origen.id 
 WHERE
-DATE(servicio."fechaServicio" AT TIME ZONE 'UTC' AT TIME ZONE 'America/Bogota') >= '{0}'
-AND DATE(servicio."fechaServicio" AT TIME ZONE 'UTC' AT TIME ZONE 'America/Bogota') <= '{1}'
+DATE(servicio."fechaServicio" AT TIME ZONE 'UTC' AT TIME ZONE 'America/Bogota') >= %(fecha_inicio)s
+AND DATE(servicio."fechaServicio" AT TIME ZONE 'UTC' AT TIME ZONE 'America/Bogota') <= %(fecha_final)s
 AND medio_id != 25 -- Medio de apoyo no rampa
-AND "tipoProcedimiento_id" in ({2})
-AND "estadoServicio_id" in (3, 4, 5, 6, 7, 8, 9, 21, 22, 23, 24)
\ No newline at end of file
+AND "tipoProcedimiento_id" = ANY(%(tipo_prod_list)s)
+AND "estadoServicio_id" in (3, 4, 5, 6, 7, 8, 9, 21, 22, 23, 24)
+AND (%(ciudad_origen)s::integer IS NULL OR ciudad_origen.id = %(ciudad_origen)s)
+AND (%(ciudad_destino)s::integer IS NULL OR ciudad_destino.id = %(ciudad_destino)s)
+AND (%(regional_origen)s::integer IS NULL OR ciudad_origen."Departamento_id" = %(regional_origen)s)
+AND (%(regional_destino)s::integer IS NULL OR ciudad_destino."Departamento_id" = %(regional_destino)s)
+AND (%(detalle)s::boolean IS NULL OR servicio.detalle = %(detalle)s)
+ORDER BY fecha_servicio
\ No newline at end of file
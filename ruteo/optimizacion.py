@@ -0,0 +1,377 @@
+"""
+    optimizacion.py
+"""
+import numpy as np
+from apps.ruteo.constantes import VRP_CAPACIDAD, VRP_COSTO_VEHICULO
+
+# Mejora mínima en segundos para aceptar un movimiento de la búsqueda local
+EPSILON = 1e-6
+# Tiempo que reemplaza a los tramos sin ruta (infinitos) al ordenar paradas
+TIEMPO_SIN_RUTA = 1e9
+# Máximo de waypoints que se ordenan de forma exacta (2^n * n^2 operaciones)
+MAX_WAYPOINTS_EXACTO = 8
+
+
+def vecino_mas_cercano(tiempos):
+    """
+    Construye un camino abierto del primer al último punto de `tiempos`
+        visitando los demás con la heurística del vecino más cercano.
+
+    Args:
+        tiempos (np.ndarray): Matriz (n, n) de tiempos entre puntos.
+
+    Returns:
+        list: Índices de los puntos en orden de visita, de 0 a n - 1.
+    """
+    pendientes = list(range(1, len(tiempos) - 1))
+    camino = [0]
+    while pendientes:
+        actual = camino[-1]
+        siguiente = min(pendientes, key=lambda punto: tiempos[actual, punto])
+        pendientes.remove(siguiente)
+        camino.append(siguiente)
+    camino.append(len(tiempos) - 1)
+    return camino
+
+
+def _dos_opt(camino, tiempos):
+    # Invierte el tramo camino[i:j + 1]; con tiempos asimétricos el costo
+    # del tramo invertido se obtiene de las sumas acumuladas en reversa
+    paradas = np.asarray(camino)
+    ida = np.concatenate([[0], np.cumsum(tiempos[paradas[:-1], paradas[1:]])])
+    vuelta = np.concatenate(
+        [[0], np.cumsum(tiempos[paradas[1:], paradas[:-1]])])
+    for i in range(1, len(camino) - 2):
+        for j in range(i + 1, len(camino) - 1):
+            anterior, siguiente = camino[i - 1], camino[j + 1]
+            delta = tiempos[anterior, camino[j]] + \
+                tiempos[camino[i], siguiente] - \
+                tiempos[anterior, camino[i]] - tiempos[camino[j], siguiente] + \
+                (vuelta[j] - vuelta[i]) - (ida[j] - ida[i])
+            if delta < -EPSILON:
+                camino[i:j + 1] = camino[i:j + 1][::-1]
+                return True
+    return False
+
+
+def _or_opt(camino, tiempos, max_segmento=3):
+    # Mueve un segmento de hasta `max_segmento` paradas a otra posición
+    for largo in range(1, max_segmento + 1):
+        for i in range(1, len(camino) - largo):
+            segmento = camino[i:i + largo]
+            resto = camino[:i] + camino[i + largo:]
+            ahorro = tiempos[camino[i - 1], segmento[0]] + \
+                tiempos[segmento[-1], camino[i + largo]] - \
+                tiempos[camino[i - 1], camino[i + largo]]
+            for k in range(1, len(resto)):
+                if k == i:
+                    continue
+                delta = tiempos[resto[k - 1], segmento[0]] + \
+                    tiempos[segmento[-1], resto[k]] - \
+                    tiempos[resto[k - 1], resto[k]] - ahorro
+                if delta < -EPSILON:
+                    camino[:] = resto[:k] + segmento + resto[k:]
+                    return True
+    return False
+
+
+def _orden_exacto(tiempos):
+    # Programación dinámica de Held-Karp sobre el camino abierto: costo[m, k]
+    # es el menor tiempo desde el origen visitando los waypoints de la
+    # máscara m y terminando en el waypoint k
+    n_waypoints = len(tiempos) - 2
+    entre = tiempos[1:-1, 1:-1]
+    completa = (1 << n_waypoints) - 1
+    costo = np.full((completa + 1, n_waypoints), np.inf)
+    previo = np.full((completa + 1, n_waypoints), -1, dtype=int)
+    for k in range(n_waypoints):
+        costo[1 << k, k] = tiempos[0, k + 1]
+    for mascara in range(1, completa + 1):
+        for k in range(n_waypoints):
+            anterior = mascara ^ (1 << k)
+            if not mascara & (1 << k) or not anterior:
+                continue
+            valores = costo[anterior] + entre[:, k]
+            previo[mascara, k] = int(np.argmin(valores))
+            costo[mascara, k] = valores[previo[mascara, k]]
+    ultimo = int(np.argmin(costo[completa] + tiempos[1:-1, -1]))
+    orden, mascara = [], completa
+    while ultimo >= 0:
+        orden.append(ultimo)
+        mascara, ultimo = mascara ^ (1 << ultimo), previo[mascara, ultimo]
+    return orden[::-1]
+
+
+def ordenar_waypoints(tiempos, max_iteraciones=1000):
+    """
+    Ordena los waypoints de una ruta abierta con origen y destino fijos.
+
+    Con hasta MAX_WAYPOINTS_EXACTO waypoints el orden es el óptimo
+    (programación dinámica de Held-Karp). Con más, se construye con el
+    vecino más cercano y se mejora con movimientos 2-opt y Or-opt hasta
+    que ninguno reduce la duración. Es el reemplazo local de
+    `optimize_waypoints` de la API de Directions.
+
+    Args:
+        tiempos (np.ndarray): Matriz (n, n) de tiempos entre puntos, donde
+            el índice 0 es el origen, el último el destino y los demás los
+            waypoints en su orden original.
+        max_iteraciones (int, opcional): Límite de movimientos aplicados.
+
+    Returns:
+        list: Orden de visita de los waypoints con la misma forma que
+            `waypoint_order` de Google (índices desde 0).
+
+    Ejemplo:
+        puntos = [origen, *waypoints, destino]
+        orden = ordenar_waypoints(calcular_matriz(puntos, puntos))
+        waypoints = [waypoints[i] for i in orden]
+    """
+    tiempos = np.nan_to_num(
+        np.asarray(tiempos, dtype=float), nan=TIEMPO_SIN_RUTA,
+        posinf=TIEMPO_SIN_RUTA)
+    if len(tiempos) <= 3:
+        return list(range(max(len(tiempos) - 2, 0)))
+    if len(tiempos) - 2 <= MAX_WAYPOINTS_EXACTO:
+        return _orden_exacto(tiempos)
+    camino = vecino_mas_cercano(tiempos)
+    for _ in range(max_iteraciones):
+        if not (_dos_opt(camino, tiempos) or _or_opt(camino, tiempos)):
+            break
+    return [punto - 1 for punto in camino[1:-1]]
+
+
+def barrido_angular(puntos, centro, max_tamano, inicio=None):
+    """
+    Divide puntos en grupos espacialmente coherentes por barrido angular
+        alrededor de un centro.
+
+    Los puntos se ordenan por su ángulo respecto al `centro` y se cortan en
+    el menor número de grupos contiguos de a lo sumo `max_tamano` puntos,
+    de tamaños balanceados. El barrido empieza en el punto `inicio` o, si
+    no se indica, en el mayor hueco angular entre puntos.
+
+    Args:
+        puntos (array-like): Coordenadas (latitud, longitud).
+        centro (tuple): Coordenadas (latitud, longitud) del centro, por
+            ejemplo el destino común de una ruta.
+        max_tamano (int): Número máximo de puntos por grupo.
+        inicio (int, opcional): Índice del punto que abre el primer grupo.
+
+    Returns:
+        list: Grupos como listas de índices de `puntos`, en orden de barrido.
+
+    Ejemplo:
+        grupos = barrido_angular(origenes, destino, 26, inicio=0)
+    """
+    puntos = np.asarray(puntos, dtype=float).reshape(-1, 2)
+    if not len(puntos):
+        return []
+    latitud, longitud = float(centro[0]), float(centro[1])
+    angulos = np.arctan2(
+        puntos[:, 0] - latitud,
+        (puntos[:, 1] - longitud) * np.cos(np.radians(latitud)))
+    if inicio is None:
+        ordenados = np.sort(angulos)
+        huecos = np.diff(np.append(ordenados, ordenados[0] + 2 * np.pi))
+        referencia = ordenados[(np.argmax(huecos) + 1) % len(ordenados)]
+    else:
+        referencia = angulos[inicio]
+    relativos = np.mod(angulos - referencia, 2 * np.pi)
+    if inicio is not None:
+        relativos[inicio] = -1
+    orden = np.argsort(relativos, kind='stable')
+    n_grupos = int(np.ceil(len(puntos) / max_tamano))
+    return [grupo.tolist() for grupo in np.array_split(orden, n_grupos)]
+
+
+class ProblemaRutas:
+    """
+    Problema de rutas de vehículos abiertas hacia un destino común.
+
+    Cada vehículo inicia en la recogida de su primer pasajero, recoge a los
+    demás en orden y termina en el destino. Una ruta es factible si no
+    supera la capacidad del vehículo, si su duración (el viaje del primer
+    pasajero) no supera `max_duracion` y si ningún pasajero espera en el
+    destino más de `max_espera` respecto a la hora de servicio más temprana
+    de la ruta, que es la hora de llegada del vehículo (ventana de tiempo).
+
+    El costo de una ruta es su duración más `costo_vehiculo`, de modo que
+    el solucionador prefiere menos vehículos y más llenos.
+
+    Args:
+        tiempos (np.ndarray): Matriz (n + 1) x (n + 1) de tiempos de viaje
+            en segundos; los n primeros índices son las recogidas y el
+            último es el destino.
+        horas (np.ndarray, opcional): Hora de servicio de cada pasajero en
+            segundos (cualquier referencia común).
+        demandas (np.ndarray, opcional): Cupos que ocupa cada recogida; por
+            defecto 1.
+        capacidad (int, opcional): Cupos por vehículo.
+        max_duracion (float, opcional): Duración máxima de una ruta en segundos.
+        max_espera (float, opcional): Espera máxima en el destino en segundos.
+        costo_vehiculo (float, opcional): Costo fijo de cada vehículo en segundos.
+
+    Ejemplo:
+        problema = ProblemaRutas(tiempos, horas, max_duracion=1800)
+        rutas = problema.resolver()  # [[3, 0, 1], [2], ...]
+    """
+
+    def __init__(self, tiempos, horas=None, demandas=None,
+                 capacidad=VRP_CAPACIDAD, max_duracion=np.inf,
+                 max_espera=np.inf, costo_vehiculo=VRP_COSTO_VEHICULO):
+        self.tiempos = np.asarray(tiempos, dtype=float)
+        self.destino = len(self.tiempos) - 1
+        n_pasajeros = self.destino
+        self.horas = np.zeros(n_pasajeros) if horas is None else \
+            np.asarray(horas, dtype=float)
+        self.demandas = np.ones(n_pasajeros) if demandas is None else \
+            np.asarray(demandas, dtype=float)
+        self.capacidad = capacidad
+        self.max_duracion = max_duracion
+        self.max_espera = max_espera
+        self.costo_vehiculo = costo_vehiculo
+
+    def duracion(self, ruta):
+        """Segundos desde la primera recogida de `ruta` hasta el destino."""
+        paradas = np.append(np.asarray(ruta, dtype=int), self.destino)
+        return self.tiempos[paradas[:-1], paradas[1:]].sum()
+
+    def costo(self, ruta):
+        """Costo de `ruta`: duración más costo fijo; 0 si está vacía."""
+        if not len(ruta):
+            return 0.0
+        return self.costo_vehiculo + self.duracion(ruta)
+
+    def factible(self, ruta):
+        """
+        Indica si `ruta` cumple capacidad, ventana de tiempo y duración.
+
+        Una ruta de un solo pasajero siempre es factible: es el viaje
+        directo, aunque supere la duración máxima.
+        """
+        if len(ruta) <= 1:
+            return True
+        horas = self.horas[ruta]
+        return bool(self.demandas[ruta].sum() <= self.capacidad and
+                    horas.max() - horas.min() <= self.max_espera and
+                    self.duracion(ruta) <= self.max_duracion)
+
+    def ahorros(self):
+        """
+        Construye rutas con el algoritmo de ahorros de Clarke y Wright.
+
+        Parte de una ruta por pasajero y une la ruta que termina en `a` con
+        la que empieza en `b` en orden decreciente del ahorro
+        costo_vehiculo + t(a, destino) - t(a, b), siempre que la unión sea
+        factible.
+
+        Returns:
+            list: Rutas como listas de índices de recogida.
+        """
+        n_pasajeros = self.destino
+        tiempos = self.tiempos[:n_pasajeros, :n_pasajeros]
+        a_destino = self.tiempos[:n_pasajeros, self.destino]
+        ahorro = self.costo_vehiculo + a_destino[:, None] - tiempos
+        # Pares que no pueden compartir vehículo en ningún caso
+        posibles = (ahorro > 0) & \
+            (self.demandas[:, None] + self.demandas <= self.capacidad) & \
+            (np.abs(self.horas[:, None] - self.horas) <= self.max_espera) & \
+            (tiempos + a_destino <= self.max_duracion)
+        np.fill_diagonal(posibles, False)
+        origenes, siguientes = np.nonzero(posibles)
+        orden = np.argsort(-ahorro[origenes, siguientes], kind='stable')
+        rutas = [[i] for i in range(n_pasajeros)]
+        ruta_de = list(range(n_pasajeros))
+        for fin, inicio in zip(origenes[orden], siguientes[orden]):
+            r_fin, r_inicio = ruta_de[fin], ruta_de[inicio]
+            if r_fin == r_inicio or rutas[r_fin][-1] != fin or \
+                    rutas[r_inicio][0] != inicio:
+                continue
+            unida = rutas[r_fin] + rutas[r_inicio]
+            if not self.factible(unida):
+                continue
+            for pasajero in rutas[r_inicio]:
+                ruta_de[pasajero] = r_fin
+            rutas[r_fin], rutas[r_inicio] = unida, []
+        return [ruta for ruta in rutas if ruta]
+
+    def _reubicar(self, rutas, costos):
+        # Mueve un pasajero a otra posición de su ruta o de otra ruta
+        for i, ruta in enumerate(rutas):
+            for posicion, pasajero in enumerate(ruta):
+                resto = ruta[:posicion] + ruta[posicion + 1:]
+                costo_resto = self.costo(resto)
+                for j, base in enumerate(rutas):
+                    if not base:
+                        continue
+                    misma = i == j
+                    if misma:
+                        base = resto
+                    for destino in range(len(base) + 1):
+                        nueva = base[:destino] + [pasajero] + base[destino:]
+                        if misma:
+                            delta = self.costo(nueva) - costos[i]
+                        else:
+                            delta = costo_resto + self.costo(nueva) - \
+                                costos[i] - costos[j]
+                        if delta >= -EPSILON or not self.factible(nueva):
+                            continue
+                        if misma:
+                            rutas[i], costos[i] = nueva, costos[i] + delta
+                        else:
+                            if not self.factible(resto):
+                                continue
+                            rutas[i], costos[i] = resto, costo_resto
+                            rutas[j], costos[j] = nueva, self.costo(nueva)
+                        return True
+        return False
+
+    def _intercambiar(self, rutas, costos):
+        # Intercambia dos pasajeros de rutas distintas
+        for i in range(len(rutas)):
+            for j in range(i + 1, len(rutas)):
+                for p, pasajero_i in enumerate(rutas[i]):
+                    for q, pasajero_j in enumerate(rutas[j]):
+                        nueva_i = rutas[i][:p] + [pasajero_j] + rutas[i][p + 1:]
+                        nueva_j = rutas[j][:q] + [pasajero_i] + rutas[j][q + 1:]
+                        costo_i, costo_j = self.costo(nueva_i), self.costo(nueva_j)
+                        if costo_i + costo_j - costos[i] - costos[j] >= -EPSILON:
+                            continue
+                        if self.factible(nueva_i) and self.factible(nueva_j):
+                            rutas[i], costos[i] = nueva_i, costo_i
+                            rutas[j], costos[j] = nueva_j, costo_j
+                            return True
+        return False
+
+    def busqueda_local(self, rutas, max_movimientos=1000):
+        """
+        Mejora un conjunto de rutas con movimientos de reubicación e
+            intercambio de pasajeros, aplicando la primera mejora encontrada.
+
+        Args:
+            rutas (list): Rutas factibles como listas de índices de recogida.
+            max_movimientos (int, opcional): Límite de movimientos aplicados.
+
+        Returns:
+            list: Rutas mejoradas, sin rutas vacías.
+        """
+        rutas = [list(ruta) for ruta in rutas]
+        costos = [self.costo(ruta) for ruta in rutas]
+        for _ in range(max_movimientos):
+            if not (self._reubicar(rutas, costos) or
+                    self._intercambiar(rutas, costos)):
+                break
+        return [ruta for ruta in rutas if ruta]
+
+    def resolver(self, max_movimientos=1000):
+        """
+        Resuelve el problema: construcción por ahorros y búsqueda local.
+
+        Returns:
+            list: Rutas como listas de índices de recogida, en orden de
+                recogida.
+        """
+        if self.destino <= 0:
+            return []
+        return self.busqueda_local(self.ahorros(), max_movimientos)
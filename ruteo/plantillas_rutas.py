@@ -0,0 +1,259 @@
+"""
+    plantillas_rutas.py
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+from apps.ruteo.constantes import (
+    PLANTILLAS_PATH, PLANTILLAS_JACCARD, PLANTILLAS_MINUTOS_FRANJA,
+    PLANTILLAS_PRECISION)
+from apps.ruteo.geo import geohash
+
+# Número máximo de plantillas comparadas en una búsqueda aproximada
+MAX_CANDIDATOS = 50
+
+
+def pasajeros_grupo(df_ruta, precision=PLANTILLAS_PRECISION):
+    """
+    Identifica a cada pasajero de un grupo por su IDENTIFICACION_USUARIO y
+        la celda geohash de su origen.
+
+    Un pasajero recogido en otra dirección es otro pasajero para las
+    plantillas: su ruta y orden anteriores no garantizan la distancia
+    máxima a la ruta ni la duración del viaje.
+
+    Args:
+        df_ruta (pd.DataFrame): Pasajeros del grupo.
+        precision (int, opcional): Caracteres del geohash del origen.
+
+    Returns:
+        list of str: '<identificación>@<geohash>' de cada pasajero, en el
+            orden de `df_ruta`.
+    """
+    origenes = geohash(df_ruta['LATITUD_ORIGEN'].to_numpy(dtype=float),
+                       df_ruta['LONGITUD_ORIGEN'].to_numpy(dtype=float),
+                       precision)
+    return [f"{pasajero}@{origen}" for pasajero, origen in zip(
+        df_ruta['IDENTIFICACION_USUARIO'].astype(str), origenes)]
+
+
+def huella_grupo(df_ruta, precision=PLANTILLAS_PRECISION,
+                 minutos_franja=PLANTILLAS_MINUTOS_FRANJA):
+    """
+    Calcula la huella de un grupo de RUTA_INICIAL.
+
+    La huella combina el conjunto de pasajeros con sus orígenes (ver
+    pasajeros_grupo), la celda geohash del destino y la franja de la hora
+    de servicio más tardía del grupo, de modo que el mismo grupo en otro
+    día tiene la misma huella.
+
+    Args:
+        df_ruta (pd.DataFrame): Pasajeros del grupo.
+        precision (int, opcional): Caracteres del geohash del origen y
+            del destino.
+        minutos_franja (int, opcional): Tamaño de la franja horaria.
+
+    Returns:
+        tuple: Huella (str), celda del destino (str), franja 'HH:MM' (str)
+            y pasajeros ordenados (list of str).
+    """
+    pasajeros = sorted(pasajeros_grupo(df_ruta, precision))
+    destino = geohash(df_ruta['LATITUD_DESTINO'].iat[0],
+                      df_ruta['LONGITUD_DESTINO'].iat[0], precision)[0]
+    hora = df_ruta['HORA_SERVICIO_C'].max()
+    minutos = (hora.hour * 60 + hora.minute) // minutos_franja * minutos_franja
+    franja = f"{minutos // 60:02d}:{minutos % 60:02d}"
+    huella = hashlib.sha1("|".join(
+        [";".join(pasajeros), destino, franja]).encode()).hexdigest()
+    return huella, destino, franja, pasajeros
+
+
+def jaccard(a, b):
+    """Índice de Jaccard entre dos conjuntos."""
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class PlantillasRutas:
+    """
+    Almacén en SQLite de plantillas de rutas finales de grupos recurrentes.
+
+    Una plantilla guarda, para cada pasajero de un grupo de RUTA_INICIAL,
+    el número de su ruta final y su orden de recogida. Un grupo de otro
+    día (o de otra ejecución) con la misma huella, o con los mismos
+    destino y franja, pasajeros contenidos en los de la plantilla y un
+    índice de Jaccard de al menos `umbral`, reutiliza la plantilla sin
+    solicitudes de rutas. Un grupo con pasajeros nuevos o recogidos en
+    otro origen se recalcula: la plantilla no garantiza para ellos la
+    distancia máxima a la ruta, la capacidad ni las ventanas de tiempo.
+
+    Args:
+        ruta (str): Ruta del archivo SQLite.
+        umbral (float): Jaccard mínimo para reutilizar una plantilla similar.
+
+    Attributes:
+        conn (sqlite3.Connection): Conexión al archivo de plantillas.
+    """
+
+    def __init__(self, ruta=PLANTILLAS_PATH, umbral=PLANTILLAS_JACCARD):
+        self.umbral = umbral
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            ruta, timeout=30, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS plantillas ("
+                "huella TEXT NOT NULL, parametros TEXT NOT NULL, "
+                "destino TEXT NOT NULL, franja TEXT NOT NULL, "
+                "pasajeros TEXT NOT NULL, asignacion TEXT NOT NULL, "
+                "usos INTEGER NOT NULL, actualizado REAL NOT NULL, "
+                "PRIMARY KEY (huella, parametros))")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_plantillas_zona "
+                "ON plantillas (parametros, destino, franja)")
+
+    def buscar(self, clave, parametros):
+        """
+        Busca la plantilla de un grupo, exacta o similar.
+
+        Args:
+            clave (tuple): Resultado de huella_grupo.
+            parametros (str): Llave de estado_rutas.clave_parametros.
+
+        Returns:
+            dict or None: Ruta final y orden de recogida por pasajero, o
+                None si no hay plantilla reutilizable.
+        """
+        huella, destino, franja, pasajeros = clave
+        with self._lock:
+            fila = self.conn.execute(
+                "SELECT huella, asignacion FROM plantillas "
+                "WHERE huella = ? AND parametros = ?",
+                (huella, parametros)).fetchone()
+            if fila is None and self.umbral < 1:
+                candidatos = self.conn.execute(
+                    "SELECT huella, asignacion, pasajeros FROM plantillas "
+                    "WHERE parametros = ? AND destino = ? AND franja = ? "
+                    "ORDER BY actualizado DESC LIMIT ?",
+                    (parametros, destino, franja, MAX_CANDIDATOS)).fetchall()
+                # Solo plantillas que contienen a todos los pasajeros
+                similitudes = [
+                    jaccard(pasajeros, anteriores)
+                    if set(pasajeros) <= set(anteriores) else 0.0
+                    for anteriores in (json.loads(candidato[2])
+                                       for candidato in candidatos)]
+                if similitudes and max(similitudes) >= self.umbral:
+                    fila = candidatos[int(np.argmax(similitudes))][:2]
+            if fila is None:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE plantillas SET usos = usos + 1, actualizado = ? "
+                    "WHERE huella = ? AND parametros = ?",
+                    (time.time(), fila[0], parametros))
+        return json.loads(fila[1])
+
+    def guardar(self, clave, parametros, df_ruta, etiquetas, orden=None):
+        """
+        Guarda la plantilla de un grupo recién calculado.
+
+        Args:
+            clave (tuple): Resultado de huella_grupo.
+            parametros (str): Llave de estado_rutas.clave_parametros.
+            df_ruta (pd.DataFrame): Pasajeros del grupo.
+            etiquetas (pd.Series): RUTA_FINAL por pasajero ('<grupo>_<n>'),
+                con el índice de `df_ruta`; los pasajeros sin etiqueta se
+                guardan sin ruta.
+            orden (pd.Series, opcional): ORDEN_RECOGIDA por pasajero.
+        """
+        huella, destino, franja, pasajeros = clave
+        if len(set(pasajeros)) != len(pasajeros):
+            # Un pasajero repetido no se puede identificar en la plantilla
+            return
+        etiquetas = etiquetas.reindex(df_ruta.index)
+        orden = pd.Series(np.nan, index=df_ruta.index) if orden is None \
+            else orden.reindex(df_ruta.index)
+        asignacion = {
+            pasajero: [
+                etiqueta.split('_', 1)[1] if isinstance(etiqueta, str)
+                else None,
+                None if pd.isna(posicion) else int(posicion)]
+            for pasajero, etiqueta, posicion in zip(
+                pasajeros_grupo(df_ruta), etiquetas, orden)}
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO plantillas (huella, parametros, "
+                "destino, franja, pasajeros, asignacion, usos, actualizado) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+                (huella, parametros, destino, franja, json.dumps(pasajeros),
+                 json.dumps(asignacion), time.time()))
+
+    def eliminar(self):
+        """Elimina todas las plantillas."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM plantillas")
+
+
+_plantillas = None
+_plantillas_pid = None
+_plantillas_lock = threading.Lock()
+
+
+def obtener_plantillas():
+    """
+    Retorna la instancia compartida del almacén de plantillas del proceso.
+
+    Returns:
+        PlantillasRutas: Almacén compartido.
+    """
+    global _plantillas, _plantillas_pid
+    with _plantillas_lock:
+        # Las conexiones SQLite no se comparten entre procesos
+        if _plantillas is None or _plantillas_pid != os.getpid():
+            _plantillas = PlantillasRutas()
+            _plantillas_pid = os.getpid()
+    return _plantillas
+
+
+def aplicar_plantilla(valor, df_ruta, asignacion):
+    """
+    Asigna RUTA_FINAL y ORDEN_RECOGIDA a un grupo a partir de una plantilla.
+
+    Los pasajeros conservan su ruta y orden de la plantilla (o quedan sin
+    ruta, como en ella); PlantillasRutas.buscar solo retorna plantillas
+    que contienen a todos los pasajeros del grupo. Los órdenes se
+    renumeran dentro de cada ruta, sin los pasajeros ausentes.
+
+    Args:
+        valor (int): Valor de RUTA_INICIAL del grupo.
+        df_ruta (pd.DataFrame): Pasajeros del grupo.
+        asignacion (dict): Plantilla retornada por PlantillasRutas.buscar.
+
+    Returns:
+        tuple:
+            pd.Series: Etiqueta RUTA_FINAL de cada pasajero, con el índice
+                de `df_ruta` (NaN si la plantilla no lo asignaba).
+            pd.Series: ORDEN_RECOGIDA entero de cada pasajero, como el de
+                los motores; de tipo Int64 con NA si la plantilla no tiene
+                orden para algún pasajero.
+    """
+    pasajeros = pasajeros_grupo(df_ruta)
+    rutas = [asignacion[pasajero][0] for pasajero in pasajeros]
+    orden = np.array([
+        np.nan if asignacion[pasajero][1] is None else asignacion[pasajero][1]
+        for pasajero in pasajeros], dtype=float)
+    etiquetas = pd.Series(
+        [None if ruta is None else f"{str(valor)}_{ruta}" for ruta in rutas],
+        index=df_ruta.index, dtype=object)
+    orden = pd.Series(orden, index=df_ruta.index)
+    orden = orden.groupby(etiquetas).rank(method='first').reindex(
+        df_ruta.index)
+    # rank retorna float; los motores retornan enteros
+    orden = orden.astype('Int64') if orden.isna().any() else orden.astype(int)
+    return etiquetas, orden
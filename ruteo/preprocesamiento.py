@@ -4,7 +4,13 @@
 import numpy as np
 import pandas as pd
 from sklearn.cluster import DBSCAN
-from sklearn.metrics.pairwise import haversine_distances
+from apps.ruteo.decoradores import etapa
+
+# Columnas que usa el ruteo; las demás solo se exportan
+COLUMNAS_RUTEO = ['SERVICIO_ID', 'IDENTIFICACION_USUARIO', 'FECHA_SERVICIO',
+                  'HORA_SERVICIO', 'DETALLE_SERVICIO', 'CIUDAD_DESTINO',
+                  'LATITUD_ORIGEN', 'LONGITUD_ORIGEN', 'LATITUD_DESTINO',
+                  'LONGITUD_DESTINO']
 
 def obtener_pasajeros_ruta(df_servicios, servicio=0):
     """
@@ -31,15 +37,18 @@ def obtener_pasajeros_ruta(df_servicios, servicio=0):
     """
     tipo_servicio = 'ida' if servicio == 0 else 'retorno'
     validator = df_servicios['DETALLE_SERVICIO'].str.lower() == tipo_servicio
-    pasajeros_por_tipo = df_servicios[validator].copy()
-    # Se limpian los datos de coordenadas para ser omitidos más adelante
-    validator = pasajeros_por_tipo['LATITUD_ORIGEN'] == ''
-    pasajeros_por_tipo.loc[validator, 'LATITUD_ORIGEN'] = None
-    validator = pasajeros_por_tipo['LATITUD_DESTINO'] == ''
-    pasajeros_por_tipo.loc[validator, 'LATITUD_DESTINO'] = None
+    # take copia las filas una sola vez, sin el .copy() de un filtro booleano
+    pasajeros_por_tipo = df_servicios.take(np.flatnonzero(validator.to_numpy()))
+    # Se limpian los datos de coordenadas para ser omitidos más adelante;
+    # las coordenadas ya tipadas (conexion.tipar_columnas) traen NaN
+    for columna in ['LATITUD_ORIGEN', 'LATITUD_DESTINO']:
+        if not pd.api.types.is_numeric_dtype(pasajeros_por_tipo[columna]):
+            validator = pasajeros_por_tipo[columna] == ''
+            pasajeros_por_tipo.loc[validator, columna] = None
     return pasajeros_por_tipo
 
 
+@etapa
 def formato_dataframe(df_pasajeros):
     """
     Realiza el preprocesamiento básico de un DataFrame
@@ -65,15 +74,16 @@ def formato_dataframe(df_pasajeros):
     df_faltantes = df_pasajeros[validator_empty].copy()
     # Se eliminan estos pasajeros:
     df_pasajeros.dropna(subset=['LATITUD_ORIGEN', 'LATITUD_DESTINO'], inplace=True)
-    # Convertir las columnas de coordenadas a tipo float
+    # Convertir las columnas de coordenadas a tipo float (sin copiar las
+    # que ya lo son)
     df_pasajeros['LATITUD_ORIGEN'] = df_pasajeros[
-        'LATITUD_ORIGEN'].astype(float)
+        'LATITUD_ORIGEN'].astype(float, copy=False)
     df_pasajeros['LONGITUD_ORIGEN'] = df_pasajeros[
-        'LONGITUD_ORIGEN'].astype(float)
+        'LONGITUD_ORIGEN'].astype(float, copy=False)
     df_pasajeros['LATITUD_DESTINO'] = df_pasajeros[
-        'LATITUD_DESTINO'].astype(float)
+        'LATITUD_DESTINO'].astype(float, copy=False)
     df_pasajeros['LONGITUD_DESTINO'] = df_pasajeros[
-        'LONGITUD_DESTINO'].astype(float)
+        'LONGITUD_DESTINO'].astype(float, copy=False)
 
     # Convertir la columna 'HORA_SERVICIO' a formato datetime
     df_pasajeros['HORA_SERVICIO_C'] = pd.to_datetime(
@@ -85,12 +95,17 @@ def formato_dataframe(df_pasajeros):
     return df_pasajeros, df_faltantes
 
 
+@etapa
 def agrupar_por_destinos(df_pasajeros):
     """
     Realiza la agrupación de coordenadas por destinos cercanos,
     en dado caso de que las coordenadas en el mismo destino varien un 
     poco (100 metros).
 
+    Los destinos repetidos se agrupan una sola vez y los vecinos se buscan
+    con un BallTree haversine, de modo que la memoria depende del número de
+    vecinos dentro del radio y no de una matriz de distancias N x N.
+
     Args:
         df_pasajeros (pd.DataFrame): DataFrame que contiene las
             coordenadas de destino.
@@ -99,76 +114,144 @@ def agrupar_por_destinos(df_pasajeros):
             asignadas a cada punto.
     """
     # Seleccionar las columnas de LATITUD_DESTINO y LONGITUD_DESTINO
-    destinos = df_pasajeros[['LATITUD_DESTINO', 'LONGITUD_DESTINO']]
+    destinos = pd.MultiIndex.from_arrays([
+        df_pasajeros['LATITUD_DESTINO'], df_pasajeros['LONGITUD_DESTINO']])
+    # Destinos únicos en orden de aparición, para conservar la numeración
+    # de las etiquetas
+    indices, destinos_unicos = pd.factorize(destinos)
+    if len(destinos_unicos) == 0:
+        return np.array([], dtype=np.int32)
     # Convertir las coordenadas a radianes
-    destinos_rad = np.radians(destinos.to_numpy())
-    # Calcular la matriz de distancias utilizando la fórmula de Haversine
-    distancias = haversine_distances(destinos_rad) * 6371000  # Radio de la Tierra en metros
+    destinos_rad = np.radians(np.array(destinos_unicos.tolist(), dtype=float))
     # Aplicar el algoritmo de DBSCAN
+    radio_tierra = 6371000  # Radio de la Tierra en metros
     epsilon = 100  # Umbral de distancia para considerar puntos vecinos (100 metros)
     min_samples = 1  # Número mínimo de puntos para formar un grupo
-    dbscan = DBSCAN(eps=epsilon, min_samples=min_samples, metric='precomputed')
-    labels = dbscan.fit_predict(distancias)
-    return labels
+    dbscan = DBSCAN(eps=epsilon / radio_tierra, min_samples=min_samples,
+                    metric='haversine', algorithm='ball_tree')
+    labels = dbscan.fit_predict(destinos_rad).astype(np.int32)
+    return labels[indices]
 
 
-def agrupar_por_horas(df_pasajeros):
+@etapa
+def agrupar_por_horas(df_pasajeros, max_mins=10):
     """
         Asigna grupos de horas a un DataFrame según la diferencia
         de tiempo entre registros.
 
+        Un registro inicia un nuevo grupo cuando su hora difiere en más de
+        `max_mins` minutos (en valor absoluto) de la hora del primer registro
+        del grupo actual. El recorrido se hace sobre un arreglo de enteros
+        en lugar de filas del DataFrame.
+
     Args:
         df_pasajeros (pd.DataFrame): DataFrame con las columnas 'HORA_SERVICIO_C'
             que contienen la hora de servicio.
+        max_mins (int, opcional): Diferencia máxima en minutos dentro de
+            un mismo grupo.
 
     Retorna:
-        pd.DataFrame: DataFrame con una nueva columna 'GRUPO_HORA'
+        pd.DataFrame: DataFrame con una nueva columna entera 'GRUPO_HORA'
             que indica el grupo de hora asignado.
     """
+    horas = df_pasajeros['HORA_SERVICIO_C'].to_numpy(dtype='datetime64[ns]')
+    horas = horas.astype(np.int64).tolist()
+    max_diff = pd.Timedelta(minutes=max_mins).value
+    grupos = np.zeros(len(horas), dtype=np.int32)
     ruta = 0
-    max_mins = 10
-    df_pasajeros['GRUPO_HORA'] = None
-    hora = df_pasajeros.loc[0, 'HORA_SERVICIO_C']
-    for indice, row in df_pasajeros.iterrows():
-        hora_actual = row['HORA_SERVICIO_C']
-        diff_hora = hora_actual - hora
-        # Si la diferencia de tiempo es negativa, convertirla a positiva
-        if diff_hora < pd.Timedelta(0):
-            diff_hora = hora - hora_actual
+    hora = horas[0] if horas else 0
+    for indice, hora_actual in enumerate(horas):
         # Si la diferencia de tiempo es mayor a max_mins, se inicia un nuevo grupo
-        if diff_hora > pd.Timedelta(minutes=max_mins):
+        if abs(hora_actual - hora) > max_diff:
             hora = hora_actual
             ruta += 1
-        df_pasajeros.loc[indice, 'GRUPO_HORA'] = ruta
-
+        grupos[indice] = ruta
+    df_pasajeros['GRUPO_HORA'] = grupos
     return df_pasajeros
 
 
+@etapa
 def obtener_ruta_previa(df_pasajeros):
     """
     Asigna rutas previas a un DataFrame en función de los
         grupos de hora y destino.
 
+    Cada cambio de la pareja ('GRUPO_HORA', 'GRUPO_DESTINO') respecto a la
+    fila anterior inicia una nueva ruta; la primera fila se compara contra
+    la pareja (0, 0).
+
     Args:
         df_pasajeros (pd.DataFrame): DataFrame con columnas 'GRUPO_HORA'
             y 'GRUPO_DESTINO' que representan los grupos.
 
     Returns:
-        - pd.DataFrame: DataFrame con una nueva columna 'RUTA_PREVIA'
+        - pd.DataFrame: DataFrame con una nueva columna entera 'RUTA_PREVIA'
             que indica la ruta previa asignada.
     """
-    ruta = 0
-    grupo_hora = 0
-    grupo_destino = 0
-    df_pasajeros['RUTA_PREVIA'] = None
-    for indice, row in df_pasajeros.iterrows():
-        hora_actual = row['GRUPO_HORA']
-        destino_actual = row['GRUPO_DESTINO']
-        val_1 = grupo_hora == hora_actual
-        val_2 = grupo_destino == destino_actual
-        if not (val_1 and val_2):
-            ruta += 1
-        df_pasajeros.loc[indice, 'RUTA_PREVIA'] = ruta
-        grupo_hora = hora_actual
-        grupo_destino = destino_actual
+    grupo_hora = df_pasajeros['GRUPO_HORA'].to_numpy()
+    grupo_destino = df_pasajeros['GRUPO_DESTINO'].to_numpy()
+    cambio = np.empty(len(df_pasajeros), dtype=np.int32)
+    if len(cambio):
+        cambio[0] = not (grupo_hora[0] == 0 and grupo_destino[0] == 0)
+        cambio[1:] = (grupo_hora[1:] != grupo_hora[:-1]) | \
+            (grupo_destino[1:] != grupo_destino[:-1])
+    df_pasajeros['RUTA_PREVIA'] = np.cumsum(cambio, dtype=np.int32)
     return df_pasajeros
+
+
+def separar_columnas(df_servicios):
+    """
+    Separa las columnas que usa el ruteo de las que solo se exportan.
+
+    El ruteo (y el pool de procesos, que copia los servicios de cada día)
+    trabaja solo con COLUMNAS_RUTEO; las columnas de texto anchas
+    (observaciones, nombres, direcciones, teléfonos...) se guardan aparte
+    por SERVICIO_ID y se unen al resultado con unir_columnas.
+
+    Args:
+        df_servicios (pd.DataFrame): Servicios de un día o de un rango.
+
+    Returns:
+        tuple:
+            pd.DataFrame: Servicios con las COLUMNAS_RUTEO presentes.
+            pd.DataFrame or None: SERVICIO_ID y las demás columnas, o None
+                si no hay SERVICIO_ID u otras columnas (en ese caso el
+                primer DataFrame es `df_servicios` completo).
+            list: Orden original de las columnas.
+
+    Example:
+        df_dia, df_ancho, columnas = separar_columnas(df_dia)
+        df_ida = unir_columnas(
+            obtener_rutas_ida(df_dia)[0], df_ancho, columnas)
+    """
+    columnas = list(dict.fromkeys(df_servicios.columns))
+    anchas = [col for col in columnas if col not in COLUMNAS_RUTEO]
+    if 'SERVICIO_ID' not in columnas or not anchas:
+        return df_servicios, None, columnas
+    df_ancho = df_servicios[['SERVICIO_ID', *anchas]].drop_duplicates(
+        'SERVICIO_ID')
+    return df_servicios[
+        [col for col in columnas if col in COLUMNAS_RUTEO]], df_ancho, columnas
+
+
+def unir_columnas(df_rutas, df_ancho, columnas):
+    """
+    Une a unas rutas las columnas separadas con separar_columnas.
+
+    Args:
+        df_rutas (pd.DataFrame): Rutas con la columna SERVICIO_ID.
+        df_ancho (pd.DataFrame or None): Columnas separadas.
+        columnas (list): Orden original de las columnas de los servicios.
+
+    Returns:
+        pd.DataFrame: Rutas con las columnas de los servicios en su orden
+            original, seguidas de las columnas agregadas por el ruteo, con
+            el mismo índice y orden de filas.
+    """
+    if df_ancho is None or df_rutas.empty:
+        return df_rutas
+    df_rutas = df_rutas.join(
+        df_ancho.set_index('SERVICIO_ID'), on='SERVICIO_ID')
+    originales = [col for col in columnas if col in df_rutas.columns]
+    return df_rutas[originales + [col for col in dict.fromkeys(
+        df_rutas.columns) if col not in columnas]]
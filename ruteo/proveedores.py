@@ -0,0 +1,380 @@
+"""
+    proveedores.py
+"""
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+import numpy as np
+from polyline import encode
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from apps.ruteo.calculos import proyectar_coordenadas
+from apps.ruteo.geo import distancias_pares, distancias_consecutivas
+from apps.ruteo.optimizacion import ordenar_waypoints
+
+# Velocidad en km/h por tipo de vía de OpenStreetMap
+VELOCIDADES_VIA = {
+    'motorway': 80, 'motorway_link': 50,
+    'trunk': 60, 'trunk_link': 40,
+    'primary': 45, 'primary_link': 35,
+    'secondary': 35, 'secondary_link': 30,
+    'tertiary': 30, 'tertiary_link': 25,
+    'unclassified': 25, 'residential': 20,
+    'living_street': 10, 'service': 15,
+}
+
+
+def como_coordenada(ubicacion):
+    """
+    Convierte una ubicación en una tupla (latitud, longitud) de floats.
+
+    Args:
+        ubicacion (tuple or dict): Tupla (latitud, longitud) o diccionario
+            con las llaves 'lat' y 'lng'.
+
+    Returns:
+        tuple: Coordenadas (latitud, longitud).
+    """
+    if isinstance(ubicacion, dict):
+        return float(ubicacion['lat']), float(ubicacion['lng'])
+    if isinstance(ubicacion, str):
+        raise ValueError(
+            "Los proveedores locales solo aceptan coordenadas, no direcciones")
+    return float(ubicacion[0]), float(ubicacion[1])
+
+
+class ProveedorRutas(ABC):
+    """
+    Interfaz de los proveedores de rutas.
+
+    Un proveedor recibe los mismos argumentos que calcular_ruta y retorna
+    una respuesta con la forma de la API de Google Maps Directions: una
+    lista con una ruta, cuyos 'legs' van de cada punto al siguiente y
+    contienen 'duration', 'distance', 'start_location', 'end_location' y
+    'steps' con 'polyline', además de 'waypoint_order'.
+
+    Attributes:
+        nombre (str): Nombre con el que se selecciona el proveedor.
+        usa_cache (bool): Si sus respuestas se guardan en el cache de rutas.
+        limites_matriz (tuple or None): Máximo de orígenes, destinos y
+            elementos por solicitud de matriz, o None si no tiene límites.
+        max_waypoints (int or None): Máximo de waypoints por solicitud de
+            ruta, o None si no tiene límite.
+
+    Las solicitudes a proveedores con costo se registran en las métricas
+    ruteo_solicitudes_api_total y ruteo_costo_api_usd. Los proveedores
+    deben implementar `direcciones` y `matriz`.
+    """
+    nombre = None
+    usa_cache = False
+    limites_matriz = None
+    max_waypoints = None
+
+    @abstractmethod
+    def direcciones(self, origen, destino, waypoints=None,
+                    departure_time=None, optimize=True):
+        """
+        Calcula una ruta con los mismos argumentos que calcular_ruta.
+
+        Returns:
+            list: Respuesta con la forma de la API de Directions.
+        """
+
+    def costo(self, waypoints=None, departure_time=None):
+        """
+        Retorna el costo en USD de una solicitud. Los proveedores locales no
+            tienen costo.
+        """
+        return 0.0
+
+    def costo_matriz(self, elementos, departure_time=None):
+        """
+        Retorna el costo en USD de una solicitud de matriz con `elementos`
+            pares origen-destino.
+        """
+        return 0.0
+
+    @abstractmethod
+    def matriz(self, origenes, destinos, departure_time=None):
+        """
+        Calcula los tiempos de viaje en segundos de cada origen a cada destino.
+
+        Args:
+            origenes (list of tuple): Coordenadas (latitud, longitud).
+            destinos (list of tuple): Coordenadas (latitud, longitud).
+            departure_time (datetime, opcional): Hora de salida.
+
+        Returns:
+            np.ndarray: Matriz (n_origenes, n_destinos) de tiempos en
+                segundos; np.inf si no hay ruta.
+        """
+
+    def matriz_tiempos(self, puntos):
+        """
+        Calcula la matriz de tiempos en segundos entre todos los puntos.
+
+        Args:
+            puntos (list of tuple): Coordenadas (latitud, longitud).
+
+        Returns:
+            np.ndarray: Matriz (n, n) de tiempos en segundos.
+        """
+        return self.matriz(puntos, puntos)
+
+    def _respuesta(self, puntos, tramos, waypoint_order):
+        """
+        Arma la respuesta con la forma de Directions.
+
+        Args:
+            puntos (list of tuple): Puntos visitados en orden.
+            tramos (list of tuple): Para cada par de puntos consecutivos,
+                (vértices del recorrido, duración en segundos, distancia en
+                metros).
+            waypoint_order (list): Orden de visita de los waypoints.
+
+        Returns:
+            list: Respuesta con la forma de la API de Directions.
+        """
+        legs = []
+        for inicio, fin, (vertices, duracion, distancia) in zip(
+                puntos[:-1], puntos[1:], tramos):
+            legs.append({
+                'duration': {'value': int(round(duracion))},
+                'distance': {'value': int(round(distancia))},
+                'start_location': {'lat': inicio[0], 'lng': inicio[1]},
+                'end_location': {'lat': fin[0], 'lng': fin[1]},
+                'steps': [{
+                    'duration': {'value': int(round(duracion))},
+                    'distance': {'value': int(round(distancia))},
+                    'polyline': {'points': encode(
+                        [tuple(vertice) for vertice in vertices])}
+                }]
+            })
+        return [{'legs': legs, 'waypoint_order': waypoint_order}]
+
+    def _ordenar(self, origen, destino, waypoints, optimize):
+        puntos = [origen, *waypoints, destino]
+        if optimize and len(waypoints) > 1:
+            orden = ordenar_waypoints(self.matriz_tiempos(puntos))
+        else:
+            orden = list(range(len(waypoints)))
+        return [origen, *[waypoints[i] for i in orden], destino], orden
+
+
+class ProveedorLineaRecta(ProveedorRutas):
+    """
+    Proveedor sintético que une los puntos en línea recta.
+
+    La distancia recorrida es la distancia Haversine multiplicada por un
+    factor de circuito y la duración se calcula con una velocidad constante.
+    No requiere red ni datos externos.
+
+    Args:
+        vel_prom_km_h (float): Velocidad promedio en km/h.
+        factor_circuito (float): Relación entre la distancia por vía y la
+            distancia en línea recta.
+    """
+    nombre = 'linea_recta'
+
+    def __init__(self, vel_prom_km_h=30, factor_circuito=1.3):
+        self.vel_prom_km_h = vel_prom_km_h
+        self.factor_circuito = factor_circuito
+
+    def matriz(self, origenes, destinos, departure_time=None):
+        distancias = distancias_pares(origenes, destinos) * \
+            self.factor_circuito
+        return distancias / self.vel_prom_km_h * 3600
+
+    def tramo(self, inicio, fin):
+        """
+        Calcula el tramo en línea recta entre dos puntos.
+
+        Returns:
+            tuple: Vértices, duración en segundos y distancia en metros.
+        """
+        distancia_km = float(distancias_consecutivas([inicio, fin])[0]) * \
+            self.factor_circuito
+        duracion = distancia_km / self.vel_prom_km_h * 3600
+        return [inicio, fin], duracion, distancia_km * 1000
+
+    def direcciones(self, origen, destino, waypoints=None,
+                    departure_time=None, optimize=True):
+        origen, destino = como_coordenada(origen), como_coordenada(destino)
+        waypoints = [como_coordenada(punto) for punto in (waypoints or [])]
+        puntos, orden = self._ordenar(origen, destino, waypoints, optimize)
+        tramos = [self.tramo(inicio, fin)
+                  for inicio, fin in zip(puntos[:-1], puntos[1:])]
+        return self._respuesta(puntos, tramos, orden)
+
+
+class ProveedorLocal(ProveedorRutas):
+    """
+    Motor de rutas local sobre un grafo vial cargado de un extracto de
+        OpenStreetMap (.osm en XML).
+
+    Los puntos se ajustan al nodo más cercano de la red y los tramos se
+    calculan con el camino de menor tiempo (Dijkstra). Si un punto queda a
+    más de `max_ajuste_km` de la red o no hay camino, el tramo se calcula
+    con el proveedor en línea recta.
+
+    Args:
+        ruta_osm (str): Ruta del archivo .osm.
+        max_ajuste_km (float): Distancia máxima de un punto a la red vial.
+        respaldo (ProveedorRutas, opcional): Proveedor para los tramos sin
+            camino. Por defecto ProveedorLineaRecta.
+
+    Attributes:
+        coords (np.ndarray): Coordenadas (latitud, longitud) de los nodos.
+        grafo (scipy.sparse.csr_matrix): Tiempos en segundos entre nodos.
+    """
+    nombre = 'local'
+
+    def __init__(self, ruta_osm, max_ajuste_km=0.5, respaldo=None):
+        self.max_ajuste_km = max_ajuste_km
+        self.respaldo = respaldo or ProveedorLineaRecta()
+        self.coords, self.grafo = self.cargar_osm(ruta_osm)
+        self.lat_ref = float(self.coords[:, 0].mean())
+        self.indice = cKDTree(proyectar_coordenadas(self.coords, self.lat_ref))
+
+    @staticmethod
+    def cargar_osm(ruta_osm):
+        """
+        Construye el grafo vial a partir de un archivo .osm.
+
+        Solo se conservan las vías con etiqueta 'highway' de los tipos en
+        VELOCIDADES_VIA, respetando 'oneway' y 'maxspeed' (si es positiva)
+        cuando existen. Si varias vías comparten un tramo, la arista tiene
+        el menor de sus tiempos.
+
+        Args:
+            ruta_osm (str): Ruta del archivo .osm.
+
+        Returns:
+            tuple: Coordenadas de los nodos (np.ndarray (N, 2)) y matriz
+                dispersa (N, N) de tiempos en segundos.
+        """
+        nodos = {}
+        vias = []
+        for _, elemento in ET.iterparse(ruta_osm, events=('end',)):
+            if elemento.tag == 'node':
+                nodos[elemento.get('id')] = (
+                    float(elemento.get('lat')), float(elemento.get('lon')))
+            elif elemento.tag == 'way':
+                etiquetas = {
+                    tag.get('k'): tag.get('v') for tag in elemento.iter('tag')}
+                tipo = etiquetas.get('highway')
+                if tipo in VELOCIDADES_VIA:
+                    velocidad = VELOCIDADES_VIA[tipo]
+                    try:
+                        maxima = float(etiquetas.get('maxspeed', velocidad))
+                    except ValueError:
+                        maxima = velocidad
+                    # maxspeed "0", negativo o infinito se trata como ausente
+                    if np.isfinite(maxima) and maxima > 0:
+                        velocidad = maxima
+                    referencias = [nd.get('ref') for nd in elemento.iter('nd')]
+                    sentido = etiquetas.get('oneway', 'no')
+                    vias.append((referencias, velocidad, sentido))
+            if elemento.tag in ('node', 'way', 'relation'):
+                elemento.clear()
+        indices = {}
+        origenes, destinos, tiempos = [], [], []
+        for referencias, velocidad, sentido in vias:
+            referencias = [ref for ref in referencias if ref in nodos]
+            if len(referencias) < 2:
+                continue
+            ids = [indices.setdefault(ref, len(indices)) for ref in referencias]
+            puntos = np.array([nodos[ref] for ref in referencias])
+            segundos = distancias_consecutivas(puntos) / velocidad * 3600
+            # Evitar aristas de peso cero, que csgraph trata como ausentes
+            segundos = np.maximum(segundos, 1e-3)
+            if sentido == '-1':
+                ids = ids[::-1]
+                segundos = segundos[::-1]
+            origenes.extend(ids[:-1])
+            destinos.extend(ids[1:])
+            tiempos.extend(segundos)
+            if sentido not in ('yes', 'true', '1', '-1'):
+                origenes.extend(ids[1:])
+                destinos.extend(ids[:-1])
+                tiempos.extend(segundos)
+        if not indices:
+            raise ValueError(f"El archivo {ruta_osm} no contiene vías")
+        coords = np.empty((len(indices), 2))
+        for ref, indice in indices.items():
+            coords[indice] = nodos[ref]
+        # Las vías que comparten un tramo repiten la arista; csr_matrix
+        # sumaría sus tiempos, así que se conserva el menor
+        origenes, destinos, tiempos = (
+            np.asarray(origenes), np.asarray(destinos), np.asarray(tiempos))
+        orden = np.lexsort((tiempos, destinos, origenes))
+        origenes, destinos, tiempos = \
+            origenes[orden], destinos[orden], tiempos[orden]
+        primeras = np.ones(len(orden), dtype=bool)
+        primeras[1:] = (origenes[1:] != origenes[:-1]) | \
+            (destinos[1:] != destinos[:-1])
+        grafo = csr_matrix(
+            (tiempos[primeras], (origenes[primeras], destinos[primeras])),
+            shape=(len(indices),) * 2)
+        return coords, grafo
+
+    def ajustar(self, puntos):
+        """
+        Ubica el nodo de la red más cercano a cada punto.
+
+        Args:
+            puntos (list of tuple): Coordenadas (latitud, longitud).
+
+        Returns:
+            np.ndarray: Índice del nodo más cercano, o -1 si está a más de
+                `max_ajuste_km` de la red.
+        """
+        distancias, nodos = self.indice.query(
+            proyectar_coordenadas(puntos, self.lat_ref))
+        return np.where(distancias <= self.max_ajuste_km, nodos, -1)
+
+    def matriz(self, origenes, destinos, departure_time=None):
+        nodos_origen = self.ajustar(origenes)
+        nodos_destino = self.ajustar(destinos)
+        matriz = self.respaldo.matriz(origenes, destinos)
+        filas = np.flatnonzero(nodos_origen >= 0)
+        columnas = np.flatnonzero(nodos_destino >= 0)
+        if len(filas) and len(columnas):
+            tiempos = dijkstra(self.grafo, directed=True,
+                               indices=nodos_origen[filas])
+            locales = tiempos[:, nodos_destino[columnas]]
+            bloque = matriz[np.ix_(filas, columnas)]
+            matriz[np.ix_(filas, columnas)] = np.where(
+                np.isfinite(locales), locales, bloque)
+        return matriz
+
+    def tramo(self, inicio, fin, nodo_inicio, nodo_fin):
+        """
+        Calcula el camino de menor tiempo entre dos puntos.
+
+        Returns:
+            tuple: Vértices, duración en segundos y distancia en metros.
+        """
+        if nodo_inicio < 0 or nodo_fin < 0:
+            return self.respaldo.tramo(inicio, fin)
+        tiempos, predecesores = dijkstra(
+            self.grafo, directed=True, indices=nodo_inicio,
+            return_predecessors=True)
+        if not np.isfinite(tiempos[nodo_fin]):
+            return self.respaldo.tramo(inicio, fin)
+        camino = [nodo_fin]
+        while camino[-1] != nodo_inicio:
+            camino.append(predecesores[camino[-1]])
+        vertices = np.vstack([inicio, self.coords[camino[::-1]], fin])
+        distancia = distancias_consecutivas(vertices).sum() * 1000
+        return vertices.tolist(), float(tiempos[nodo_fin]), distancia
+
+    def direcciones(self, origen, destino, waypoints=None,
+                    departure_time=None, optimize=True):
+        origen, destino = como_coordenada(origen), como_coordenada(destino)
+        waypoints = [como_coordenada(punto) for punto in (waypoints or [])]
+        puntos, orden = self._ordenar(origen, destino, waypoints, optimize)
+        nodos = self.ajustar(puntos)
+        tramos = [self.tramo(puntos[i], puntos[i + 1], nodos[i], nodos[i + 1])
+                  for i in range(len(puntos) - 1)]
+        return self._respuesta(puntos, tramos, orden)
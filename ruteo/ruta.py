@@ -2,17 +2,33 @@
     ruta.py
 """
 import traceback
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from apps.ruteo.conexion import obtener_servicios
+from apps.ruteo.constantes import (
+    RUTAS_PROCESOS, RUTAS_HILOS_GRUPOS, RUTAS_MOTOR, RUTAS_ORDEN_LOCAL,
+    RUTAS_PLANTILLAS, VEL_LINEA_RECTA,
+    VRP_CAPACIDAD, VRP_ESPERA_MAX, VRP_COSTO_VEHICULO)
+from apps.ruteo.conexion import obtener_servicios_por_dia, tipar_columnas
 from apps.ruteo.preprocesamiento import (
     formato_dataframe, agrupar_por_destinos, agrupar_por_horas,
-    obtener_ruta_previa)
-from apps.ruteo.google_maps import calcular_ruta
+    obtener_ruta_previa, separar_columnas, unir_columnas)
+from apps.ruteo.google_maps import (
+    calcular_ruta, calcular_matriz, orden_waypoints)
 from apps.ruteo.calculos import (
-    calcular_distancia_lineal, obtener_coordenadas_polilinea,
-    filtrar_coordenadas_por_distancia)
+    calcular_distancias_lineales, obtener_polilinea_simplificada,
+    filtrar_origenes_por_segmentos)
 from apps.ruteo.tiempo import obtener_hora_salida
+from apps.ruteo.geo import distancias_uno_a_muchos
+from apps.ruteo.optimizacion import ProblemaRutas
+from apps.ruteo.estado_rutas import (
+    obtener_estado, clave_parametros, grupos_sin_cambios)
+from apps.ruteo.plantillas_rutas import (
+    obtener_plantillas, huella_grupo, aplicar_plantilla)
+from apps.ruteo.decoradores import (
+    etapa, cronometro, contar, ejecucion, ejecucion_actual, en_contexto,
+    registro_metricas)
 
 
 
@@ -21,7 +37,7 @@ def encontrar_origen_mas_lejano(origenes, destino):
     Encuentra el origen más lejano respecto al destino y retorna los demás
         origenes como intermedios.
 
-    Calcula la distancia euclidiana entre los puntos de origen y el destino,
+    Calcula la distancia Haversine entre los puntos de origen y el destino,
     identifica el origen más lejano y devuelve los demás origenes
         como intermedios.
 
@@ -34,12 +50,11 @@ def encontrar_origen_mas_lejano(origenes, destino):
         tuple: Una tupla con el origen más lejano respecto al destino y una
             lista de origenes intermedios.
     """
-    origenes = np.array(origenes)
-    destino = np.array(destino)
-    # Calcular las distancias euclidianas entre los puntos de origen y el destino
-    distancias_origenes = np.sqrt(np.sum((origenes[:, np.newaxis] - destino) ** 2, axis=2))
+    origenes = np.array(origenes, dtype=float).reshape(-1, 2)
+    # Calcular las distancias Haversine entre los puntos de origen y el destino
+    distancias_origenes = distancias_uno_a_muchos(destino, origenes)
     # Encontrar el índice del origen más lejano respecto al destino
-    indice_origen_mas_lejano = np.argmax(np.max(distancias_origenes, axis=1))
+    indice_origen_mas_lejano = np.argmax(distancias_origenes)
     # Obtener el origen más lejano y eliminarlo de la lista de origenes
     origen_mas_lejano = origenes[indice_origen_mas_lejano]
     origenes_intermedios = np.delete(origenes, indice_origen_mas_lejano, axis=0).tolist()
@@ -47,7 +62,8 @@ def encontrar_origen_mas_lejano(origenes, destino):
     return tuple(origen_mas_lejano), origenes_intermedios
 
 
-def ordenar_ruta(origen, origenes_intermedios, destino, fecha_hora_viaje):
+def ordenar_ruta(origen, origenes_intermedios, destino, fecha_hora_viaje,
+                 proveedor=None, orden_local=RUTAS_ORDEN_LOCAL):
     """
     Ordena la ruta previa y devuelve los puntos intermedios en el orden optimizado.
 
@@ -55,15 +71,24 @@ def ordenar_ruta(origen, origenes_intermedios, destino, fecha_hora_viaje):
     utilizando la función calcular_ruta. Luego, reordena los waypoints intermedios en el orden optimizado y devuelve tanto
     los waypoints reordenados como la ruta previa calculada.
 
+    Con `orden_local` el orden se calcula localmente sobre la matriz de
+    tiempos (ver google_maps.orden_waypoints) y la ruta se pide una sola vez,
+    ya ordenada y sin optimize_waypoints; su `waypoint_order` es entonces
+    la identidad sobre los waypoints retornados. Si la matriz tendría costo
+    o los puntos son direcciones de texto, se usa optimize_waypoints.
+
     Args:
         origen (str or tuple): Ubicación de origen. Puede ser una dirección o una tupla (latitud, longitud).
         origenes_intermedios (list): Lista de ubicaciones intermedias (waypoints) en la ruta.
         destino (str or tuple): Ubicación de destino. Puede ser una dirección o una tupla (latitud, longitud).
         fecha_hora_viaje (datetime): Hora de salida para estimar la duración de la ruta.
+        proveedor (str, opcional): Proveedor de rutas (ver calcular_ruta).
+        orden_local (bool, opcional): Ordenar localmente en lugar de usar
+            optimize_waypoints de la API.
 
     Returns:
         tuple: Una tupla que contiene dos elementos: 
-            - La lista de waypoints intermedios reordenados en el orden optimizado.
+            - La lista de waypoints intermedios en orden de visita.
             - La lista de pasos de la ruta previa, cada uno representado como un diccionario con información detallada.
 
     Note:
@@ -78,14 +103,31 @@ def ordenar_ruta(origen, origenes_intermedios, destino, fecha_hora_viaje):
         for step in ruta_previa:
             print(step['html_instructions'])
     """
+    origenes_orden = None
+    if orden_local:
+        try:
+            origenes_orden = orden_waypoints(
+                origen, destino, origenes_intermedios, fecha_hora_viaje,
+                proveedor)
+        except Exception:
+            # Direcciones de texto u otro error: se deja que la API ordene
+            origenes_orden = None
+    if origenes_orden is not None:
+        origenes_intermedios = [origenes_intermedios[i] for i in origenes_orden]
+        ruta_previa = calcular_ruta(
+            origen, destino, origenes_intermedios, fecha_hora_viaje, False,
+            proveedor=proveedor)
+        return origenes_intermedios, ruta_previa
     ruta_previa = calcular_ruta(
-        origen, destino, origenes_intermedios, fecha_hora_viaje)
-    np.insert(origenes_intermedios, 0, origen, axis=0)
+        origen, destino, origenes_intermedios, fecha_hora_viaje,
+        proveedor=proveedor)
+    # waypoint_order lista los índices originales en orden de visita
     origenes_orden = ruta_previa[0]['waypoint_order']
-    origenes_intermedios = [x for _, x in sorted(zip(origenes_orden, origenes_intermedios))]
+    origenes_intermedios = [origenes_intermedios[i] for i in origenes_orden]
     return origenes_intermedios, ruta_previa
 
 
+@etapa
 def obtener_rutas_cercanas(df_servicios, servicio=0):
     """
     Procesa las rutas de los pasajeros a partir de un DataFrame de servicios.
@@ -141,14 +183,13 @@ def obtener_pasajeros_ruta(df, servicio=0):
     """
     tipo_servicio = 'ida' if servicio == 0 else 'retorno'
     validator = df['DETALLE_SERVICIO'].str.lower() == tipo_servicio
-    rutas_ida = df[validator].copy()
-    validator = rutas_ida['LATITUD_ORIGEN'] == ''
-    rutas_ida.loc[validator, 'LATITUD_ORIGEN'] = None
-    validator = rutas_ida['LATITUD_DESTINO'] == ''
-    rutas_ida.loc[validator, 'LATITUD_DESTINO'] = None
-    # Eliminar los registros sin coordenadas
-    rutas_ida.dropna(subset=['LATITUD_ORIGEN', 'LATITUD_DESTINO'], inplace=True)
-    return rutas_ida
+    # Eliminar los registros sin coordenadas (vacías o nulas) en el mismo
+    # filtro, que con take copia las filas una sola vez
+    for columna in ['LATITUD_ORIGEN', 'LATITUD_DESTINO']:
+        validator &= df[columna].notna()
+        if not pd.api.types.is_numeric_dtype(df[columna]):
+            validator &= df[columna] != ''
+    return df.take(np.flatnonzero(validator.to_numpy()))
 
 
 def formato_coordenadas(df):
@@ -180,6 +221,7 @@ def formato_coordenadas(df):
     return df
 
 
+@etapa
 def organizar_ruta(df_rutas):
     """
     Organiza un DataFrame de rutas en función de la distancia lineal y la ruta inicial.
@@ -197,14 +239,289 @@ def organizar_ruta(df_rutas):
     Ejemplo:
         df_rutas_organizado = organizar_ruta(dataframe_rutas)
     """
-    df_rutas['DISTANCIA_LINEAL'] = df_rutas.apply(calcular_distancia_lineal, axis=1)
+    df_rutas['DISTANCIA_LINEAL'] = calcular_distancias_lineales(df_rutas)
     df_rutas.sort_values(by=['RUTA_INICIAL', 'DISTANCIA_LINEAL'],
                          ascending=[True, False], inplace=True)
     df_rutas.reset_index(drop=True, inplace=True)
     return df_rutas
 
 
-def obtener_rutas_ida(df_servicio, max_distancia_km=2):
+@etapa
+def rutas_finales_grupo(valor, df_ruta, max_distancia_km=2, proveedor=None):
+    """
+    Divide un grupo de RUTA_INICIAL en rutas finales.
+
+    Toma el primer pasajero restante (el más lejano), calcula su ruta hasta
+    el destino y agrupa a todos los pasajeros que quedan a menos de
+    `max_distancia_km` de ella; repite con los restantes.
+
+    Args:
+        valor (int): Valor de RUTA_INICIAL del grupo.
+        df_ruta (pandas.DataFrame): Pasajeros del grupo, ordenados por
+            distancia lineal descendente.
+        max_distancia_km (float): Distancia máxima a la ruta para agrupar pasajeros.
+        proveedor (str, opcional): Proveedor de rutas (ver calcular_ruta).
+
+    Returns:
+        pandas.Series: Etiqueta RUTA_FINAL de cada pasajero agrupado, con el
+            índice de `df_ruta`.
+    """
+    print(f"Calculando ruta {valor} con {df_ruta.shape[0]} pasajeros.")
+    etiquetas = np.full(len(df_ruta), None, dtype=object)
+    # Los pasajeros restantes se marcan en un arreglo booleano en lugar de
+    # copiar el DataFrame en cada iteración
+    restantes = np.ones(len(df_ruta), dtype=bool)
+    origenes = df_ruta[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(
+        dtype=float)
+    destinos = df_ruta[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].to_numpy(
+        dtype=float)
+    count = 1
+    fecha_hora_viaje = obtener_hora_salida(
+        df_ruta["HORA_SERVICIO_C"].max().time(), "2023-12-04")
+    valor_ant = -1
+    while restantes.any():
+        indices = np.flatnonzero(restantes)
+        primero = indices[0]
+        origen = (origenes[primero, 0], origenes[primero, 1])
+        destino = (destinos[primero, 0], destinos[primero, 1])
+        directions_result = calcular_ruta(
+            origen, destino, None, fecha_hora_viaje, proveedor=proveedor)
+        poly_coords = obtener_polilinea_simplificada(directions_result)
+
+        se_agrupa, _ = filtrar_origenes_por_segmentos(
+            origenes[indices], poly_coords, max_distancia_km)
+        se_agrupa = np.asarray(se_agrupa, dtype=bool)
+        etiquetas[indices[se_agrupa]] = f"{str(valor)}_{count}"
+        restantes[indices[se_agrupa]] = False
+        valor_act = len(indices) - int(se_agrupa.sum())
+        if valor_act == 1 or valor_act == valor_ant:
+            break
+        valor_ant = valor_act
+        count += 1
+    etiquetas = pd.Series(etiquetas, index=df_ruta.index).dropna()
+    contar('ruteo_grupos_total', etiquetas.nunique(), tipo='RUTA_FINAL')
+    return etiquetas
+
+
+@etapa
+def rutas_finales_matriz(valor, df_ruta, max_distancia_km=2, proveedor=None,
+                         vel_prom_km_h=VEL_LINEA_RECTA, holgura=1.5):
+    """
+    Divide un grupo de RUTA_INICIAL en rutas finales usando tiempos de
+        viaje de una matriz en lugar de polilíneas de Directions.
+
+    Igual que rutas_finales_grupo, toma el pasajero restante más lejano
+    como inicio de una ruta y le agrega los pasajeros que quedan cerca de
+    ella; aquí un pasajero se agrega si el desvío para recogerlo
+    (t(inicio, pasajero) + t(pasajero, destino) - t(inicio, destino)) no
+    supera el tiempo de recorrer 2 * `max_distancia_km` a `vel_prom_km_h`.
+
+    Los tiempos al destino se piden una sola vez para todo el grupo y en
+    cada iteración solo se pide la fila del pasajero de inicio hacia los
+    candidatos cuyo desvío en línea recta no supera `holgura` veces el
+    límite, de modo que el grupo se resuelve con pocas solicitudes de
+    matriz (ver google_maps.calcular_matriz) y ninguna de Directions.
+
+    Args:
+        valor (int): Valor de RUTA_INICIAL del grupo.
+        df_ruta (pandas.DataFrame): Pasajeros del grupo, ordenados por
+            distancia lineal descendente.
+        max_distancia_km (float): Distancia máxima a la ruta para agrupar pasajeros.
+        proveedor (str, opcional): Proveedor de rutas (ver calcular_matriz).
+        vel_prom_km_h (float, opcional): Velocidad para convertir la
+            distancia máxima en tiempo de desvío.
+        holgura (float, opcional): Factor del filtro previo en línea recta.
+
+    Returns:
+        tuple:
+            pandas.Series: Etiqueta RUTA_FINAL de cada pasajero, con el
+                índice de `df_ruta`.
+            pandas.Series: ORDEN_RECOGIDA de cada pasajero dentro de su
+                ruta final, del más lejano al destino al más cercano.
+    """
+    fecha_hora_viaje = obtener_hora_salida(
+        df_ruta["HORA_SERVICIO_C"].max().time(), "2023-12-04")
+    origenes = df_ruta[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(
+        dtype=float)
+    destino = tuple(df_ruta[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].iloc[0])
+    a_destino = calcular_matriz(
+        origenes, [destino], fecha_hora_viaje, proveedor)[:, 0]
+    lineal_destino = distancias_uno_a_muchos(destino, origenes)
+    max_desvio = 2 * max_distancia_km / vel_prom_km_h * 3600
+    etiquetas = np.empty(len(origenes), dtype=object)
+    orden = np.zeros(len(origenes), dtype=int)
+    pendientes = np.ones(len(origenes), dtype=bool)
+    count = 1
+    while pendientes.any():
+        inicio = np.flatnonzero(pendientes)[0]
+        pendientes[inicio] = False
+        candidatos = np.flatnonzero(pendientes)
+        # Filtro previo con el desvío en línea recta
+        desvio_lineal = distancias_uno_a_muchos(
+            origenes[inicio], origenes[candidatos]) + \
+            lineal_destino[candidatos] - lineal_destino[inicio]
+        candidatos = candidatos[
+            desvio_lineal <= holgura * 2 * max_distancia_km]
+        miembros = candidatos[:0]
+        # Sin tiempo del ancla al destino (elemento sin ruta en la matriz)
+        # el desvío no se puede medir: el ancla queda sola en su ruta
+        if len(candidatos) and np.isfinite(a_destino[inicio]):
+            desde_inicio = calcular_matriz(
+                [origenes[inicio]], origenes[candidatos], fecha_hora_viaje,
+                proveedor)[0]
+            desvio = desde_inicio + a_destino[candidatos] - a_destino[inicio]
+            miembros = candidatos[desvio <= max_desvio]
+        pendientes[miembros] = False
+        ruta = np.concatenate([[inicio], miembros[np.argsort(
+            -a_destino[miembros], kind='stable')]])
+        etiquetas[ruta] = f"{str(df_ruta['RUTA_INICIAL'].iat[inicio])}_{count}"
+        orden[ruta] = np.arange(1, len(ruta) + 1)
+        count += 1
+    contar('ruteo_grupos_total', count - 1, tipo='RUTA_FINAL')
+    return (pd.Series(etiquetas, index=df_ruta.index),
+            pd.Series(orden, index=df_ruta.index))
+
+
+@etapa
+def rutas_finales_vrp(valor, df_ruta, max_distancia_km=2, proveedor=None,
+                      capacidad=VRP_CAPACIDAD, max_duracion=None,
+                      max_espera=VRP_ESPERA_MAX,
+                      costo_vehiculo=VRP_COSTO_VEHICULO):
+    """
+    Divide un grupo de RUTA_INICIAL en rutas finales resolviendo un
+        problema de rutas de vehículos (ver optimizacion.ProblemaRutas).
+
+    A diferencia de rutas_finales_grupo y rutas_finales_matriz, que
+    absorben pasajeros cercanos a la ruta del más lejano, aquí se respetan
+    la capacidad del vehículo, la espera en el destino según HORA_SERVICIO
+    y la duración máxima del viaje. La matriz de tiempos entre todas las
+    recogidas y el destino se pide una vez por grupo con calcular_matriz,
+    que reutiliza los elementos del cache.
+
+    Args:
+        valor (int): Valor de RUTA_INICIAL del grupo.
+        df_ruta (pandas.DataFrame): Pasajeros del grupo.
+        max_distancia_km (float): Distancia máxima a la ruta; solo se usa
+            para derivar `max_duracion` si no se indica.
+        proveedor (str, opcional): Proveedor de rutas (ver calcular_matriz).
+        capacidad (int, opcional): Pasajeros por vehículo.
+        max_duracion (float, opcional): Duración máxima de la ruta en
+            minutos. Por defecto el tiempo_aprox de servicios_completos,
+            del que se deriva max_distancia_km (15 * max_distancia_km).
+        max_espera (float, opcional): Espera máxima en el destino en minutos.
+        costo_vehiculo (float, opcional): Costo fijo por vehículo en segundos.
+
+    Returns:
+        tuple:
+            pandas.Series: Etiqueta RUTA_FINAL de cada pasajero, con el
+                índice de `df_ruta`.
+            pandas.Series: ORDEN_RECOGIDA de cada pasajero dentro de su
+                ruta final.
+    """
+    fecha_hora_viaje = obtener_hora_salida(
+        df_ruta["HORA_SERVICIO_C"].max().time(), "2023-12-04")
+    if max_duracion is None:
+        max_duracion = 15 * max_distancia_km
+    destino = df_ruta[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].to_numpy(
+        dtype=float)[:1]
+    puntos = np.vstack([df_ruta[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(
+        dtype=float), destino])
+    tiempos = calcular_matriz(puntos, puntos, fecha_hora_viaje, proveedor)
+    horas = (df_ruta['HORA_SERVICIO_C'] - df_ruta['HORA_SERVICIO_C'].min()
+             ).dt.total_seconds().to_numpy()
+    problema = ProblemaRutas(
+        tiempos, horas, capacidad=capacidad, max_duracion=max_duracion * 60,
+        max_espera=max_espera * 60, costo_vehiculo=costo_vehiculo)
+    etiquetas = np.empty(len(df_ruta), dtype=object)
+    orden = np.zeros(len(df_ruta), dtype=int)
+    rutas = problema.resolver()
+    for count, ruta in enumerate(rutas, start=1):
+        etiquetas[ruta] = f"{str(df_ruta['RUTA_INICIAL'].iat[0])}_{count}"
+        orden[ruta] = np.arange(1, len(ruta) + 1)
+    contar('ruteo_grupos_total', len(rutas), tipo='RUTA_FINAL')
+    return (pd.Series(etiquetas, index=df_ruta.index),
+            pd.Series(orden, index=df_ruta.index))
+
+
+def rutas_finales_anteriores(valor, df_ruta, anterior, valor_anterior,
+                             con_orden=False):
+    """
+    Reutiliza las rutas finales de un grupo de RUTA_INICIAL que no cambió
+        desde el cálculo anterior del día (ver estado_rutas).
+
+    Args:
+        valor (int): Valor actual de RUTA_INICIAL del grupo.
+        df_ruta (pandas.DataFrame): Pasajeros del grupo con SERVICIO_ID.
+        anterior (pandas.DataFrame): Estado guardado del día.
+        valor_anterior (int): RUTA_INICIAL del grupo en el estado guardado.
+        con_orden (bool, opcional): Retornar también ORDEN_RECOGIDA, como
+            los motores 'matriz' y 'vrp'.
+
+    Returns:
+        pandas.Series or tuple: Igual que el motor con que se calculó el
+            estado; las etiquetas RUTA_FINAL se renombran con `valor`.
+    """
+    previo = anterior[anterior['RUTA_INICIAL'] == valor_anterior].set_index(
+        'SERVICIO_ID').reindex(df_ruta['SERVICIO_ID'])
+    etiquetas = f"{str(valor)}_" + \
+        previo['RUTA_FINAL'].str.split('_', n=1).str[1]
+    etiquetas.index = df_ruta.index
+    if con_orden:
+        orden = previo['ORDEN_RECOGIDA']
+        orden.index = df_ruta.index
+        return etiquetas, orden
+    return etiquetas.dropna()
+
+
+def rutas_finales_con_plantilla(valor, df_ruta, max_distancia_km=2,
+                                proveedor=None, calcular_grupo=None,
+                                parametros=None, con_orden=False):
+    """
+    Divide un grupo de RUTA_INICIAL en rutas finales reutilizando la
+        plantilla de un grupo igual o similar de otro día, si existe
+        (ver plantillas_rutas).
+
+    Sin plantilla el grupo se calcula con `calcular_grupo` y el resultado
+    se guarda como plantilla para los días siguientes.
+
+    Args:
+        valor (int): Valor de RUTA_INICIAL del grupo.
+        df_ruta (pandas.DataFrame): Pasajeros del grupo.
+        max_distancia_km (float): Distancia máxima a la ruta para agrupar pasajeros.
+        proveedor (str, opcional): Proveedor de rutas.
+        calcular_grupo (callable): Motor de MOTORES_RUTA.
+        parametros (str): Llave de estado_rutas.clave_parametros.
+        con_orden (bool, opcional): Si el motor retorna ORDEN_RECOGIDA.
+
+    Returns:
+        pandas.Series or tuple: Igual que `calcular_grupo`.
+    """
+    almacen = obtener_plantillas()
+    clave = huella_grupo(df_ruta)
+    asignacion = almacen.buscar(clave, parametros)
+    contar('ruteo_plantillas_total',
+           resultado='miss' if asignacion is None else 'hit')
+    if asignacion is not None:
+        etiquetas, orden = aplicar_plantilla(valor, df_ruta, asignacion)
+        return (etiquetas, orden) if con_orden else etiquetas.dropna()
+    resultado = calcular_grupo(valor, df_ruta, max_distancia_km, proveedor)
+    etiquetas, orden = resultado if con_orden else (resultado, None)
+    almacen.guardar(clave, parametros, df_ruta, etiquetas, orden)
+    return resultado
+
+
+# Motores de agrupación de rutas finales por grupo de RUTA_INICIAL
+MOTORES_RUTA = {
+    'directions': rutas_finales_grupo,
+    'matriz': rutas_finales_matriz,
+    'vrp': rutas_finales_vrp,
+}
+
+
+def obtener_rutas_ida(df_servicio, max_distancia_km=2,
+                      n_hilos=RUTAS_HILOS_GRUPOS, proveedor=None,
+                      motor=RUTAS_MOTOR, anterior=None,
+                      plantillas=RUTAS_PLANTILLAS):
     """
     Esta función procesa un DataFrame de servicios de transporte y calcula las rutas de ida de los vehículos
     basándose en la información de coordenadas y hora de salida. Las rutas se agrupan en función de su proximidad
@@ -212,89 +529,284 @@ def obtener_rutas_ida(df_servicio, max_distancia_km=2):
 
     Args:
         df_servicio (pandas.DataFrame): DataFrame que contiene información de servicios de transporte.
+        max_distancia_km (float): Distancia máxima a la ruta para agrupar pasajeros.
+        n_hilos (int, opcional): Número de grupos de RUTA_INICIAL que se
+            calculan en paralelo. Con 1 se calculan uno tras otro.
+        proveedor (str, opcional): Proveedor de rutas. Con 'local' o
+            'linea_recta' los grupos se calculan sin consumir la API de Google.
+        motor (str, opcional): 'directions' agrupa con la polilínea de una
+            solicitud de Directions por iteración (rutas_finales_grupo);
+            'matriz' agrupa con tiempos de Distance Matrix y además asigna
+            ORDEN_RECOGIDA (rutas_finales_matriz); 'vrp' resuelve cada
+            grupo con capacidad y ventanas de tiempo (rutas_finales_vrp).
+        anterior (pandas.DataFrame, opcional): Estado de un cálculo
+            anterior del mismo día (estado_rutas.EstadoRutas). Los grupos
+            de RUTA_INICIAL sin servicios nuevos, cancelados o modificados
+            conservan sus rutas finales y solo los demás se recalculan.
+        plantillas (bool, opcional): Reutilizar las rutas finales de grupos
+            recurrentes ya calculados (rutas_finales_con_plantilla).
 
     Returns:
         pandas.DataFrame, pandas.DataFrame:
             - Un DataFrame con las rutas de ida de los vehículos, incluyendo información de ruta inicial y final.
             - Un DataFrame que almacena cualquier error que ocurra durante el proceso.
 
-    Esta función utiliza las siguientes funciones auxiliares: obtener_rutas_cercanas, organizar_ruta,
-    obtener_hora_salida, calcular_ruta, obtener_coordenadas_polilinea y filtrar_coordenadas_por_distancia.
+    Esta función utiliza las siguientes funciones auxiliares: obtener_rutas_cercanas, organizar_ruta
+    y rutas_finales_grupo.
     """
+    if motor not in MOTORES_RUTA:
+        raise ValueError(
+            f"Motor de rutas '{motor}' no soportado, use uno de "
+            f"{sorted(MOTORES_RUTA)}")
+    calcular_grupo = MOTORES_RUTA[motor]
+    if plantillas:
+        calcular_grupo = partial(
+            rutas_finales_con_plantilla, calcular_grupo=calcular_grupo,
+            parametros=clave_parametros(max_distancia_km, proveedor, motor),
+            con_orden=motor != 'directions')
     df_ida, df_error = obtener_rutas_cercanas(df_servicio)
     if not df_ida.empty:
-        df_ida['RUTA_INICIAL'] = df_ida['RUTA_PREVIA'].copy()
+        df_ida['RUTA_INICIAL'] = df_ida['RUTA_PREVIA']
         df_ida = organizar_ruta(df_ida)
         # Calcular las rutas por hora de llegada y destino en común
-        df_ida['COORD_ORIGEN'] = list(
-            zip(df_ida['LATITUD_ORIGEN'], df_ida['LONGITUD_ORIGEN']))
-        df_ida['COORD_DESTINO'] = list(
-            zip(df_ida['LATITUD_DESTINO'], df_ida['LONGITUD_DESTINO']))
-        for valor in df_ida['RUTA_INICIAL'].unique().tolist():
-            validator = df_ida['RUTA_INICIAL'] == valor
-            df_ruta = df_ida[validator].copy()
-            print(f"Calculando ruta {valor} con {df_ruta.shape[0]} pasajeros.")
-            ruta_test = df_ruta.copy()
-            count = 1
-            fecha_hora_viaje = obtener_hora_salida(
-                df_ruta["HORA_SERVICIO_C"].max().time(), "2023-12-04")
-            valor_ant = -1
-            while not ruta_test.empty:
-                primer_valor = ruta_test.iloc[0]
-                origen = (primer_valor['LATITUD_ORIGEN'], primer_valor['LONGITUD_ORIGEN'])
-                destino = (primer_valor['LATITUD_DESTINO'], primer_valor['LONGITUD_DESTINO'])
-                directions_result = calcular_ruta(origen, destino, None, fecha_hora_viaje)
-                poly_coords = obtener_coordenadas_polilinea(directions_result)
-
-                ruta_test['SE_AGRUPA'] = ruta_test.apply(
-                    filtrar_coordenadas_por_distancia, axis=1, args=(poly_coords, max_distancia_km))
-                validator_index = df_ida.index.isin(ruta_test[ruta_test['SE_AGRUPA']].index)
-                df_ida.loc[validator_index, 'RUTA_FINAL'] = f"{str(primer_valor['RUTA_INICIAL'])}_{count}"
-                ruta_test = ruta_test[~ruta_test['SE_AGRUPA']].copy()
-                valor_act = (ruta_test['SE_AGRUPA'] == False).sum()
-                print(ruta_test)
-                if ruta_test.shape[0] == 1:
-                    ruta_test = pd.DataFrame()
-                elif valor_act == valor_ant and valor_act == ruta_test.shape[0]:
-                    ruta_test = pd.DataFrame()
-                else:
-                    valor_ant = (ruta_test['SE_AGRUPA'] == False).sum()
-                count += 1
-        df_ida.sort_values(by=['RUTA_INICIAL', 'RUTA_FINAL', 'DISTANCIA_LINEAL'],
-                                ascending=[True, True, False], inplace=True)
-        df = df_ida.copy()
+        grupos = [(valor, df_ruta) for valor, df_ruta in
+                  df_ida.groupby('RUTA_INICIAL', sort=False)]
+        contar('ruteo_filas_total', len(df_ida), etapa='obtener_rutas_ida')
+        contar('ruteo_grupos_total', len(grupos), tipo='RUTA_INICIAL')
+        reutilizados = {}
+        if anterior is not None and not anterior.empty:
+            reutilizados = grupos_sin_cambios(df_ida, anterior)
+            contar('ruteo_grupos_total', len(reutilizados), tipo='REUTILIZADO')
+        pendientes = [(valor, df_ruta) for valor, df_ruta in grupos
+                      if valor not in reutilizados]
+        if n_hilos and n_hilos > 1 and len(pendientes) > 1:
+            # Los grupos no comparten pasajeros: se calculan en paralelo y
+            # sus solicitudes a la API comparten el pool de conexiones
+            with ThreadPoolExecutor(
+                    max_workers=min(n_hilos, len(pendientes))) as executor:
+                calculados = list(executor.map(
+                    en_contexto(lambda grupo: calcular_grupo(
+                        grupo[0], grupo[1], max_distancia_km, proveedor)),
+                    pendientes))
+        else:
+            calculados = [calcular_grupo(
+                valor, df_ruta, max_distancia_km, proveedor)
+                for valor, df_ruta in pendientes]
+        calculados = iter(calculados)
+        resultados = [
+            rutas_finales_anteriores(
+                valor, df_ruta, anterior, reutilizados[valor],
+                motor != 'directions')
+            if valor in reutilizados else next(calculados)
+            for valor, df_ruta in grupos]
+        orden = 'DISTANCIA_LINEAL'
+        if motor != 'directions':
+            etiquetas = [etiqueta for etiqueta, _ in resultados]
+            df_ida['ORDEN_RECOGIDA'] = pd.concat(
+                [recogida for _, recogida in resultados])
+            orden = 'ORDEN_RECOGIDA'
+        else:
+            etiquetas = resultados
+        df_ida['RUTA_FINAL'] = pd.concat(etiquetas) if etiquetas else None
+        df_ida.sort_values(by=['RUTA_INICIAL', 'RUTA_FINAL', orden],
+                           ascending=[True, True, orden == 'ORDEN_RECOGIDA'],
+                           inplace=True)
+        df = df_ida
     else:
         df = pd.DataFrame()
     return df, df_error
 
 
+def rutas_ida_por_dia(fecha, df_dia, max_distancia_km,
+                      n_hilos=RUTAS_HILOS_GRUPOS, proveedor=None,
+                      motor=RUTAS_MOTOR, incremental=False,
+                      plantillas=RUTAS_PLANTILLAS):
+    """
+    Calcula las rutas de ida de un único día de servicio.
+
+    Junto con rutas_retorno_dia forma la unidad de trabajo de
+    servicios_completos (rutas_dia), tanto en modo serial como en el pool
+    de procesos.
+
+    Args:
+        fecha (str): Fecha de servicio en formato 'YYYY-MM-DD'.
+        df_dia (pandas.DataFrame): Servicios de esa fecha.
+        max_distancia_km (float): Distancia máxima a la ruta para agrupar pasajeros.
+        n_hilos (int, opcional): Grupos de RUTA_INICIAL calculados en paralelo.
+        proveedor (str, opcional): Proveedor de rutas.
+        motor (str, opcional): Motor de agrupación (ver obtener_rutas_ida).
+        incremental (bool, opcional): Partir del estado guardado del día y
+            recalcular solo los grupos afectados; el resultado se guarda
+            como nuevo estado.
+        plantillas (bool, opcional): Reutilizar plantillas de grupos
+            recurrentes (ver obtener_rutas_ida).
+
+    Returns:
+        pandas.DataFrame: Rutas de ida del día con RUTA_FINAL prefijada por
+            mes y día, o un DataFrame vacío.
+    """
+    print(f"Calculando rutas fecha: {fecha} con {df_dia.shape[0]} pasajeros")
+    anterior = None
+    if incremental:
+        parametros = clave_parametros(max_distancia_km, proveedor, motor)
+        anterior = obtener_estado().obtener(str(fecha), parametros)
+    df_ida, _ = obtener_rutas_ida(
+        df_dia, max_distancia_km, n_hilos, proveedor, motor, anterior,
+        plantillas)
+    if incremental and not df_ida.empty:
+        obtener_estado().guardar(str(fecha), parametros, df_ida)
+    if not df_ida.empty:
+        df_ida['RUTA_FINAL'] = "-".join(fecha.split("-")[1:]) + \
+            "_" + df_ida['RUTA_FINAL']
+    return df_ida
+
+
+def rutas_retorno_dia(df_dia, df_ida):
+    """
+    Calcula las rutas de retorno de un único día de servicio.
+
+    Cada pasajero de retorno recibe la RUTA_FINAL de su servicio de ida
+    del mismo día.
+
+    Args:
+        df_dia (pandas.DataFrame): Servicios de esa fecha.
+        df_ida (pandas.DataFrame): Rutas de ida del día (rutas_ida_por_dia).
+
+    Returns:
+        pandas.DataFrame: Rutas de retorno del día.
+    """
+    df_retorno, _ = obtener_rutas_cercanas(df_dia, 1)
+    if df_ida.empty:
+        return df_retorno.assign(RUTA_FINAL=None)
+    return df_retorno.merge(
+        df_ida[['IDENTIFICACION_USUARIO', 'FECHA_SERVICIO', 'RUTA_FINAL']],
+        on=['IDENTIFICACION_USUARIO', 'FECHA_SERVICIO'], how='left')
+
+
+def rutas_dia(fecha, df_dia, *args):
+    """
+    Calcula las rutas de ida y de retorno de un único día de servicio.
+
+    Recibe los mismos argumentos que rutas_ida_por_dia.
+
+    Returns:
+        tuple: DataFrames de rutas de ida y de retorno del día.
+    """
+    df_ida = rutas_ida_por_dia(fecha, df_dia, *args)
+    return df_ida, rutas_retorno_dia(df_dia, df_ida)
+
+
+def rutas_dia_proceso(*args):
+    """
+    Ejecuta rutas_dia en un proceso del pool.
+
+    Las métricas del proceso se recolectan en una ejecución propia y se
+    retornan para que el proceso principal las sume a la suya.
+
+    Returns:
+        tuple: Rutas de ida y de retorno del día y sus métricas
+            (decoradores.Metricas).
+    """
+    with ejecucion() as id_ejecucion:
+        df_ida, df_retorno = rutas_dia(*args)
+    return df_ida, df_retorno, registro_metricas.metricas_ejecucion(
+        id_ejecucion)
+
+
 def servicios_completos(
         fecha_inicio, fecha_final, tipo_prod=[14], tiempo_aprox=30,
-        by_excel=None):
+        by_excel=None, n_procesos=RUTAS_PROCESOS, n_hilos=RUTAS_HILOS_GRUPOS,
+        ciudad_origen=None, ciudad_destino=None, regional_origen=None,
+        regional_destino=None, proveedor=None, id_ejecucion=None,
+        motor=RUTAS_MOTOR, incremental=False, plantillas=RUTAS_PLANTILLAS):
+    """
+    Calcula las rutas de ida y retorno de todos los servicios de un rango
+        de fechas.
+
+    Las métricas del cálculo (tiempo por etapa, latencias y costo de la
+    API, filas y grupos procesados) se registran bajo `id_ejecucion`; si no
+    se indica, se usa la ejecución activa o se crea una nueva. El reporte
+    se obtiene con decoradores.registro_metricas.reporte(id_ejecucion).
+
+    `motor` selecciona cómo se dividen los grupos en rutas finales:
+    'directions', 'matriz' o 'vrp' (ver obtener_rutas_ida).
+
+    Con `incremental` cada día parte de su cálculo anterior con los mismos
+    parámetros (ver estado_rutas) y solo se recalculan los grupos de
+    RUTA_INICIAL con servicios nuevos, cancelados o modificados. Con
+    `plantillas` los grupos recurrentes entre días (mismos pasajeros,
+    destino y franja horaria) reutilizan sus rutas finales sin
+    solicitudes de rutas (ver plantillas_rutas).
+
+    Returns:
+        tuple: DataFrames de rutas de ida y de retorno.
+    """
+    with ejecucion(id_ejecucion or ejecucion_actual()), \
+            cronometro('servicios_completos'):
+        return _servicios_completos(
+            fecha_inicio, fecha_final, tipo_prod, tiempo_aprox, by_excel,
+            n_procesos, n_hilos, ciudad_origen, ciudad_destino,
+            regional_origen, regional_destino, proveedor, motor, incremental,
+            plantillas)
+
+
+def _servicios_completos(
+        fecha_inicio, fecha_final, tipo_prod, tiempo_aprox, by_excel,
+        n_procesos, n_hilos, ciudad_origen, ciudad_destino, regional_origen,
+        regional_destino, proveedor, motor, incremental, plantillas):
     try:
         max_distancia_km = (1/15)*tiempo_aprox
         if by_excel:
             df_servicios = pd.read_csv(by_excel)
             df_servicios.columns = [
                 col.upper() for col in df_servicios.columns]
+            df_servicios = tipar_columnas(df_servicios)
+            dias = df_servicios.groupby('FECHA_SERVICIO', sort=False)
         else:
-            df_servicios = obtener_servicios(
-                fecha_inicio, fecha_final, tipo_prod)
-        df_rutas_ida = pd.DataFrame()
-        for valor in df_servicios['FECHA_SERVICIO'].unique().tolist():
-            validator = df_servicios['FECHA_SERVICIO'] == valor
-            df_dia = df_servicios[validator].copy()
-            print(f"Calculando rutas fecha: {valor} con {df_dia.shape[0]} pasajeros")
-            df_ida, _ = obtener_rutas_ida(df_dia, max_distancia_km)
-            if not df_ida.empty:
-                df_ida['RUTA_FINAL'] = "-".join(valor.split("-")[1:]) + \
-                    "_" + df_ida['RUTA_FINAL']
-                df_rutas_ida = pd.concat([df_rutas_ida, df_ida], axis=0)
-        df_retorno, _ = obtener_rutas_cercanas(df_servicios, 1)
-        df_ruta_ida = df_rutas_ida[
-            ['IDENTIFICACION_USUARIO', 'FECHA_SERVICIO', 'RUTA_FINAL']].copy()
-        df_rutas_retorno = df_retorno.merge(
-            df_ruta_ida, on=['IDENTIFICACION_USUARIO', 'FECHA_SERVICIO'], how='left')
+            # Los días se procesan a medida que llegan de la base de datos
+            dias = obtener_servicios_por_dia(
+                fecha_inicio, fecha_final, tipo_prod,
+                ciudad_origen=ciudad_origen, ciudad_destino=ciudad_destino,
+                regional_origen=regional_origen,
+                regional_destino=regional_destino)
+        executor = ProcessPoolExecutor(max_workers=n_procesos) \
+            if n_procesos and n_procesos > 1 else None
+        # Solo se conservan los resultados de cada día, no sus servicios
+        resultados, pendientes = [], []
+        try:
+            for valor, df_dia in dias:
+                # Las columnas que solo se exportan no viajan por el ruteo
+                df_dia, df_ancho, columnas = separar_columnas(df_dia)
+                contar('ruteo_dias_total')
+                argumentos = (valor, df_dia, max_distancia_km, n_hilos,
+                              proveedor, motor, incremental, plantillas)
+                if executor:
+                    # Cada proceso recibe solo los servicios de su día
+                    pendientes.append((executor.submit(
+                        rutas_dia_proceso, *argumentos), df_ancho, columnas))
+                else:
+                    resultados.append(
+                        (*rutas_dia(*argumentos), df_ancho, columnas))
+                del df_dia, argumentos
+            for futuro, df_ancho, columnas in pendientes:
+                df_ida, df_retorno, metricas = futuro.result()
+                registro_metricas.combinar(ejecucion_actual(), metricas)
+                resultados.append((df_ida, df_retorno, df_ancho, columnas))
+        finally:
+            if executor:
+                executor.shutdown()
+            # Cierra el cursor de la consulta si el ciclo no lo agotó
+            if hasattr(dias, 'close'):
+                dias.close()
+        rutas_ida = [unir_columnas(df_ida, df_ancho, columnas)
+                     for df_ida, _, df_ancho, columnas in resultados
+                     if not df_ida.empty]
+        rutas_retorno = [unir_columnas(df_retorno, df_ancho, columnas)
+                         for _, df_retorno, df_ancho, columnas in resultados]
+        df_rutas_ida = pd.concat(rutas_ida, axis=0) if rutas_ida \
+            else pd.DataFrame()
+        df_rutas_retorno = pd.concat(rutas_retorno, axis=0) \
+            if rutas_retorno else pd.DataFrame()
     except Exception as e:
         print(e)
         traceback.print_exc()
@@ -0,0 +1,661 @@
+"""
+    tests.py
+"""
+import itertools
+import os
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+from sklearn.metrics.pairwise import haversine_distances
+from apps.ruteo.conexion import (
+    Connection, parametros_servicios, registro_consultas)
+from apps.ruteo.calculos import (
+    filtrar_coordenadas_por_distancia, filtrar_origenes_por_distancia)
+from apps.ruteo.estado_rutas import EstadoRutas
+from apps.ruteo.google_maps import calcular_ruta_por_partes
+from apps.ruteo.proveedores import ProveedorLineaRecta
+from apps.ruteo.optimizacion import ProblemaRutas, ordenar_waypoints
+from apps.ruteo.plantillas_rutas import (
+    PlantillasRutas, aplicar_plantilla, huella_grupo)
+from apps.ruteo.ruta import MOTORES_RUTA, obtener_rutas_ida
+from apps.ruteo.preprocesamiento import (
+    agrupar_por_destinos, agrupar_por_horas, obtener_ruta_previa)
+
+
+class FiltrarOrigenesPorDistanciaTest(unittest.TestCase):
+    """
+    Compara filtrar_origenes_por_distancia con la versión fila a fila
+        filtrar_coordenadas_por_distancia.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(3)
+
+    def polilinea_aleatoria(self, n_vertices):
+        """Recorrido aleatorio de `n_vertices` vértices alrededor de Bogotá."""
+        pasos = self.rng.normal(0, 0.002, size=(n_vertices, 2))
+        return np.array([4.65, -74.08]) + np.cumsum(pasos, axis=0)
+
+    def comparar(self, origenes, polilinea, max_distancia_km, **kwargs):
+        df = pd.DataFrame(origenes, columns=['LATITUD_ORIGEN', 'LONGITUD_ORIGEN'])
+        esperado = np.array([
+            filtrar_coordenadas_por_distancia(
+                fila, [tuple(v) for v in polilinea], max_distancia_km)
+            for _, fila in df.iterrows()], dtype=bool)
+        cercanos, distancias = filtrar_origenes_por_distancia(
+            origenes, polilinea, max_distancia_km, **kwargs)
+        np.testing.assert_array_equal(cercanos, esperado)
+        self.assertEqual(distancias.shape, (len(origenes),))
+
+    def test_polilineas_aleatorias(self):
+        for _ in range(30):
+            polilinea = self.polilinea_aleatoria(int(self.rng.integers(1, 80)))
+            origenes = polilinea.mean(axis=0) + self.rng.normal(
+                0, 0.02, size=(int(self.rng.integers(1, 40)), 2))
+            self.comparar(origenes, polilinea,
+                          float(self.rng.uniform(0.1, 3)))
+
+    def test_bloques_pequenos(self):
+        # Con max_elementos pequeño la polilínea se recorre en varios bloques
+        for max_elementos in [1, 7, 50]:
+            polilinea = self.polilinea_aleatoria(120)
+            origenes = polilinea.mean(axis=0) + self.rng.normal(
+                0, 0.02, size=(25, 2))
+            self.comparar(origenes, polilinea, 1.0,
+                          max_elementos=max_elementos)
+
+    def test_polilinea_vacia(self):
+        origenes = np.array([[4.65, -74.08], [4.66, -74.07]])
+        cercanos, distancias = filtrar_origenes_por_distancia(
+            origenes, np.empty((0, 2)), 2)
+        self.assertFalse(cercanos.any())
+        self.assertTrue(np.isinf(distancias).all())
+
+
+def _agrupar_por_destinos_densa(df_pasajeros):
+    """Agrupación original: matriz de distancias N x N precalculada."""
+    destinos_rad = np.radians(
+        df_pasajeros[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].to_numpy())
+    distancias = haversine_distances(destinos_rad) * 6371000
+    dbscan = DBSCAN(eps=100, min_samples=1, metric='precomputed')
+    return dbscan.fit_predict(distancias)
+
+
+class AgruparPorDestinosTest(unittest.TestCase):
+    """
+    Compara agrupar_por_destinos con la agrupación de la matriz densa de
+        haversine_distances, con epsilon de 100 metros.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(5)
+
+    def destinos_aleatorios(self, n_pasajeros, n_sedes):
+        """Destinos alrededor de unas sedes, con destinos repetidos."""
+        sedes = np.array([4.65, -74.08]) + self.rng.normal(
+            0, 0.03, size=(n_sedes, 2))
+        destinos = sedes[self.rng.integers(0, n_sedes, n_pasajeros)]
+        # Cerca de la mitad se desplaza hasta ~200 m; el resto se repite
+        desplazados = self.rng.random(n_pasajeros) < 0.5
+        destinos[desplazados] += self.rng.normal(
+            0, 0.0008, size=(desplazados.sum(), 2))
+        return pd.DataFrame(
+            destinos, columns=['LATITUD_DESTINO', 'LONGITUD_DESTINO'])
+
+    def test_etiquetas_identicas(self):
+        for _ in range(30):
+            df = self.destinos_aleatorios(
+                int(self.rng.integers(1, 200)), int(self.rng.integers(1, 15)))
+            np.testing.assert_array_equal(
+                agrupar_por_destinos(df), _agrupar_por_destinos_densa(df))
+
+    def test_destinos_repetidos(self):
+        df = pd.DataFrame({'LATITUD_DESTINO': [4.6, 4.7, 4.6, 4.6, 4.7],
+                           'LONGITUD_DESTINO': [-74.1, -74.0, -74.1, -74.1,
+                                                -74.0]})
+        etiquetas = agrupar_por_destinos(df)
+        np.testing.assert_array_equal(etiquetas, [0, 1, 0, 0, 1])
+        np.testing.assert_array_equal(
+            etiquetas, _agrupar_por_destinos_densa(df))
+
+    def test_sin_pasajeros(self):
+        df = pd.DataFrame({'LATITUD_DESTINO': [], 'LONGITUD_DESTINO': []},
+                          dtype=float)
+        self.assertEqual(len(agrupar_por_destinos(df)), 0)
+
+
+def _agrupar_por_horas_iterrows(df_pasajeros):
+    """Implementación original de agrupar_por_horas, fila a fila."""
+    ruta = 0
+    max_mins = 10
+    df_pasajeros['GRUPO_HORA'] = None
+    hora = df_pasajeros.loc[0, 'HORA_SERVICIO_C']
+    for indice, row in df_pasajeros.iterrows():
+        hora_actual = row['HORA_SERVICIO_C']
+        diff_hora = hora_actual - hora
+        if diff_hora < pd.Timedelta(0):
+            diff_hora = hora - hora_actual
+        if diff_hora > pd.Timedelta(minutes=max_mins):
+            hora = hora_actual
+            ruta += 1
+        df_pasajeros.loc[indice, 'GRUPO_HORA'] = ruta
+    return df_pasajeros
+
+
+def _obtener_ruta_previa_iterrows(df_pasajeros):
+    """Implementación original de obtener_ruta_previa, fila a fila."""
+    ruta = 0
+    grupo_hora = 0
+    grupo_destino = 0
+    df_pasajeros['RUTA_PREVIA'] = None
+    for indice, row in df_pasajeros.iterrows():
+        hora_actual = row['GRUPO_HORA']
+        destino_actual = row['GRUPO_DESTINO']
+        if not (grupo_hora == hora_actual and grupo_destino == destino_actual):
+            ruta += 1
+        df_pasajeros.loc[indice, 'RUTA_PREVIA'] = ruta
+        grupo_hora = hora_actual
+        grupo_destino = destino_actual
+    return df_pasajeros
+
+
+def _horas(*horas):
+    """DataFrame con HORA_SERVICIO_C a partir de horas 'HH:MM:SS'."""
+    return pd.DataFrame({'HORA_SERVICIO_C': pd.to_datetime(
+        list(horas), format='%H:%M:%S')})
+
+
+class AgruparPorHorasTest(unittest.TestCase):
+    """Compara agrupar_por_horas con la implementación con iterrows."""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(6)
+
+    def comparar(self, df):
+        esperado = _agrupar_por_horas_iterrows(df.copy())['GRUPO_HORA']
+        obtenido = agrupar_por_horas(df.copy())['GRUPO_HORA']
+        np.testing.assert_array_equal(
+            obtenido.to_numpy(), esperado.to_numpy(dtype=int))
+        return obtenido.tolist()
+
+    def test_horas_aleatorias(self):
+        for _ in range(50):
+            minutos = self.rng.integers(0, 24 * 60, int(self.rng.integers(1, 60)))
+            if self.rng.random() < 0.5:
+                minutos = np.sort(minutos)
+            df = _horas(*[f"{m // 60:02d}:{m % 60:02d}:00" for m in minutos])
+            self.comparar(df)
+
+    def test_limite_de_diez_minutos(self):
+        # Exactamente 10 minutos sigue en el grupo; un segundo más no
+        self.assertEqual(
+            self.comparar(_horas('08:00:00', '08:10:00', '08:20:01')),
+            [0, 0, 1])
+        self.assertEqual(
+            self.comparar(_horas('08:10:00', '08:00:00', '07:59:59')),
+            [0, 0, 1])
+
+    def test_una_fila(self):
+        self.assertEqual(self.comparar(_horas('06:30:00')), [0])
+
+    def test_sin_filas(self):
+        df = agrupar_por_horas(_horas())
+        self.assertIn('GRUPO_HORA', df.columns)
+        self.assertEqual(len(df), 0)
+
+
+class ObtenerRutaPreviaTest(unittest.TestCase):
+    """Compara obtener_ruta_previa con la implementación con iterrows."""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(7)
+
+    def comparar(self, df):
+        esperado = _obtener_ruta_previa_iterrows(df.copy())['RUTA_PREVIA']
+        obtenido = obtener_ruta_previa(df.copy())['RUTA_PREVIA']
+        np.testing.assert_array_equal(
+            obtenido.to_numpy(), esperado.to_numpy(dtype=int))
+        return obtenido.tolist()
+
+    def test_grupos_aleatorios(self):
+        for _ in range(50):
+            n_filas = int(self.rng.integers(1, 60))
+            df = pd.DataFrame({
+                'GRUPO_HORA': np.sort(self.rng.integers(0, 5, n_filas)),
+                'GRUPO_DESTINO': self.rng.integers(0, 3, n_filas)})
+            self.comparar(df)
+
+    def test_primera_fila(self):
+        # La primera fila se compara contra la pareja (0, 0)
+        df = pd.DataFrame({'GRUPO_HORA': [0, 0, 1], 'GRUPO_DESTINO': [0, 0, 0]})
+        self.assertEqual(self.comparar(df), [0, 0, 1])
+        df = pd.DataFrame({'GRUPO_HORA': [0, 0, 1], 'GRUPO_DESTINO': [2, 2, 2]})
+        self.assertEqual(self.comparar(df), [1, 1, 2])
+
+    def test_una_fila(self):
+        df = pd.DataFrame({'GRUPO_HORA': [3], 'GRUPO_DESTINO': [1]})
+        self.assertEqual(self.comparar(df), [1])
+
+    def test_sin_filas(self):
+        df = obtener_ruta_previa(pd.DataFrame(
+            {'GRUPO_HORA': [], 'GRUPO_DESTINO': []}, dtype=int))
+        self.assertEqual(len(df['RUTA_PREVIA']), 0)
+
+
+# Base de datos PostgreSQL desechable (p. ej. "dbname=ruteo_pruebas") para
+# probar la consulta de servicios; las tablas se crean dentro de una
+# transacción que se revierte al terminar
+TEST_DSN = os.environ.get('RUTEO_TEST_DSN')
+
+TABLAS_SERVICIOS = """
+CREATE TABLE public.general_departamento (id integer PRIMARY KEY);
+CREATE TABLE public.general_ciudad (
+    id integer PRIMARY KEY, "Departamento_id" integer, nombre text);
+CREATE TABLE public.general_localidad (
+    id integer PRIMARY KEY, "Ciudad_id" integer, nombre text);
+CREATE TABLE public.general_upz (
+    id integer PRIMARY KEY, "Localidad_id" integer, nombre text);
+CREATE TABLE public.general_barrio (
+    id integer PRIMARY KEY, "Upz_id" integer, nombre text);
+CREATE TABLE public.destinos_destino (
+    id integer PRIMARY KEY, barrio_id integer, direccion text,
+    descripcion text, latitude text, longitude text);
+CREATE TABLE public.clientes_cliente (id integer PRIMARY KEY);
+CREATE TABLE public.pasajeros_categoriapasajero (id integer PRIMARY KEY);
+CREATE TABLE public."mediosApoyo_medioapoyo" (id integer PRIMARY KEY);
+CREATE TABLE public.pasajeros_pasajero (
+    id integer PRIMARY KEY, numero_documento text, primer_nombre text,
+    primer_apellido text, cliente_id integer,
+    "categoria_Pasajero_id" integer, medio_id integer,
+    "telefono_Celular1" text);
+CREATE TABLE public.servicios_estadoservicio (id integer PRIMARY KEY);
+CREATE TABLE public.servicios_tiporuta (id integer PRIMARY KEY);
+CREATE TABLE public.servicios_servicio (
+    id integer PRIMARY KEY, "observacionesOperador" text,
+    "codigoServicio_id" integer, "tipoRuta_id" integer,
+    pasajero_id integer, destino_id integer, origen_id integer,
+    "fechaServicio" timestamp, detalle boolean,
+    "tipoProcedimiento_id" integer, "estadoServicio_id" integer);
+INSERT INTO public.general_departamento VALUES (1), (2);
+INSERT INTO public.general_ciudad VALUES (11, 1, 'Bogota'), (21, 2, 'Cali');
+INSERT INTO public.general_localidad VALUES (1, 11, 'L1'), (2, 21, 'L2');
+INSERT INTO public.general_upz VALUES (1, 1, 'U1'), (2, 2, 'U2');
+INSERT INTO public.general_barrio VALUES (1, 1, 'B1'), (2, 2, 'B2');
+INSERT INTO public.destinos_destino VALUES
+    (1, 1, 'Calle 1', '', '4.65', '-74.08'),
+    (2, 1, 'Calle 2', '', '4.70', '-74.05'),
+    (3, 2, 'Calle 3', '', '3.45', '-76.53');
+INSERT INTO public.pasajeros_pasajero VALUES
+    (1, '100', 'Ana', 'Gil', NULL, NULL, 1, ''),
+    (2, '200', 'Luis', 'Paz', NULL, NULL, 25, '');
+"""
+
+# (id, pasajero, origen, destino, fecha UTC, ida, tipo, estado)
+SERVICIOS = [
+    (1, 1, 1, 2, '2023-05-02 12:00', True, 14, 3),
+    (2, 1, 2, 1, '2023-05-02 20:00', False, 14, 3),
+    (3, 1, 1, 3, '2023-05-03 13:00', True, 14, 4),
+    (4, 1, 1, 2, '2023-05-03 14:00', True, 15, 4),
+    (5, 2, 1, 2, '2023-05-03 15:00', True, 14, 4),
+    (6, 1, 1, 2, '2023-05-03 16:00', True, 14, 1),
+    (7, 1, 3, 1, '2023-05-04 12:00', False, 14, 5),
+    (8, 1, 1, 2, '2023-05-05 02:00', True, 14, 5),
+]
+
+
+@unittest.skipUnless(TEST_DSN, 'RUTEO_TEST_DSN no está definida')
+class ConsultaServiciosTest(unittest.TestCase):
+    """
+    Ejecuta la consulta de servicios contra PostgreSQL con parámetros
+        enlazados, en un cursor normal y en uno del lado del servidor.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import psycopg2
+        cls.conn = psycopg2.connect(TEST_DSN)
+        with cls.conn.cursor() as cursor:
+            cursor.execute(TABLAS_SERVICIOS)
+            cursor.executemany(
+                'INSERT INTO public.servicios_servicio VALUES '
+                '(%s, NULL, NULL, NULL, %s, %s, %s, %s, %s, %s, %s)',
+                [(id_, pasajero, destino, origen, fecha, ida, tipo, estado)
+                 for id_, pasajero, origen, destino, fecha, ida, tipo, estado
+                 in SERVICIOS])
+        cls.connection = Connection.__new__(Connection)
+        cls.connection.conn = cls.conn
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.rollback()
+        cls.conn.close()
+
+    def consultar(self, *args, **kwargs):
+        datos = parametros_servicios(*args, **kwargs)[1]
+        return self.connection.execute_query('obtain_services', datos)
+
+    def filtros(self, **kwargs):
+        filtros = dict(
+            tipo_prod_list=[14], ciudad_origen=None, ciudad_destino=None,
+            regional_origen=None, regional_destino=None,
+            detalle_servicio=None)
+        filtros.update(kwargs)
+        return filtros
+
+    def test_sin_filtros(self):
+        df = self.consultar('2023-05-02', '2023-05-04', **self.filtros())
+        # La consulta solo ordena por fecha
+        df = df.sort_values('SERVICIO_ID')
+        self.assertEqual(df['SERVICIO_ID'].tolist(), [1, 2, 3, 7, 8])
+        # Las fechas y horas se convierten a la hora de Bogotá
+        self.assertEqual(df['FECHA_SERVICIO'].tolist(), [
+            '2023-05-02', '2023-05-02', '2023-05-03', '2023-05-04',
+            '2023-05-04'])
+        self.assertEqual(df['HORA_SERVICIO'].iat[0], '07:00:00')
+
+    def test_filtros_opcionales(self):
+        df = self.consultar('2023-05-02', '2023-05-04', **self.filtros(
+            ciudad_destino=21))
+        self.assertEqual(df['SERVICIO_ID'].tolist(), [3])
+        df = self.consultar('2023-05-02', '2023-05-04', **self.filtros(
+            regional_origen='2', detalle_servicio=1))
+        self.assertEqual(df['SERVICIO_ID'].tolist(), [7])
+        df = self.consultar('2023-05-02', '2023-05-04', **self.filtros(
+            tipo_prod_list=[14, 15], detalle_servicio=0))
+        self.assertEqual(sorted(df['SERVICIO_ID']), [1, 3, 4, 8])
+
+    def test_bloques_por_dia(self):
+        datos = parametros_servicios(
+            '2023-05-01', '2023-05-05', **self.filtros())[1]
+        completo = self.connection.execute_query('obtain_services', datos)
+        for tamano_bloque in (1, 2, 100):
+            dias = list(self.connection.stream_query(
+                'obtain_services', datos, tamano_bloque=tamano_bloque,
+                columna_grupo='FECHA_SERVICIO'))
+            self.assertEqual(
+                [df['FECHA_SERVICIO'].unique().tolist() for df in dias],
+                [['2023-05-02'], ['2023-05-03'], ['2023-05-04']])
+            self.assertEqual(
+                sorted(pd.concat(dias)['SERVICIO_ID']),
+                sorted(completo['SERVICIO_ID']))
+
+    def test_parametros_faltantes(self):
+        with self.conn.cursor() as cursor:
+            with self.assertRaises(ValueError):
+                registro_consultas.ejecutar(
+                    cursor, 'obtain_services', {'fecha_inicio': '2023-05-02'})
+
+
+class PlantillasRutasTest(unittest.TestCase):
+    """
+    Reutilización de plantillas de un grupo recurrente.
+    """
+
+    def setUp(self):
+        self.almacen = PlantillasRutas(':memory:')
+        self.df_ruta = pd.DataFrame({
+            'IDENTIFICACION_USUARIO': ['1', '2', '3'],
+            'LATITUD_ORIGEN': [4.60, 4.62, 4.64],
+            'LONGITUD_ORIGEN': [-74.10, -74.09, -74.08],
+            'LATITUD_DESTINO': [4.70] * 3,
+            'LONGITUD_DESTINO': [-74.05] * 3,
+            'HORA_SERVICIO_C': pd.to_datetime(
+                ['08:00:00'] * 3, format='%H:%M:%S')})
+        self.almacen.guardar(
+            huella_grupo(self.df_ruta), 'p', self.df_ruta,
+            pd.Series(['7_1', '7_1', '7_2']), pd.Series([1, 2, 1]))
+
+    def test_mismo_grupo(self):
+        asignacion = self.almacen.buscar(huella_grupo(self.df_ruta), 'p')
+        etiquetas, orden = aplicar_plantilla(9, self.df_ruta, asignacion)
+        self.assertEqual(etiquetas.tolist(), ['9_1', '9_1', '9_2'])
+        self.assertEqual(orden.tolist(), [1, 2, 1])
+        self.assertTrue(pd.api.types.is_integer_dtype(orden))
+
+    def test_subconjunto(self):
+        df_ruta = self.df_ruta.iloc[1:]
+        asignacion = self.almacen.buscar(huella_grupo(df_ruta), 'p')
+        self.assertIsNone(asignacion)
+        self.almacen.umbral = 0.5
+        asignacion = self.almacen.buscar(huella_grupo(df_ruta), 'p')
+        etiquetas, orden = aplicar_plantilla(9, df_ruta, asignacion)
+        self.assertEqual(etiquetas.tolist(), ['9_1', '9_2'])
+        self.assertEqual(orden.tolist(), [1, 1])
+        self.assertEqual(orden.dtype, np.int64)
+
+    def test_pasajero_en_otro_origen(self):
+        self.almacen.umbral = 0.5
+        df_ruta = self.df_ruta.copy()
+        df_ruta.loc[0, 'LATITUD_ORIGEN'] += 0.05
+        self.assertIsNone(self.almacen.buscar(huella_grupo(df_ruta), 'p'))
+
+
+def _duracion_camino(tiempos, orden):
+    """Duración del camino origen -> waypoints en `orden` -> destino."""
+    paradas = [0, *[waypoint + 1 for waypoint in orden], len(tiempos) - 1]
+    return sum(tiempos[a, b] for a, b in zip(paradas[:-1], paradas[1:]))
+
+
+class OrdenarWaypointsTest(unittest.TestCase):
+    """
+    Compara ordenar_waypoints con la fuerza bruta en matrices pequeñas.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(21)
+
+    def comparar(self, tiempos):
+        n_waypoints = len(tiempos) - 2
+        orden = ordenar_waypoints(tiempos)
+        self.assertEqual(sorted(orden), list(range(n_waypoints)))
+        optimo = min(
+            _duracion_camino(tiempos, permutacion) for permutacion in
+            itertools.permutations(range(n_waypoints)))
+        self.assertAlmostEqual(_duracion_camino(tiempos, orden), optimo)
+
+    def test_tiempos_asimetricos(self):
+        for n_waypoints in range(7):
+            for _ in range(20):
+                tiempos = self.rng.uniform(
+                    60, 1800, size=(n_waypoints + 2, n_waypoints + 2))
+                np.fill_diagonal(tiempos, 0)
+                self.comparar(tiempos)
+
+    def test_tiempos_euclidianos(self):
+        for n_waypoints in range(7):
+            for _ in range(20):
+                puntos = self.rng.uniform(size=(n_waypoints + 2, 2))
+                self.comparar(np.linalg.norm(
+                    puntos[:, None] - puntos[None], axis=2))
+
+    def test_tramos_sin_ruta(self):
+        tiempos = self.rng.uniform(60, 1800, size=(7, 7))
+        tiempos[2, 1:-1] = np.inf
+        orden = ordenar_waypoints(tiempos)
+        self.assertEqual(sorted(orden), list(range(5)))
+        # El waypoint sin rutas hacia otros waypoints queda de último
+        self.assertEqual(orden[-1], 1)
+
+    def test_muchos_waypoints(self):
+        tiempos = self.rng.uniform(60, 1800, size=(14, 14))
+        self.assertEqual(sorted(ordenar_waypoints(tiempos)), list(range(12)))
+
+
+class ProblemaRutasTest(unittest.TestCase):
+    """
+    Las rutas de ProblemaRutas.resolver son factibles y cubren a cada
+        pasajero una sola vez.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(20)
+
+    def problema_aleatorio(self, n_pasajeros):
+        puntos = self.rng.uniform(0, 0.1, size=(n_pasajeros + 1, 2))
+        # Tiempos en segundos, asimétricos por el ruido
+        tiempos = np.linalg.norm(puntos[:, None] - puntos[None], axis=2) * \
+            1e4 * self.rng.uniform(0.8, 1.2, size=(n_pasajeros + 1,) * 2)
+        np.fill_diagonal(tiempos, 0)
+        return ProblemaRutas(
+            tiempos, self.rng.choice([0, 900, 1800], size=n_pasajeros),
+            demandas=self.rng.integers(1, 3, size=n_pasajeros),
+            capacidad=int(self.rng.integers(2, 6)),
+            max_duracion=float(self.rng.uniform(600, 2400)),
+            max_espera=900, costo_vehiculo=600)
+
+    def test_rutas_factibles(self):
+        for _ in range(50):
+            n_pasajeros = int(self.rng.integers(1, 25))
+            problema = self.problema_aleatorio(n_pasajeros)
+            rutas = problema.resolver()
+            self.assertEqual(
+                sorted(pasajero for ruta in rutas for pasajero in ruta),
+                list(range(n_pasajeros)))
+            for ruta in rutas:
+                self.assertTrue(problema.factible(ruta))
+
+    def test_ventana_de_tiempo(self):
+        # Dos pasajeros vecinos con horas de servicio muy distintas no
+        # comparten vehículo
+        tiempos = np.array([[0, 60, 600], [60, 0, 600], [600, 600, 0]])
+        problema = ProblemaRutas(tiempos, [0, 3600], max_espera=900)
+        self.assertEqual(sorted(problema.resolver()), [[0], [1]])
+        problema = ProblemaRutas(tiempos, [0, 600], max_espera=900)
+        self.assertEqual(len(problema.resolver()), 1)
+
+    def test_sin_pasajeros(self):
+        self.assertEqual(ProblemaRutas(np.zeros((1, 1))).resolver(), [])
+
+
+class CalcularRutaPorPartesTest(unittest.TestCase):
+    """
+    Unión de tramos de una ruta con más waypoints que el límite del
+        proveedor.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(22)
+        self.proveedor = ProveedorLineaRecta()
+        self.proveedor.max_waypoints = 3
+        self.origen = (4.55, -74.10)
+        self.destino = (4.65, -74.05)
+
+    def comprobar(self, n_waypoints, optimize):
+        waypoints = [tuple(punto) for punto in self.rng.uniform(
+            [4.50, -74.20], [4.80, -74.00], size=(n_waypoints, 2))]
+        ruta = calcular_ruta_por_partes(
+            self.origen, self.destino, waypoints, optimize=optimize,
+            proveedor=self.proveedor)[0]
+        orden = ruta['waypoint_order']
+        self.assertEqual(sorted(orden), list(range(n_waypoints)))
+        self.assertEqual(len(ruta['legs']), n_waypoints + 1)
+        # Los trayectos recorren las paradas en el orden retornado
+        paradas = [self.origen, *[waypoints[i] for i in orden], self.destino]
+        for leg, inicio, fin in zip(ruta['legs'], paradas[:-1], paradas[1:]):
+            self.assertEqual(
+                (leg['start_location']['lat'], leg['start_location']['lng']),
+                inicio)
+            self.assertEqual(
+                (leg['end_location']['lat'], leg['end_location']['lng']), fin)
+        return orden
+
+    def test_optimizada(self):
+        for n_waypoints in (1, 3, 4, 7, 12, 25):
+            self.comprobar(n_waypoints, optimize=True)
+
+    def test_sin_optimizar(self):
+        for n_waypoints in (1, 3, 4, 7, 12, 25):
+            self.assertEqual(self.comprobar(n_waypoints, optimize=False),
+                             list(range(n_waypoints)))
+
+
+class RuteoIncrementalTest(unittest.TestCase):
+    """
+    Un cambio en un servicio recalcula solo su grupo de RUTA_INICIAL; los
+        demás grupos conservan las rutas finales del estado guardado.
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(23)
+        filas = []
+        # Cuatro grupos: dos destinos por dos horas de servicio
+        for destino in ((4.70, -74.05), (4.60, -74.15)):
+            for hora in ('07:00:00', '09:00:00'):
+                for _ in range(5):
+                    filas.append(self.servicio(len(filas) + 1, destino, hora))
+        self.df_dia = pd.DataFrame(filas)
+        self.estado = EstadoRutas(':memory:')
+        self.estado.guardar('2023-05-02', 'p', self.rutas(self.df_dia)[0])
+        self.anterior = self.estado.obtener('2023-05-02', 'p')
+
+    def servicio(self, servicio_id, destino, hora):
+        origen = np.array(destino) + self.rng.uniform(-0.03, 0.03, size=2)
+        return {
+            'SERVICIO_ID': servicio_id,
+            'IDENTIFICACION_USUARIO': str(1000 + servicio_id),
+            'FECHA_SERVICIO': '2023-05-02', 'HORA_SERVICIO': hora,
+            'DETALLE_SERVICIO': 'Ida', 'CIUDAD_DESTINO': 'Bogota',
+            'LATITUD_ORIGEN': origen[0], 'LONGITUD_ORIGEN': origen[1],
+            'LATITUD_DESTINO': destino[0], 'LONGITUD_DESTINO': destino[1]}
+
+    def rutas(self, df_dia, anterior=None):
+        """Rutas de ida del día y SERVICIO_ID de cada grupo recalculado."""
+        calculados = []
+        motor = MOTORES_RUTA['matriz']
+
+        def registrar(valor, df_ruta, *args):
+            calculados.append(set(df_ruta['SERVICIO_ID']))
+            return motor(valor, df_ruta, *args)
+
+        with mock.patch.dict(MOTORES_RUTA, {'matriz': registrar}):
+            df_ida, _ = obtener_rutas_ida(
+                df_dia.copy(), 2, n_hilos=1, proveedor='linea_recta',
+                motor='matriz', anterior=anterior)
+        return df_ida, calculados
+
+    def grupo(self, servicio_id):
+        """SERVICIO_ID del grupo de RUTA_INICIAL de un servicio."""
+        ruta = self.anterior.loc[
+            self.anterior['SERVICIO_ID'] == servicio_id, 'RUTA_INICIAL'].iat[0]
+        return set(self.anterior.loc[
+            self.anterior['RUTA_INICIAL'] == ruta, 'SERVICIO_ID'])
+
+    def comprobar(self, df_dia, esperado):
+        df_ida, calculados = self.rutas(df_dia, self.anterior)
+        self.assertEqual(calculados, [esperado])
+        # Los demás servicios conservan su ruta final y orden de recogida
+        actual = df_ida.set_index('SERVICIO_ID')
+        previo = self.anterior.set_index('SERVICIO_ID')
+        otros = sorted(set(actual.index) - esperado)
+        self.assertEqual(len(otros), 15)
+        self.assertEqual(
+            actual.loc[otros, 'RUTA_FINAL'].str.split('_').str[1].tolist(),
+            previo.loc[otros, 'RUTA_FINAL'].str.split('_').str[1].tolist())
+        self.assertEqual(actual.loc[otros, 'ORDEN_RECOGIDA'].tolist(),
+                         previo.loc[otros, 'ORDEN_RECOGIDA'].tolist())
+        self.assertTrue((actual['RUTA_FINAL'].str.split('_').str[0].astype(int)
+                         == actual['RUTA_INICIAL']).all())
+
+    def test_sin_cambios(self):
+        self.assertEqual(len(self.rutas(self.df_dia)[1]), 4)
+        self.assertEqual(self.rutas(self.df_dia, self.anterior)[1], [])
+
+    def test_servicio_cancelado(self):
+        self.comprobar(self.df_dia[self.df_dia['SERVICIO_ID'] != 7],
+                       self.grupo(7) - {7})
+
+    def test_servicio_nuevo(self):
+        nuevo = self.servicio(21, (4.60, -74.15), '07:00:00')
+        self.comprobar(pd.concat([self.df_dia, pd.DataFrame([nuevo])],
+                                 ignore_index=True), self.grupo(11) | {21})
+
+    def test_origen_modificado(self):
+        df_dia = self.df_dia.copy()
+        df_dia.loc[df_dia['SERVICIO_ID'] == 17, 'LATITUD_ORIGEN'] += 0.01
+        self.comprobar(df_dia, self.grupo(17))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
 """
     tiempo.py
 """
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+from apps.ruteo.constantes import (
+    MAX_DURATION, RUTAS_MAX_HILOS, RUTAS_ORDEN_LOCAL)
+from apps.ruteo.calculos import duracion_estimada_ruta
+from apps.ruteo.geo import distancias_fila
+from apps.ruteo.google_maps import (
+    calcular_ruta, calcular_rutas_batch, orden_waypoints)
+from apps.ruteo.decoradores import etapa, en_contexto
 
 
 def duracion_estimada_por_ruta_previa(df_group):
@@ -22,6 +31,7 @@ def duracion_estimada_por_ruta_previa(df_group):
                 'DURACION_CALCULADA' que contiene la duración estimada de la
                 ruta en segundos.
     """
+    from apps.ruteo.ruta import encontrar_origen_mas_lejano
     destino_row = df_group.sample(n=1)
     print(f"Estimando duración de la ruta {destino_row['RUTA_PREVIA'].values[0]}")
     origenes = df_group[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].values.tolist()
@@ -35,9 +45,6 @@ def duracion_estimada_por_ruta_previa(df_group):
     return df_group
 
 
-
-
-
 def obtener_hora_salida(hora_maxima, fecha_str):
     """
     Calcula la hora de salida para un viaje, considerando una hora máxima y una duración máxima.
@@ -125,6 +132,7 @@ def duracion_real_por_ruta_previa(df_group):
         duracion_total = obtener_duracion_real_ruta(ruta_previa)
         print(duracion_total)
     """
+    from apps.ruteo.ruta import encontrar_origen_mas_lejano, ordenar_ruta
     print(f"Calculando duración real de la ruta {max(df_group['RUTA_PREVIA'])}")
     # Obtener la hora y fecha de la ruta:
     fecha_hora_viaje = obtener_hora_salida(
@@ -144,15 +152,367 @@ def duracion_real_por_ruta_previa(df_group):
     duracion = obtener_duracion_real_ruta(ruta)
     df_group['DURACION_REAL'] = duracion
     if duracion <= MAX_DURATION:
-        orden_intermedios = ruta[0]['waypoint_order']
+        # Los intermedios ya están en orden de visita
         for i, coordinate in enumerate(origenes_intermedios):
             validator_lat = df_group['LATITUD_ORIGEN'] == coordinate[0]
             validator_lon = df_group['LONGITUD_ORIGEN'] == coordinate[1]
             val = validator_lat & validator_lon
-            df_group.loc[val, 'ORDEN_RECOGIDA'] = orden_intermedios[i] + 2
+            df_group.loc[val, 'ORDEN_RECOGIDA'] = i + 2
         validator_lat = df_group['LATITUD_ORIGEN'] == origen[0]
         validator_lon = df_group['LONGITUD_ORIGEN'] == origen[1]
         val = validator_lat & validator_lon
         df_group.loc[val, 'ORDEN_RECOGIDA'] = 1
         df_group['RUTA_VALIDA'] = 1
     return df_group
+
+
+def ordenar_recogidas(df_rutas):
+    """
+    Ordena los pasajeros de todas las rutas previas en el orden de recogida
+        que usan las estimaciones de duración.
+
+    En cada RUTA_PREVIA el primer pasajero es el de origen más lejano al
+    destino y los demás conservan el orden del DataFrame, igual que
+    encontrar_origen_mas_lejano. El destino de cada ruta es el del primer
+    pasajero del grupo.
+
+    Args:
+        df_rutas (pd.DataFrame): DataFrame con índice único y las columnas
+            RUTA_PREVIA, LATITUD_ORIGEN, LONGITUD_ORIGEN, LATITUD_DESTINO y
+            LONGITUD_DESTINO.
+
+    Returns:
+        pd.DataFrame: DataFrame con el mismo índice, ordenado por ruta y orden
+            de recogida, con las coordenadas de origen, las del destino de la
+            ruta y la columna booleana ES_INICIO.
+    """
+    columnas = ['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']
+    puntos = df_rutas[['RUTA_PREVIA', *columnas]].copy()
+    grupos = df_rutas.groupby('RUTA_PREVIA', sort=False)
+    puntos['LATITUD_DESTINO'] = grupos['LATITUD_DESTINO'].transform('first')
+    puntos['LONGITUD_DESTINO'] = grupos['LONGITUD_DESTINO'].transform('first')
+    puntos['DISTANCIA_DESTINO'] = distancias_fila(
+        puntos[columnas].to_numpy(dtype=float),
+        puntos[['LATITUD_DESTINO', 'LONGITUD_DESTINO']].to_numpy(dtype=float))
+    inicios = puntos.groupby('RUTA_PREVIA', sort=False)[
+        'DISTANCIA_DESTINO'].idxmax()
+    puntos['ES_INICIO'] = puntos.index.isin(inicios.values)
+    puntos['POSICION'] = np.arange(len(puntos))
+    puntos['NO_INICIO'] = ~puntos['ES_INICIO']
+    puntos.sort_values(['RUTA_PREVIA', 'NO_INICIO', 'POSICION'],
+                       kind='mergesort', inplace=True)
+    return puntos.drop(columns=['POSICION', 'NO_INICIO'])
+
+
+def tramos_recogida(df_orden):
+    """
+    Calcula los tramos de cada ruta en el orden de recogida: de cada
+        pasajero al siguiente y del último al destino.
+
+    Args:
+        df_orden (pd.DataFrame): Resultado de ordenar_recogidas.
+
+    Returns:
+        tuple: Arreglos (N, 2) con el inicio y el fin de cada tramo,
+            alineados con las filas de `df_orden`.
+    """
+    siguientes = df_orden.groupby('RUTA_PREVIA', sort=False)[
+        ['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].shift(-1)
+    # El último pasajero de cada ruta continúa hacia el destino
+    siguientes['LATITUD_ORIGEN'] = siguientes['LATITUD_ORIGEN'].fillna(
+        df_orden['LATITUD_DESTINO'])
+    siguientes['LONGITUD_ORIGEN'] = siguientes['LONGITUD_ORIGEN'].fillna(
+        df_orden['LONGITUD_DESTINO'])
+    return (df_orden[['LATITUD_ORIGEN', 'LONGITUD_ORIGEN']].to_numpy(
+        dtype=float), siguientes.to_numpy(dtype=float))
+
+
+def duraciones_estimadas(df_rutas, vel_prom_km_h=30, df_orden=None):
+    """
+    Calcula la duración estimada de todas las rutas previas en una sola pasada.
+
+    Es equivalente a aplicar duracion_estimada_por_ruta_previa a cada grupo,
+    pero usando el destino del primer pasajero en lugar de uno al azar.
+
+    Args:
+        df_rutas (pd.DataFrame): DataFrame de pasajeros con RUTA_PREVIA y
+            coordenadas de origen y destino.
+        vel_prom_km_h (float, opcional): Velocidad promedio en km/h.
+        df_orden (pd.DataFrame, opcional): Resultado de ordenar_recogidas,
+            si ya se calculó.
+
+    Returns:
+        pd.Series: Duración estimada en minutos (entero) por RUTA_PREVIA.
+    """
+    if df_orden is None:
+        df_orden = ordenar_recogidas(df_rutas)
+    tramos = pd.Series(distancias_fila(*tramos_recogida(df_orden)),
+                       index=df_orden.index)
+    distancias_km = tramos.groupby(df_orden['RUTA_PREVIA'], sort=False).sum()
+    duraciones = distancias_km / vel_prom_km_h * 60
+    return duraciones.astype(int).rename('DURACION_CALCULADA')
+
+
+def duraciones_modelo(df_rutas, modelo, fecha_str="2023-10-20",
+                      df_orden=None):
+    """
+    Estima la duración de todas las rutas previas con el modelo de tiempos
+        aprendido (ver modelo_tiempo.ModeloTiempo).
+
+    Cada tramo se estima con el perfil de velocidad de su zona, día y hora
+    de salida; la duración máxima de la ruta suma los límites superiores de
+    sus tramos, lo que equivale a suponer que sus errores están
+    correlacionados (el tráfico afecta a toda la ruta).
+
+    Args:
+        df_rutas (pd.DataFrame): DataFrame de pasajeros con RUTA_PREVIA,
+            HORA_SERVICIO_C y coordenadas.
+        modelo (ModeloTiempo): Modelo de tiempos.
+        fecha_str (str, opcional): Fecha (YYYY-MM-DD) usada para la hora
+            de salida.
+        df_orden (pd.DataFrame, opcional): Resultado de ordenar_recogidas,
+            si ya se calculó.
+
+    Returns:
+        pd.DataFrame: Una fila por RUTA_PREVIA con HORA_SALIDA y
+            DURACION_MODELO y DURACION_MODELO_MAX en minutos; la máxima es
+            NaN si algún tramo no tiene perfil.
+    """
+    if df_orden is None:
+        df_orden = ordenar_recogidas(df_rutas)
+    horas = df_rutas.groupby('RUTA_PREVIA', sort=False)['HORA_SERVICIO_C'].max()
+    salidas = pd.Series(
+        [obtener_hora_salida(hora.time(), fecha_str) for hora in horas],
+        index=horas.index)
+    inicios, fines = tramos_recogida(df_orden)
+    estimacion = modelo.estimar(
+        inicios, fines, salidas.reindex(df_orden['RUTA_PREVIA']).to_numpy())
+    estimacion.index = df_orden.index
+    grupos = estimacion.groupby(df_orden['RUTA_PREVIA'], sort=False)
+    completas = grupos['DURACION_MAX'].count() == grupos.size()
+    return pd.DataFrame({
+        'HORA_SALIDA': salidas,
+        'DURACION_MODELO': grupos['DURACION'].sum() / 60,
+        'DURACION_MODELO_MAX': (grupos['DURACION_MAX'].sum() / 60).where(
+            completas),
+    })
+
+
+def ordenar_solicitudes(solicitudes, max_hilos=RUTAS_MAX_HILOS):
+    """
+    Calcula localmente y de forma concurrente el orden de los waypoints de
+        varias solicitudes de ruta (ver google_maps.orden_waypoints).
+
+    Args:
+        solicitudes (list of dict): Solicitudes con la forma de
+            calcular_rutas_batch.
+        max_hilos (int, opcional): Número máximo de rutas ordenadas a la vez.
+
+    Returns:
+        list: Orden de visita de cada solicitud con la forma de
+            `waypoint_order`, o None si no se pudo calcular sin costo.
+    """
+    def _ordenar(solicitud):
+        try:
+            return orden_waypoints(
+                solicitud['origen'], solicitud['destino'],
+                solicitud.get('waypoints'), solicitud.get('departure_time'),
+                solicitud.get('proveedor'))
+        except Exception:
+            return None
+
+    if not solicitudes:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, max_hilos)) as executor:
+        return list(executor.map(en_contexto(_ordenar), solicitudes))
+
+
+@etapa
+def duraciones_reales(df_rutas, fecha_str="2023-10-20",
+                      max_hilos=RUTAS_MAX_HILOS, df_orden=None,
+                      proveedor=None, orden_local=RUTAS_ORDEN_LOCAL):
+    """
+    Calcula la duración real de todas las rutas previas con solicitudes
+        concurrentes a la API de rutas.
+
+    Cada ruta parte del origen más lejano y usa los demás pasajeros como
+    waypoints, optimizando su orden cuando hay más de uno, igual que
+    duracion_real_por_ruta_previa. Con `orden_local` el orden se calcula
+    con la matriz de tiempos (ver google_maps.orden_waypoints) y cada ruta
+    se pide ya ordenada, sin optimize_waypoints; si el orden local falla o
+    la matriz tendría costo se deja que la API lo optimice.
+
+    Args:
+        df_rutas (pd.DataFrame): DataFrame de pasajeros con RUTA_PREVIA,
+            HORA_SERVICIO_C y coordenadas de origen y destino.
+        fecha_str (str, opcional): Fecha (YYYY-MM-DD) usada para la hora
+            de salida.
+        max_hilos (int, opcional): Número máximo de solicitudes simultáneas.
+        df_orden (pd.DataFrame, opcional): Resultado de ordenar_recogidas,
+            si ya se calculó.
+        proveedor (str, opcional): Proveedor de rutas (ver calcular_ruta).
+        orden_local (bool, opcional): Ordenar los waypoints localmente.
+
+    Returns:
+        tuple:
+            pd.DataFrame: Una fila por RUTA_PREVIA con HORA_SALIDA,
+                DURACION_REAL (minutos) y ERROR.
+            pd.Series: ORDEN_RECOGIDA de cada pasajero, con el índice de
+                `df_rutas`; el origen más lejano tiene el orden 1.
+    """
+    if df_orden is None:
+        df_orden = ordenar_recogidas(df_rutas)
+    horas = df_rutas.groupby('RUTA_PREVIA', sort=False)['HORA_SERVICIO_C'].max()
+    rutas, solicitudes, indices = [], [], []
+    for ruta, grupo in df_orden.groupby('RUTA_PREVIA', sort=False):
+        origenes = list(zip(grupo['LATITUD_ORIGEN'], grupo['LONGITUD_ORIGEN']))
+        destino = (grupo['LATITUD_DESTINO'].iat[0],
+                   grupo['LONGITUD_DESTINO'].iat[0])
+        intermedios = origenes[1:]
+        rutas.append(ruta)
+        indices.append(grupo.index)
+        solicitudes.append({
+            'origen': origenes[0],
+            'destino': destino,
+            'waypoints': intermedios,
+            'departure_time': obtener_hora_salida(
+                horas[ruta].time(), fecha_str),
+            'optimize': len(intermedios) > 1,
+            'proveedor': proveedor
+        })
+    ordenes_locales = [None] * len(solicitudes)
+    if orden_local:
+        ordenes_locales = ordenar_solicitudes(solicitudes, max_hilos)
+        for solicitud, orden in zip(solicitudes, ordenes_locales):
+            if orden is not None:
+                solicitud['waypoints'] = [
+                    solicitud['waypoints'][i] for i in orden]
+                solicitud['optimize'] = False
+    resultados = calcular_rutas_batch(solicitudes, max_hilos)
+    filas, ordenes = [], []
+    for ruta, solicitud, indice, orden_visita, resultado in zip(
+            rutas, solicitudes, indices, ordenes_locales, resultados):
+        duracion, error = np.nan, resultado.error
+        if error is None and resultado.respuesta:
+            duracion = obtener_duracion_real_ruta(resultado.respuesta)
+            if orden_visita is None:
+                orden_visita = resultado.respuesta[0].get('waypoint_order') \
+                    or list(range(len(indice) - 1))
+            # Posición de visita de cada waypoint en el orden optimizado
+            posiciones = np.argsort(orden_visita) + 2
+            ordenes.append(pd.Series(
+                np.concatenate([[1], posiciones]), index=indice))
+        elif error is None:
+            error = ValueError("La API de rutas no retornó resultados")
+        filas.append({
+            'RUTA_PREVIA': ruta,
+            'HORA_SALIDA': solicitud['departure_time'],
+            'DURACION_REAL': duracion,
+            'ERROR': None if error is None else repr(error)
+        })
+    orden = pd.concat(ordenes) if ordenes else pd.Series(dtype=float)
+    return pd.DataFrame(filas, columns=[
+        'RUTA_PREVIA', 'HORA_SALIDA', 'DURACION_REAL', 'ERROR']), \
+        orden.rename('ORDEN_RECOGIDA')
+
+
+@etapa
+def resumen_duraciones(df_rutas, fecha_str="2023-10-20",
+                       max_duracion=MAX_DURATION, vel_prom_km_h=30,
+                       calcular_reales=True, max_hilos=RUTAS_MAX_HILOS,
+                       proveedor=None, modelo=None):
+    """
+    Valida todas las rutas previas de un DataFrame contra una duración máxima.
+
+    Reemplaza la aplicación por grupo de duracion_estimada_por_ruta_previa y
+    duracion_real_por_ruta_previa: las duraciones estimadas se calculan en
+    una sola pasada vectorizada, las reales con solicitudes concurrentes y el
+    orden de recogida se asigna con un único join por índice.
+
+    Si se indica un `modelo` de tiempos, las rutas cuya duración máxima
+    según el modelo (límite superior de confianza) no supera
+    `max_duracion` se validan sin consultar la API de rutas; solo las
+    demás se calculan con duraciones_reales.
+
+    Args:
+        df_rutas (pd.DataFrame): DataFrame de pasajeros con índice único y
+            columnas RUTA_PREVIA, HORA_SERVICIO_C y coordenadas.
+        fecha_str (str, opcional): Fecha (YYYY-MM-DD) usada para la hora
+            de salida.
+        max_duracion (int, opcional): Duración máxima válida en minutos.
+        vel_prom_km_h (float, opcional): Velocidad promedio de la estimación.
+        calcular_reales (bool, opcional): Si es False solo se calcula la
+            duración estimada y la validación se hace sobre ella.
+        max_hilos (int, opcional): Número máximo de solicitudes simultáneas.
+        proveedor (str, opcional): Proveedor de rutas de las duraciones reales.
+        modelo (ModeloTiempo, opcional): Modelo de tiempos aprendido, por
+            ejemplo modelo_tiempo.obtener_modelo().
+
+    Returns:
+        tuple:
+            pd.DataFrame: `df_rutas` con las columnas DURACION_CALCULADA,
+                DURACION_REAL, RUTA_VALIDA y ORDEN_RECOGIDA (esta última solo
+                en rutas válidas).
+            pd.DataFrame: Resumen con una fila por RUTA_PREVIA y las columnas
+                PASAJEROS, HORA_SALIDA, DURACION_CALCULADA, DURACION_REAL,
+                RUTA_VALIDA, ERROR y FUENTE_DURACION ('real', 'modelo' o
+                'estimada'); con `modelo` también DURACION_MODELO y
+                DURACION_MODELO_MAX.
+
+    Example:
+        df_validado, df_resumen = resumen_duraciones(df_rutas, '2023-12-04', 45)
+        print(df_resumen[df_resumen['RUTA_VALIDA'] == 0])
+    """
+    columnas = ['DURACION_CALCULADA', 'DURACION_REAL', 'RUTA_VALIDA',
+                'ORDEN_RECOGIDA']
+    df_rutas = df_rutas.drop(columns=columnas, errors='ignore')
+    df_orden = ordenar_recogidas(df_rutas)
+    resumen = df_rutas.groupby('RUTA_PREVIA', sort=False).size().rename(
+        'PASAJEROS').to_frame()
+    resumen = resumen.join(
+        duraciones_estimadas(df_rutas, vel_prom_km_h, df_orden))
+    columnas_modelo = []
+    por_modelo = pd.Series(False, index=resumen.index)
+    if modelo is not None:
+        df_modelo = duraciones_modelo(df_rutas, modelo, fecha_str, df_orden)
+        columnas_modelo = ['DURACION_MODELO', 'DURACION_MODELO_MAX']
+        resumen = resumen.join(df_modelo[columnas_modelo])
+        # Rutas que con confianza están dentro del límite
+        por_modelo = resumen['DURACION_MODELO_MAX'] <= max_duracion
+    if calcular_reales:
+        consultar = df_orden['RUTA_PREVIA'].isin(resumen.index[~por_modelo])
+        reales, orden = duraciones_reales(
+            df_rutas.loc[df_orden.index[consultar]], fecha_str, max_hilos,
+            df_orden[consultar], proveedor)
+        resumen = resumen.join(reales.set_index('RUTA_PREVIA'))
+        duracion = resumen['DURACION_REAL']
+        resumen['FUENTE_DURACION'] = 'real'
+        if por_modelo.any():
+            resumen['HORA_SALIDA'] = resumen['HORA_SALIDA'].fillna(
+                df_modelo['HORA_SALIDA'])
+            duracion = duracion.where(~por_modelo, resumen['DURACION_MODELO'])
+            resumen.loc[por_modelo, 'FUENTE_DURACION'] = 'modelo'
+            # Sin respuesta de la API se conserva el orden de ordenar_recogidas
+            orden_modelo = df_orden.groupby('RUTA_PREVIA', sort=False).cumcount() + 1
+            orden = pd.concat([orden, orden_modelo[~consultar]]).rename(
+                'ORDEN_RECOGIDA')
+    else:
+        orden = pd.Series(dtype=float, name='ORDEN_RECOGIDA')
+        resumen['HORA_SALIDA'] = pd.NaT
+        resumen['DURACION_REAL'] = np.nan
+        resumen['ERROR'] = None
+        resumen['FUENTE_DURACION'] = 'estimada'
+        duracion = resumen['DURACION_CALCULADA']
+    resumen['RUTA_VALIDA'] = (duracion <= max_duracion).astype(int)
+    resumen.reset_index(inplace=True)
+    resumen = resumen[['RUTA_PREVIA', 'PASAJEROS', 'HORA_SALIDA',
+                       'DURACION_CALCULADA', *columnas_modelo,
+                       'DURACION_REAL', 'RUTA_VALIDA', 'ERROR',
+                       'FUENTE_DURACION']]
+    df_rutas = df_rutas.merge(
+        resumen[['RUTA_PREVIA', 'DURACION_CALCULADA', 'DURACION_REAL',
+                 'RUTA_VALIDA']],
+        on='RUTA_PREVIA', how='left').set_index(df_rutas.index)
+    validos = df_rutas['RUTA_VALIDA'] == 1
+    df_rutas = df_rutas.join(orden[orden.index.isin(df_rutas.index[validos])])
+    return df_rutas, resumen
@@ -7,4 +7,6 @@ router = routers.DefaultRouter()
 urlpatterns = [
 	#urls Para Apis
 	url(r'^consultaRutas',(consultaRutas), name='consultaRutas'),
+	url(r'^metricasRutas',(metricasRutas), name='metricasRutas'),
+	url(r'^reporteRutas',(reporteRutas), name='reporteRutas'),
 ]
\ No newline at end of file
@@ -2,6 +2,7 @@ from django.shortcuts import render,redirect
 from django.http import HttpResponse, JsonResponse
 from apps.usuarios.views import user_validar_rol
 from apps.ruteo.ruta import servicios_completos
+from apps.ruteo.decoradores import ejecucion, registro_metricas
 from apps.procedimientos.forms import *
 from apps.procedimientos.models import *
 from apps.destinos.models import *
@@ -32,12 +33,17 @@ def consultaRutas(request):
 	tipo_procedimiento = request.GET.get('tipo_procedimiento')
 	ciudad_origen = request.GET.get('ciudad_origen')
 	ciudad_destino = request.GET.get('ciudad_destino')
+	# Recalcular solo los grupos afectados de los días ya ruteados
+	incremental = request.GET.get('incremental') in ('1', 'true')
 	print("-----------------", fecha_inicio, fecha_fin, tipo_procedimiento, ciudad_origen, ciudad_destino)	
 	if request.method=='GET':
 		if request.GET.get('action') == 'download':
 			output = BytesIO()			
-			df_rutas_ida, df_rutas_retorno = servicios_completos(
-				fecha_inicio, fecha_fin, [14], int(tiempo))
+			with ejecucion() as id_ejecucion:
+				df_rutas_ida, df_rutas_retorno = servicios_completos(
+					fecha_inicio, fecha_fin, [14], int(tiempo),
+					ciudad_origen=int(ciudad_origen), ciudad_destino=int(ciudad_destino),
+					incremental=incremental)
 			columnas_omitidas = [
 				'IDENTIFICACION_USUARIO',
 				'HORA_SERVICIO_C',
@@ -50,8 +56,6 @@ def consultaRutas(request):
 				'RUTA_PREVIA',
 				'RUTA_INICIAL',
 				'DISTANCIA_LINEAL',
-				'COORD_ORIGEN',
-				'COORD_DESTINO',
 			]
 			df_rutas_ida_export = df_rutas_ida.drop(columns=columnas_omitidas, axis=1, errors='ignore')
 			df_rutas_retorno_export = df_rutas_retorno.drop(columns=columnas_omitidas, axis=1, errors='ignore')
@@ -99,6 +103,31 @@ def consultaRutas(request):
 			# Define la respuesta HTTP con el contenido adecuado
 			response = HttpResponse(output.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 			response['Content-Disposition'] = 'attachment; filename="rutas.xlsx"'
+			# Permite consultar el reporte de la ejecución en reporteRutas
+			response['X-Ruteo-Ejecucion'] = id_ejecucion
 
 			return response
-	return render(request, "ruteo/consultaRutas.html", context)
\ No newline at end of file
+	return render(request, "ruteo/consultaRutas.html", context)
+
+
+def metricasRutas(request):
+	"""
+	Expone las métricas del proceso de ruteo en formato de texto de Prometheus.
+	"""
+	return HttpResponse(
+		registro_metricas.prometheus(),
+		content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def reporteRutas(request):
+	"""
+	Retorna el reporte de una ejecución de ruteo (parámetro 'ejecucion') o,
+	sin parámetro, la lista de ejecuciones disponibles.
+	"""
+	id_ejecucion = request.GET.get('ejecucion')
+	if not id_ejecucion:
+		return JsonResponse({'ejecuciones': list(registro_metricas.ejecuciones)})
+	reporte = registro_metricas.reporte(id_ejecucion)
+	if reporte is None:
+		return JsonResponse({'error': 'Ejecución no encontrada'}, status=404)
+	return JsonResponse(reporte)